@@ -10,6 +10,7 @@ from kivy.resources import resource_add_path
 from kivy.uix.screenmanager import ScreenManager
 
 import client.utils as utils
+from client.async_api_client import AsyncApiClientInstance
 from client.client_config import ClientConfig
 from client.screens.common import Alert
 from client.screens.image_view_screen import ImageViewScreen
@@ -106,9 +107,19 @@ if __name__ == "__main__":
         app.thread_pool.shutdown(wait=True)
         open_images = app.sm.get_screen("InstanceAnnotator").model.active.copy()
         print(open_images)
-        for iid in open_images:
-            response = utils.update_image_meta_by_id(iid, lock=False)
+        if open_images:
+            response = utils.update_image_metas_by_ids(open_images, lock=False)
             if response.status_code == 200:
-                print("Unlocked %d" % iid)
+                for row in response.json()["results"]:
+                    if row["action"] == "updated":
+                        print("Unlocked %d" % row["id"])
+                    else:
+                        print("Failed to unlock %d" % row["id"])
             else:
-                print("Failed to unlock %d" % iid)
+                print("Failed to unlock %s" % open_images)
+        for client in (utils.api, AsyncApiClientInstance()):
+            for endpoint, stats in sorted(client.stats().items()):
+                print("%-48s %5d requests %3d errors %8.1f ms mean %8.1f ms max" % (
+                    endpoint, stats["count"], stats["errors"],
+                    stats["mean_time"] * 1000, stats["max_time"] * 1000))
+            client.close()
@@ -0,0 +1,114 @@
+"""
+A pooled HTTP client for the server API.
+
+Every request made by client/utils.py goes through one requests.Session whose
+connection pool is sized to the client's thread pool, so concurrent background
+calls reuse kept-alive connections rather than opening a socket per request.
+Requests time out instead of hanging a worker thread, and the latency of every
+endpoint is recorded for diagnosing slow screens.
+"""
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from client.client_config import ClientConfig
+
+
+class EndpointStats:
+    """
+    Latency statistics for one endpoint.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, failed):
+        self.count += 1
+        self.errors += failed
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_time": self.total_time / self.count if self.count else 0.0,
+            "max_time": self.max_time
+        }
+
+
+class ApiClient:
+    """
+    A thread-safe client for the server API sharing one pool of kept-alive connections.
+    """
+
+    def __init__(self,
+                 base_url=ClientConfig.SERVER_URL,
+                 pool_size=ClientConfig.CLIENT_POOL_LIMIT,
+                 connect_timeout=ClientConfig.HTTP_CONNECT_TIMEOUT,
+                 read_timeout=ClientConfig.HTTP_READ_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = Lock()
+        self._stats = {}
+
+    def request(self, method, endpoint, path, **kwargs):
+        """
+        :param method: The HTTP method
+        :param endpoint: The route the statistics are recorded against, e.g. "images/<iid>/raw"
+        :param path: The path relative to the server url
+        :return: A requests.Response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        failed = True
+        t0 = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self._stats.setdefault(method + " " + endpoint, EndpointStats()).record(elapsed, failed)
+
+    def get(self, endpoint, path, **kwargs):
+        return self.request("GET", endpoint, path, **kwargs)
+
+    def post(self, endpoint, path, **kwargs):
+        return self.request("POST", endpoint, path, **kwargs)
+
+    def put(self, endpoint, path, **kwargs):
+        return self.request("PUT", endpoint, path, **kwargs)
+
+    def delete(self, endpoint, path, **kwargs):
+        return self.request("DELETE", endpoint, path, **kwargs)
+
+    def stats(self):
+        """
+        :return: A dict of "METHOD endpoint" -> count, errors, mean and max time in seconds
+        """
+        with self._lock:
+            return {k: v.as_dict() for k, v in self._stats.items()}
+
+    def close(self):
+        self.session.close()
+
+
+class ApiClientInstance:
+    __instance = None
+
+    def __new__(cls):
+        if ApiClientInstance.__instance is None:
+            ApiClientInstance.__instance = ApiClient()
+        return ApiClientInstance.__instance
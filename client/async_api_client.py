@@ -0,0 +1,203 @@
+"""
+An asyncio client for the server API.
+
+Requests run as coroutines on one event loop thread, so hundreds of requests in
+flight hold no threads of their own. Requests to each host are bounded by a
+semaphore, requests may be grouped, e.g. by the screen which made them, and a
+group cancelled as a whole, and results are handed to Kivy on the main thread.
+
+Every API function in client/utils.py takes a client argument. Passed this
+client, it returns a coroutine of its response rather than the response itself:
+
+    async_api.submit(utils.get_image_thumbnails, ids, on_result=show, group=screen)
+"""
+import asyncio
+import json
+import time
+from threading import Lock, Thread
+from urllib.parse import urlsplit
+
+import aiohttp
+from kivy.app import App
+from kivy.clock import mainthread
+
+from client.api_client import EndpointStats
+from client.client_config import ClientConfig
+
+
+class AsyncResponse:
+    """
+    A fully read response, with the parts of requests.Response used by the client.
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+
+class AsyncApiClient:
+    """
+    A client running API requests on a dedicated event loop thread.
+    """
+
+    def __init__(self,
+                 base_url=ClientConfig.SERVER_URL,
+                 host_concurrency=ClientConfig.ASYNC_HOST_CONCURRENCY,
+                 connect_timeout=ClientConfig.HTTP_CONNECT_TIMEOUT,
+                 read_timeout=ClientConfig.HTTP_READ_TIMEOUT):
+        self.base_url = base_url
+        self.host_concurrency = host_concurrency
+        self.timeout = (connect_timeout, read_timeout)
+
+        self._lock = Lock()
+        self._stats = {}
+        self._groups = {}  # group -> set of futures
+
+        # Only touched from the event loop thread
+        self._session = None
+        self._semaphores = {}  # host -> asyncio.Semaphore
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._run_loop, name="api-event-loop", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def request(self, method, endpoint, path, **kwargs):
+        """
+        :param method: The HTTP method
+        :param endpoint: The route the statistics are recorded against, e.g. "images/<iid>/raw"
+        :param path: The path relative to the server url
+        :param kwargs: requests style headers, data, files and timeout
+        :return: A coroutine of an AsyncResponse, to be awaited on this client's loop
+        """
+        connect_timeout, read_timeout = kwargs.pop("timeout", self.timeout)
+        kwargs["timeout"] = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+        # Files are read now, as the caller closes them once the request is built
+        files = kwargs.pop("files", None)
+        if files is not None:
+            form = aiohttp.FormData()
+            for field, (filename, f, content_type) in files:
+                form.add_field(field, f.read(), filename=filename, content_type=content_type)
+            kwargs["data"] = form
+
+        return self._request(method, endpoint, self.base_url + path, kwargs)
+
+    async def _request(self, method, endpoint, url, kwargs):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=ClientConfig.CLIENT_POOL_LIMIT))
+        host = urlsplit(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.host_concurrency)
+
+        async with self._semaphores[host]:
+            failed = True
+            t0 = time.perf_counter()
+            try:
+                async with self._session.request(method, url, **kwargs) as resp:
+                    content = await resp.read()
+                    failed = resp.status >= 500
+                    return AsyncResponse(resp.status, resp.headers, content)
+            finally:
+                elapsed = time.perf_counter() - t0
+                with self._lock:
+                    self._stats.setdefault(method + " " + endpoint, EndpointStats()).record(elapsed, failed)
+
+    def get(self, endpoint, path, **kwargs):
+        return self.request("GET", endpoint, path, **kwargs)
+
+    def post(self, endpoint, path, **kwargs):
+        return self.request("POST", endpoint, path, **kwargs)
+
+    def put(self, endpoint, path, **kwargs):
+        return self.request("PUT", endpoint, path, **kwargs)
+
+    def delete(self, endpoint, path, **kwargs):
+        return self.request("DELETE", endpoint, path, **kwargs)
+
+    def run(self, coro, on_result=None, group=None):
+        """
+        Schedule a coroutine on the event loop.
+        :param coro: A coroutine, typically awaiting API calls made with this client
+        :param on_result: Called on the Kivy main thread with the result
+        :param group: A key the coroutine can be cancelled by, see cancel
+        :return: A concurrent.futures.Future of the result
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if group is not None:
+            with self._lock:
+                self._groups.setdefault(group, set()).add(future)
+        future.add_done_callback(lambda f: self._done(f, on_result, group))
+        return future
+
+    def submit(self, call, *args, on_result=None, group=None, **kwargs):
+        """
+        Run an API function from client/utils.py on the event loop.
+        :param call: The API function, e.g. utils.get_image_by_id
+        :param on_result: Called on the Kivy main thread with the response
+        :param group: A key the request can be cancelled by, see cancel
+        :return: A concurrent.futures.Future of the response
+        """
+        return self.run(call(*args, client=self, **kwargs), on_result, group)
+
+    def cancel(self, group):
+        """
+        Cancel every unfinished request in a group, their callbacks are not called.
+        """
+        with self._lock:
+            futures = self._groups.pop(group, set())
+        for future in futures:
+            future.cancel()
+
+    def _done(self, future, on_result, group):
+        if group is not None:
+            with self._lock:
+                futures = self._groups.get(group)
+                if futures is not None:
+                    futures.discard(future)
+                    if not futures:
+                        del self._groups[group]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self._deliver(App.get_running_app().alert_user, future)
+        elif on_result is not None:
+            self._deliver(on_result, future.result())
+
+    @staticmethod
+    @mainthread
+    def _deliver(callback, value):
+        callback(value)
+
+    def stats(self):
+        """
+        :return: A dict of "METHOD endpoint" -> count, errors, mean and max time in seconds
+        """
+        with self._lock:
+            return {k: v.as_dict() for k, v in self._stats.items()}
+
+    def close(self, timeout=5):
+        async def close_session():
+            if self._session is not None:
+                await self._session.close()
+
+        asyncio.run_coroutine_threadsafe(close_session(), self.loop).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+class AsyncApiClientInstance:
+    __instance = None
+
+    def __new__(cls):
+        if AsyncApiClientInstance.__instance is None:
+            AsyncApiClientInstance.__instance = AsyncApiClient()
+        return AsyncApiClientInstance.__instance
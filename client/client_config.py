@@ -25,3 +25,35 @@ class ClientConfig:
     DATA_DIR = os.path.join(ROOT_DIR, 'client', 'data')
 
     CLIENT_POOL_LIMIT = 50
+
+    # Seconds to wait for the server to accept a connection, and then for each read of a response
+    HTTP_CONNECT_TIMEOUT = 5
+    HTTP_READ_TIMEOUT = 60
+    # Upload requests also wait while the server ingests a whole batch of images
+    HTTP_UPLOAD_READ_TIMEOUT = 600
+
+    # Requests in flight at once to a single host from the asyncio client
+    ASYNC_HOST_CONCURRENCY = 16
+
+    # Number of thumbnails requested at once by the Image View
+    THUMBNAIL_BATCH_SIZE = 100
+
+    # Number of image metas loaded at a time by the Instance Annotator
+    IMAGE_PAGE_SIZE = 200
+
+    # Image locks are leases which the client renews while it holds them
+    LOCK_OWNER_HEADER = "X-Lock-Owner"
+    LOCK_HEARTBEAT_INTERVAL = 30
+
+    # Folder uploads
+    UPLOAD_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+    UPLOAD_WORKERS = 4
+    UPLOAD_BATCH_BYTES = 32 * 1024 * 1024  # Upper bound on a single multipart request
+    UPLOAD_BATCH_FILES = 64
+    UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024  # Larger files are sent in resumable chunks
+    UPLOAD_RETRIES = 3
+    UPLOAD_MANIFEST_DIR = os.path.join(
+        os.path.expanduser("~"), ".fastannotation", "uploads")
+
+    # Mask encodings used on the wire, the smallest result is sent per annotation
+    MASK_ENCODINGS = ("rle", "packbits_zlib")
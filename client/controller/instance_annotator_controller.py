@@ -1,46 +1,129 @@
+from threading import Lock
+
 import numpy as np
 
 import client.utils as utils
+from client.client_config import ClientConfig
 from client.model.instance_annotator_model import ImageState, AnnotationState, LabelState
 from client.utils import ApiException
+from common import image_container
 
 
 class InstanceAnnotatorController:
     def __init__(self, model):
         self.model = model
 
+        # Paging state of the image listing, the cursor is None once every page is loaded
+        self._page_lock = Lock()
+        self._page_project_id = None
+        self._page_filter = None
+        self._page_cursor = None
+
+        # Images locked for this client by the project's work queue
+        self._claimed = set()
+
     def fetch_image_metas(self, project_id, filter_details):
         """
-        Fetch the meta information for all un-opened images in this project
+        Start listing the images in this project and fetch the meta information for
+        the first page of un-opened images. Later pages are loaded with fetch_next_image_metas.
         :param project_id: The ID for this project
         :param filter_details: A dict of filter params used to order the images
         :return:
         """
-        resp = utils.get_project_images(project_id, filter_details)
+        with self._page_lock:
+            self._page_project_id = project_id
+            self._page_filter = dict(filter_details)
+            self._page_filter["limit"] = ClientConfig.IMAGE_PAGE_SIZE
+            self._page_filter["fields"] = ["name", "is_locked"]
+            self._page_cursor = ""
+        self.fetch_next_image_metas()
+
+    def has_more_image_metas(self):
+        with self._page_lock:
+            return self._page_cursor is not None
+
+    def fetch_next_image_metas(self):
+        """
+        Fetch the meta information for the next page of un-opened images in this project.
+        :return: True if a page was fetched, False if every page has been loaded
+        """
+        with self._page_lock:
+            if self._page_cursor is None:
+                return False
 
-        if resp.status_code != 200:
-            raise ApiException(
-                "Failed to retrieve project image ids.",
-                resp.status_code)
+            filter_details = dict(self._page_filter)
+            if self._page_cursor:
+                filter_details["cursor"] = self._page_cursor
+            resp = utils.get_project_images(self._page_project_id, filter_details)
 
-        result = resp.json()
+            if resp.status_code != 200:
+                raise ApiException(
+                    "Failed to retrieve project image ids.",
+                    resp.status_code)
 
-        resp = utils.get_image_metas_by_ids(result["ids"])
+            result = resp.json()
+            self._page_cursor = result.get("next_cursor")
+            for row in result["images"]:
+                if self.model.images.is_open(row["id"]):
+                    continue
+
+                state = ImageState(id=row["id"],
+                                   name=row["name"],
+                                   is_locked=row["is_locked"],
+                                   is_open=False)
+                self.model.images.add(row["id"], state)
+            return True
+
+    def claim_next_image(self, project_id):
+        """
+        Claim the next unlocked, unlabeled image in this project from the server.
+        :param project_id: The ID for this project
+        :return: The ID of the claimed image, or None if no images remain
+        """
+        resp = utils.claim_project_images(project_id)
         if resp.status_code != 200:
             raise ApiException(
-                "Failed to retrieve image meta information.",
+                "Failed to claim the next image.",
                 resp.status_code)
 
         result = resp.json()
-        for row in result["images"]:
-            if self.model.images.is_open(row["id"]):
-                continue
+        if not result["images"]:
+            return None
 
-            state = ImageState(id=row["id"],
-                               name=row["name"],
-                               is_locked=row["is_locked"],
-                               is_open=False)
-            self.model.images.add(row["id"], state)
+        row = result["images"][0]
+        image_model = self.model.images.get(row["id"])
+        if image_model is None:
+            image_model = ImageState(id=row["id"], name=row["name"])
+        image_model.is_locked = True
+        self.model.images.add(row["id"], image_model)
+        self._claimed.add(row["id"])
+        return row["id"]
+
+    def renew_leases(self):
+        """
+        Renew the locks held on the images this client has open or has claimed.
+        Images whose lock has been lost, e.g. after the client was offline for longer
+        than the lease, are marked as unlocked.
+        :return: The list of image ids whose lock was lost
+        """
+        ids = set(self.model.active.copy()) | self._claimed
+        ids = [iid for iid in ids
+               if self.model.images.get(iid) is not None and self.model.images.get(iid).is_locked]
+        if not ids:
+            return []
+
+        resp = utils.renew_image_leases(ids)
+        if resp.status_code != 200:
+            raise ApiException("Failed to renew image locks.", resp.status_code)
+
+        held = set(resp.json()["ids"])
+        lost = [iid for iid in ids if iid not in held]
+        for iid in lost:
+            image_model = self.model.images.get(iid)
+            image_model.is_locked = False
+            self.model.images.add(iid, image_model)
+            self._claimed.discard(iid)
+        return lost
 
     def fetch_image(self, image_id):
         """
@@ -53,44 +136,38 @@ class InstanceAnnotatorController:
         if not image_model:
             image_model = ImageState()
 
-        resp = utils.update_image_meta_by_id(image_id, lock=True)
-        if resp.status_code != 200:
-            raise ApiException(
-                "Failed to lock image with id %d" %
-                image_id, resp.status_code)
-
-        resp = utils.get_image_by_id(image_id)
+        # Locking, the image bytes and its annotations arrive in one response
+        resp = utils.open_image_by_id(image_id)
         if resp.status_code == 404:
             raise ApiException(
                 "Image does not exist with id %d." %
                 image_id, resp.status_code)
+        elif resp.status_code == 409:
+            raise ApiException(
+                "The image with id %d is locked by another user." %
+                image_id, resp.status_code)
         elif resp.status_code != 200:
             raise ApiException(
-                "Failed to retrieve image with id %d." %
+                "Failed to open image with id %d." %
                 image_id, resp.status_code)
 
-        result = resp.json()
-        img_bytes = utils.decode_image(result["image_data"])
-        image_model.id = result["id"]
-        image_model.name = result["name"]
-        image_model.is_locked = result["is_locked"]
-        image_model.image = utils.bytes2mat(img_bytes)
-        image_model.shape = image_model.image.shape
+        result, image_bytes = image_container.unpack(resp.content)
 
-        resp = utils.get_image_annotation(image_id)
-        if resp.status_code != 200:
-            raise ApiException(
-                "Failed to retrieve annotations for the image with id %d." %
-                image_id, resp.status_code)
+        image_model.id = image_id
+        image_model.name = result["image"]["name"]
+        image_model.is_locked = True
+        image_model.image = utils.bytes2mat(image_bytes)
+        image_model.shape = image_model.image.shape
 
-        result = resp.json()
         annotations = {}
         i = 0
         for row in result["annotations"]:
             # TODO: Add actual annotation names to database
             annotation_name = row["name"]
             class_name = row["class_name"]
-            mask = utils.decode_mask(row["mask_data"], row["shape"][:2])
+            mask = utils.decode_mask(row["mask_data"],
+                                     row["shape"][:2],
+                                     row.get("mask_encoding"))
 
             bbox = row["bbox"]
             print("CLIENT: incoming bbox")
@@ -207,6 +284,7 @@ class InstanceAnnotatorController:
 
         image_model.is_locked = False
         image_model.unsaved = False
+        self._claimed.discard(iid)
 
         self.model.images.add(iid, image_model)
 
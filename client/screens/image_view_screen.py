@@ -1,10 +1,13 @@
+import asyncio
+
 from kivy.app import App
+from kivy.clock import mainthread
 from kivy.uix.screenmanager import Screen
 
 import client.utils as utils
+from client.async_api_client import AsyncApiClientInstance
 from client.screens.common import *
 from client.utils import ApiException
-from client.utils import background
 
 # Load corresponding kivy file
 Builder.load_file(
@@ -12,6 +15,8 @@ Builder.load_file(
         ClientConfig.DATA_DIR,
         'image_view_screen.kv'))
 
+async_api = AsyncApiClientInstance()
+
 
 class Thumbnail(BoxLayout):
     cust_texture = ObjectProperty(None)
@@ -36,19 +41,62 @@ class ImageViewScreen(Screen):
         }
         self._load_images(self.app.current_project_id, filter_details)
 
-    @background
+    def on_leave(self, *args):
+        # Thumbnails still loading for this screen are no longer wanted
+        async_api.cancel(self)
+
     def _load_images(self, pid, filter_details):
-        resp = utils.get_project_images(pid, filter_details=filter_details)
+        async_api.run(self._fetch_images(pid, filter_details), group=self)
+
+    async def _fetch_images(self, pid, filter_details):
+        """
+        Page through the project's images, fetching the thumbnails of each page
+        while the next page is listed.
+        """
+        filter_details = dict(filter_details)
+        filter_details["limit"] = ClientConfig.THUMBNAIL_BATCH_SIZE
+        tasks = []
+        try:
+            while True:
+                resp = await utils.get_project_images(
+                    pid, filter_details=filter_details, client=async_api)
+                if resp.status_code != 200:
+                    raise ApiException(
+                        "Failed to load project images from server.",
+                        resp.status_code)
+                result = resp.json()
+
+                # Pages are shown in order, at most one page ahead of the listing
+                if tasks:
+                    await tasks[-1]
+                if result["ids"]:
+                    tasks.append(asyncio.ensure_future(self._fetch_thumbnails(result["ids"])))
+
+                if result.get("next_cursor") is None:
+                    break
+                filter_details["cursor"] = result["next_cursor"]
+
+            if tasks:
+                await tasks[-1]
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _fetch_thumbnails(self, image_ids):
+        resp = await utils.get_image_thumbnails(image_ids, client=async_api)
         if resp.status_code != 200:
             raise ApiException(
-                "Failed to load project images from server.",
+                "Failed to load image thumbnails from server.",
                 resp.status_code)
 
-        result = resp.json()
-        for row in result["images"]:
-            img = utils.decode_image(row["image_data"])
+        for row in resp.json()["thumbnails"]:
+            if row.get("thumbnail_data") is None:
+                continue
+            img = utils.decode_image(row["thumbnail_data"])
             self.add_thumbnail(img)
 
+    @mainthread
     def add_thumbnail(self, image):
         img = utils.bytes2texture(image, "jpg")
         thumbnail = Thumbnail()
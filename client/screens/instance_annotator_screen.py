@@ -38,6 +38,9 @@ class InstanceAnnotatorScreen(Screen):
         self.app = App.get_running_app()
         self.model = InstanceAnnotatorModel()
         self.controller = InstanceAnnotatorController(self.model)
+        Clock.schedule_interval(
+            lambda dt: self.renew_leases(),
+            ClientConfig.LOCK_HEARTBEAT_INTERVAL)
 
     def get_current_image_canvas(self):
         if not isinstance(self.tab_panel.current_tab, ImageCanvasTab):
@@ -128,16 +131,10 @@ class InstanceAnnotatorScreen(Screen):
 
     @background
     def load_next(self):
-        image_ids = self.model.images.keys()
-        current_id = self.model.tool.get_current_image_id()
-        idx = 0
-        if current_id > 0:
-            idx = image_ids.index(current_id)
-            idx += 1
-
-        while self.model.images.get(image_ids[idx]).is_locked:
-            idx += 1
-        next_id = image_ids[idx]
+        next_id = self.controller.claim_next_image(self.app.current_project_id)
+        if next_id is None:
+            print("No unlocked, unlabeled images remain")
+            return
         self.controller.open_image(next_id)
         self.queue_update()
 
@@ -179,6 +176,18 @@ class InstanceAnnotatorScreen(Screen):
             self.app.current_project_id, filter_details)
         self.queue_update()
 
+    @background
+    def fetch_more_image_metas(self):
+        if self.controller.fetch_next_image_metas():
+            self.queue_update()
+
+    @background
+    def renew_leases(self):
+        lost = self.controller.renew_leases()
+        if lost:
+            print("Lost the locks on images %s" % lost)
+            self.queue_update()
+
     @background
     def fetch_class_labels(self):
         self.controller.fetch_class_labels(self.app.current_project_id)
@@ -1014,6 +1023,11 @@ class ImageQueue(GridLayout):
         self.queue.clear_widgets()
         self.queue_item_dict.clear()
 
+    def on_queue_scroll(self, scroll_view):
+        # Load the next page of images once the end of the queue is reached
+        if scroll_view.scroll_y <= 0:
+            self.app.root.current_screen.fetch_more_image_metas()
+
     def add_item(self, name, image_id, locked=False, opened=False):
         item = ImageQueueItem()
         item.image_name = name
@@ -2,10 +2,12 @@ import tkinter as tk
 from tkinter import filedialog
 
 from kivy.app import App
+from kivy.clock import mainthread
 from kivy.uix.screenmanager import Screen
 
 import client.utils as utils
 from client.screens.common import *
+from client.upload_pipeline import UploadPipeline
 from client.utils import ApiException
 from client.utils import background
 from definitions import ROOT_DIR
@@ -17,6 +19,20 @@ Builder.load_file(
         'project_tool_screen.kv'))
 
 
+class UploadProgressPopup(Popup):
+    progress_bar = ObjectProperty(None)
+    progress_label = ObjectProperty(None)
+
+    @mainthread
+    def update(self, progress):
+        total = max(progress["bytes_total"], 1)
+        self.progress_bar.value = 100 * progress["bytes_done"] / total
+        self.progress_label.text = "%d of %d images uploaded, %d failed" % (
+            progress["files_done"] - progress["failed"],
+            progress["files_total"],
+            progress["failed"])
+
+
 class ProjectToolScreen(Screen):
     def __init__(self, **kw):
         super().__init__(**kw)
@@ -25,26 +41,28 @@ class ProjectToolScreen(Screen):
     def upload_images(self, *args):
         root = tk.Tk()
         root.withdraw()
-        filepath = filedialog.askdirectory(initialdir=ROOT_DIR)
-        image_paths = []
-        for (root, _, filename) in os.walk(filepath):
-            for f in filename:
-                # tkinter does not return windows style filepath
-                image_paths.append(root + '/' + f)
+        folder = filedialog.askdirectory(initialdir=ROOT_DIR)
+        root.destroy()
+        if not folder:
+            return
+
+        popup = UploadProgressPopup()
+        popup.open()
+        self._upload_images(self.app.current_project_id, folder, popup)
 
     @background
-    def _upload_images(self, pid, image_paths):
-        resp = utils.add_project_images(pid, image_paths)
-        if resp.status_code == 200:
-            result = resp.json()
+    def _upload_images(self, pid, folder, popup):
+        pipeline = UploadPipeline(pid, on_progress=popup.update)
+        try:
+            summary = pipeline.run(pipeline.find_images(folder), root=folder)
+        finally:
+            mainthread(popup.dismiss)()
+
+        if summary["failed"]:
             msg = []
-            for row in result["results"]:
-                msg.append(row["error"]["message"])
+            for path, error in summary["failed"]:
+                msg.append("%s: %s" % (os.path.basename(path), error))
             msg = '\n'.join(msg)
             raise ApiException(
                 message="The following errors occurred while trying to upload images:\n %s" %
-                (msg,), code=resp.status_code)
-        elif resp.status_code != 201:
-            raise ApiException(
-                "Failed to upload images to project.",
-                resp.status_code)
+                (msg,), code=200)
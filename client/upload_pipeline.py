@@ -0,0 +1,390 @@
+"""
+A resumable pipeline for uploading a folder of images to a project
+"""
+import hashlib
+import json
+import os
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from threading import Lock
+
+import requests
+
+import client.utils as utils
+from client.client_config import ClientConfig
+from client.utils import ApiException
+
+# Leading bytes of the image formats accepted by the server
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"BM")
+
+_UNSAFE_NAME_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def is_image(path):
+    """
+    Check a file is an image by both its extension and its leading bytes.
+    """
+    if os.path.splitext(path)[1].lower() not in ClientConfig.UPLOAD_EXTENSIONS:
+        return False
+    try:
+        with open(path, "rb") as f:
+            header = f.read(8)
+    except OSError:
+        return False
+    return any(header.startswith(sig) for sig in IMAGE_SIGNATURES)
+
+
+def upload_name(path, root):
+    """
+    Name a file after its path relative to the upload root, sanitised the way the
+    server sanitises upload names (werkzeug's secure_filename), so files with the
+    same name in different subfolders stay distinct.
+    :return: The sanitised name, e.g. "day_1_img_001.jpg" for day 1/img_001.jpg
+    """
+    name = os.path.relpath(path, root)
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    for sep in (os.sep, os.path.altsep, "/"):
+        if sep:
+            name = name.replace(sep, " ")
+    return _UNSAFE_NAME_CHARS.sub("", "_".join(name.split())).strip("._")
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadManifest:
+    """
+    A thread-safe record of the files uploaded to a project, keyed by content hash,
+    along with the server upload session currently in use and the content hash of
+    each file sent to it.
+    """
+
+    def __init__(self, project_id):
+        self._lock = Lock()
+        self.path = os.path.join(
+            ClientConfig.UPLOAD_MANIFEST_DIR,
+            "project_%d.json" % project_id)
+        try:
+            with open(self.path) as f:
+                self._data = json.load(f)
+        except (OSError, ValueError):
+            self._data = {}
+        self._data.setdefault("session_id", None)
+        self._data.setdefault("session_files", {})
+        self._data.setdefault("uploaded", {})
+
+    def get_session_id(self):
+        with self._lock:
+            return self._data["session_id"]
+
+    def set_session_id(self, session_id):
+        with self._lock:
+            if session_id != self._data["session_id"]:
+                self._data["session_files"] = {}
+            self._data["session_id"] = session_id
+            self._save()
+
+    def get_session_file(self, name):
+        """
+        :return: The content hash last sent to the current session under a name
+        """
+        with self._lock:
+            return self._data["session_files"].get(name)
+
+    def set_session_files(self, hashes):
+        with self._lock:
+            self._data["session_files"].update(hashes)
+            self._save()
+
+    def contains(self, content_hash):
+        with self._lock:
+            return content_hash in self._data["uploaded"]
+
+    def add(self, content_hash, name, image_id):
+        with self._lock:
+            self._data["uploaded"][content_hash] = {"name": name, "id": image_id}
+            self._save()
+
+    def _save(self):
+        Path(os.path.dirname(self.path)).mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._data, f)
+        os.replace(tmp_path, self.path)
+
+
+class UploadPipeline:
+    """
+    Uploads images to a project over a bounded pool of workers.
+
+    Small files are grouped into multipart requests of at most UPLOAD_BATCH_BYTES,
+    large files are streamed in resumable chunks. Completed files are recorded in
+    an UploadManifest so that restarting an interrupted upload skips them.
+    """
+
+    def __init__(self, project_id, on_progress=None):
+        self.project_id = project_id
+        self.on_progress = on_progress
+        self.manifest = UploadManifest(project_id)
+        self.session_id = None
+        self.session_files = {}
+
+        self._lock = Lock()
+        self._progress = {}
+        self._failed = []
+        self._partial = False
+
+    def find_images(self, folder):
+        image_paths = []
+        for (root, _, filenames) in os.walk(folder):
+            for f in sorted(filenames):
+                path = os.path.join(root, f)
+                if is_image(path):
+                    image_paths.append(path)
+        return image_paths
+
+    def run(self, image_paths, root=None):
+        """
+        Upload a list of images, skipping any already recorded in the manifest.
+        :param image_paths: A list of paths to image files
+        :param root: The folder the images were found in, their upload names are
+                     their paths relative to it. Defaults to their common folder.
+        :return: A dict summarising the number of uploaded, skipped and failed files
+        """
+        if root is None and image_paths:
+            root = os.path.commonpath([os.path.dirname(os.path.abspath(x)) for x in image_paths])
+
+        with ThreadPoolExecutor(max_workers=ClientConfig.UPLOAD_WORKERS) as pool:
+            hashes = list(pool.map(self._hash_file, image_paths))
+
+            pending = []
+            skipped = 0
+            names = set()
+            for path, (content_hash, size) in zip(image_paths, hashes):
+                if content_hash is None:
+                    continue
+                if self.manifest.contains(content_hash):
+                    skipped += 1
+                    continue
+                name = upload_name(os.path.abspath(path), root)
+                stem, ext = os.path.splitext(name)
+                if not stem or name in names:
+                    # Sanitising can empty a name or map two paths to one
+                    name = "%s_%s%s" % (stem or "image", content_hash[:8], ext)
+                names.add(name)
+                pending.append((path, name, content_hash, size))
+
+            self._progress = {
+                "files_total": len(pending) + len(self._failed),
+                "files_done": len(self._failed),
+                "bytes_total": sum(x[3] for x in pending),
+                "bytes_done": 0,
+                "failed": len(self._failed)
+            }
+            self._report()
+            if not pending:
+                return {"uploaded": 0, "skipped": skipped, "failed": list(self._failed)}
+
+            self._open_session()
+            pending = [self._session_item(item) for item in pending]
+            self.manifest.set_session_files({x[1]: x[2] for x in pending})
+            jobs = []
+            for batch in self._make_batches(pending):
+                if len(batch) == 1 and batch[0][3] > ClientConfig.UPLOAD_CHUNK_BYTES:
+                    jobs.append(pool.submit(self._upload_chunked, batch[0]))
+                else:
+                    jobs.append(pool.submit(self._upload_batch, batch))
+            for job in as_completed(jobs):
+                job.result()
+
+        if not self._partial:
+            # Nothing is left to resume, the next run starts a fresh session
+            self.manifest.set_session_id(None)
+            try:
+                utils.delete_upload_session(self.project_id, self.session_id)
+            except requests.RequestException:
+                pass  # The server expires abandoned sessions
+
+        uploaded = self._progress["files_done"] - self._progress["failed"]
+        return {"uploaded": uploaded, "skipped": skipped, "failed": list(self._failed)}
+
+    def _hash_file(self, path):
+        """
+        :return: A tuple of (content hash, size), or (None, None) if the file could not
+                 be read, in which case it is recorded as failed
+        """
+        try:
+            return hash_file(path), os.path.getsize(path)
+        except OSError as e:
+            with self._lock:
+                self._failed.append((path, str(e)))
+            return None, None
+
+    def _open_session(self):
+        # Reuse the session of an interrupted upload so partial files can be resumed
+        session_id = self.manifest.get_session_id()
+        if session_id is not None:
+            resp = utils.get_upload_session(self.project_id, session_id)
+            if resp.status_code == 200:
+                self.session_id = session_id
+                self.session_files = {
+                    row["name"]: row for row in resp.json()["files"]}
+                return
+
+        resp = utils.create_upload_session(self.project_id)
+        if resp.status_code != 201:
+            raise ApiException(
+                "Failed to start an upload session.", resp.status_code)
+        self.session_id = resp.json()["session_id"]
+        self.session_files = {}
+        self.manifest.set_session_id(self.session_id)
+
+    def _session_item(self, item):
+        """
+        Rename a file whose name the current session already holds for different
+        content, e.g. a file edited since an interrupted run, so the two do not mix.
+        """
+        path, name, content_hash, size = item
+        if name in self.session_files and self.manifest.get_session_file(name) != content_hash:
+            stem, ext = os.path.splitext(name)
+            name = "%s_%s%s" % (stem, content_hash[:8], ext)
+        return path, name, content_hash, size
+
+    def _make_batches(self, pending):
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for item in pending:
+            size = item[3]
+            if size > ClientConfig.UPLOAD_CHUNK_BYTES:
+                batches.append([item])
+                continue
+            if batch and (batch_bytes + size > ClientConfig.UPLOAD_BATCH_BYTES or
+                          len(batch) >= ClientConfig.UPLOAD_BATCH_FILES):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _upload_batch(self, batch):
+        to_send = []
+        for item in batch:
+            if not self._resolve_previous(item):
+                to_send.append(item)
+        if not to_send:
+            return
+
+        try:
+            resp = self._with_retries(
+                utils.upload_session_files,
+                self.project_id, self.session_id,
+                [x[0] for x in to_send], [x[1] for x in to_send])
+        except requests.RequestException as e:
+            for item in to_send:
+                self._finish(item, error=str(e))
+            return
+
+        if resp.status_code not in (200, 201):
+            for item in to_send:
+                self._finish(item, error="Server responded with %d." % resp.status_code)
+            return
+
+        for item, row in zip(to_send, resp.json()["results"]):
+            if row["action"] == "created":
+                self._finish(item, image_id=row["id"])
+            else:
+                self._finish(item, error=row["error"]["message"])
+
+    def _upload_chunked(self, item):
+        if self._resolve_previous(item):
+            return
+
+        path, name, _, size = item
+        offset = 0
+        previous = self.session_files.get(name)
+        if previous is not None and previous["state"] == "uploading":
+            offset = previous["received"]
+        state = None
+        try:
+            with open(path, "rb") as f:
+                while offset < size:
+                    f.seek(offset)
+                    chunk = f.read(ClientConfig.UPLOAD_CHUNK_BYTES)
+                    resp = self._with_retries(
+                        utils.upload_session_chunk,
+                        self.project_id, self.session_id, name, chunk, offset, size)
+                    if resp.status_code == 409:
+                        # The server has a different offset, continue from there
+                        resp = utils.get_upload_session_file(
+                            self.project_id, self.session_id, name)
+                        state = resp.json()
+                        if state["state"] != "uploading":
+                            break
+                        offset = state["received"]
+                        continue
+                    state = resp.json()
+                    if resp.status_code not in (200, 201):
+                        break
+                    offset = state["received"]
+        except (OSError, requests.RequestException) as e:
+            self._partial = True
+            self._finish(item, error=str(e))
+            return
+
+        if state is not None and state.get("state") == "created":
+            self._finish(item, image_id=state["id"])
+        elif state is not None and state.get("error"):
+            self._finish(item, error=state["error"]["message"])
+        else:
+            self._partial = True
+            self._finish(item, error="Upload of '%s' did not complete." % name)
+
+    def _resolve_previous(self, item):
+        """
+        Finish a file which an interrupted run already uploaded to the current session.
+        Files which failed are sent again.
+        :return: True if the file needs no further work
+        """
+        state = self.session_files.get(item[1])
+        if state is None or state["state"] != "created":
+            return False
+        self._finish(item, image_id=state["id"])
+        return True
+
+    def _with_retries(self, f, *args):
+        for attempt in range(ClientConfig.UPLOAD_RETRIES):
+            try:
+                return f(*args)
+            except requests.ConnectionError:
+                if attempt == ClientConfig.UPLOAD_RETRIES - 1:
+                    raise
+
+    def _finish(self, item, image_id=None, error=None):
+        path, name, content_hash, size = item
+        if error is None:
+            self.manifest.add(content_hash, name, image_id)
+        with self._lock:
+            self._progress["files_done"] += 1
+            self._progress["bytes_done"] += size
+            if error is not None:
+                self._progress["failed"] += 1
+                self._failed.append((path, error))
+        self._report()
+
+    def _report(self):
+        if self.on_progress is None:
+            return
+        with self._lock:
+            progress = dict(self._progress)
+        self.on_progress(progress)
@@ -5,16 +5,24 @@ import base64
 import io
 import json
 import os
+import uuid
 
 import cv2
 import numpy as np
-import requests
 from PIL import Image
 from kivy.app import App
 from kivy.graphics.texture import Texture
 from kivy.uix.image import CoreImage
 
+from client.api_client import ApiClientInstance
 from client.client_config import ClientConfig
+from common import mask_codec
+
+
+api = ApiClientInstance()
+
+# Identifies the locks held by this client, sent with every request which takes or renews one
+LOCK_OWNER = uuid.uuid4().hex
 
 
 class ApiException(Exception):
@@ -35,19 +43,25 @@ def background(f):
     return aux
 
 
-def get_project_by_id(id):
-    url = ClientConfig.SERVER_URL + "projects/" + str(id)
+# ===================
+# === API methods ===
+# ===================
+# Each takes the client to send its request with. The default ApiClient blocks and
+# returns the response, an AsyncApiClient returns a coroutine of the response instead.
+
+def get_project_by_id(id, client=api):
+    path = "projects/" + str(id)
     headers = {"Accept": "application/json"}
-    return requests.get(url, headers=headers)
+    return client.get("projects/<pid>", path, headers=headers)
 
 
-def get_projects():
-    url = ClientConfig.SERVER_URL + "projects"
+def get_projects(client=api):
+    path = "projects"
     headers = {"Accept": "application/json"}
-    return requests.get(url, headers=headers)
+    return client.get("projects", path, headers=headers)
 
 
-def add_projects(names):
+def add_projects(names, client=api):
     if not isinstance(names, list):
         names = [names]
 
@@ -56,17 +70,17 @@ def add_projects(names):
         body.append({'name': n})
 
     payload = json.dumps({"projects": body})
-    url = ClientConfig.SERVER_URL + "projects"
+    path = "projects"
     headers = {"Content-Type": "application/json"}
-    return requests.post(url, headers=headers, data=payload)
+    return client.post("projects", path, headers=headers, data=payload)
 
 
-def delete_project(id):
-    url = ClientConfig.SERVER_URL + "projects/" + str(id)
-    return requests.delete(url)
+def delete_project(id, client=api):
+    path = "projects/" + str(id)
+    return client.delete("projects/<pid>", path)
 
 
-def add_project_images(project_id, image_paths):
+def add_project_images(project_id, image_paths, client=api):
     if not isinstance(image_paths, list):
         image_paths = [image_paths]
 
@@ -81,26 +95,98 @@ def add_project_images(project_id, image_paths):
                      'image_data': encode_image(path)})
 
     payload = json.dumps({'images': body})
-    url = ClientConfig.SERVER_URL + "projects/" + str(project_id) + "/images"
+    path = "projects/" + str(project_id) + "/images"
     headers = {"Accept": "application/json",
                "Content-Type": "application/json"}
-    return requests.post(url, headers=headers, data=payload)
+    return client.post("projects/<pid>/images", path, headers=headers, data=payload)
+
+
+def create_upload_session(project_id, client=api):
+    path = "projects/" + str(project_id) + "/uploads"
+    headers = {"Accept": "application/json"}
+    return client.post("projects/<pid>/uploads", path, headers=headers)
+
+
+def get_upload_session(project_id, session_id, client=api):
+    path = "projects/" + \
+        str(project_id) + "/uploads/" + session_id
+    headers = {"Accept": "application/json"}
+    return client.get("projects/<pid>/uploads/<sid>", path, headers=headers)
+
+
+def delete_upload_session(project_id, session_id, client=api):
+    path = "projects/" + \
+        str(project_id) + "/uploads/" + session_id
+    headers = {"Accept": "application/json"}
+    return client.delete("projects/<pid>/uploads/<sid>", path, headers=headers)
+
+
+def upload_session_files(project_id, session_id, image_paths, names=None, client=api):
+    """
+    Upload whole files to an upload session as a single multipart request.
+    :param names: The upload name of each file, defaults to their file names
+    """
+    if names is None:
+        names = [os.path.basename(image_path) for image_path in image_paths]
+
+    path = "projects/" + \
+        str(project_id) + "/uploads/" + session_id + "/files"
+    headers = {"Accept": "application/json"}
+    handles = [open(image_path, "rb") for image_path in image_paths]
+    try:
+        files = [("images", (name, f, "application/octet-stream"))
+                 for name, f in zip(names, handles)]
+        return client.post("projects/<pid>/uploads/<sid>/files", path, headers=headers, files=files,
+                           timeout=(ClientConfig.HTTP_CONNECT_TIMEOUT, ClientConfig.HTTP_UPLOAD_READ_TIMEOUT))
+    finally:
+        for f in handles:
+            f.close()
+
+
+def upload_session_chunk(project_id, session_id, name, chunk, start, total, client=api):
+    path = "projects/" + \
+        str(project_id) + "/uploads/" + session_id + "/files/" + name
+    headers = {"Accept": "application/json",
+               "Content-Type": "application/octet-stream",
+               "Content-Range": "bytes %d-%d/%d" % (start, start + len(chunk) - 1, total)}
+    return client.put("projects/<pid>/uploads/<sid>/files/<name>", path, headers=headers, data=chunk,
+                      timeout=(ClientConfig.HTTP_CONNECT_TIMEOUT, ClientConfig.HTTP_UPLOAD_READ_TIMEOUT))
+
+
+def get_upload_session_file(project_id, session_id, name, client=api):
+    path = "projects/" + \
+        str(project_id) + "/uploads/" + session_id + "/files/" + name
+    headers = {"Accept": "application/json"}
+    return client.get("projects/<pid>/uploads/<sid>/files/<name>", path, headers=headers)
 
 
-def get_project_images(project_id, filter_details=None):
+def get_project_images(project_id, filter_details=None, client=api):
     if not filter_details:
         filter_details = {}
 
     payload = json.dumps(filter_details)
-    url = ClientConfig.SERVER_URL + "projects/" + \
+    path = "projects/" + \
         str(project_id) + "/images"
     headers = {"Accept": "application/json",
                "Content-Type": "application/json"}
 
-    return requests.get(url, headers=headers, data=payload)
+    return client.get("projects/<pid>/images", path, headers=headers, data=payload)
 
 
-def update_image_meta_by_id(image_id, name=None, lock=None, labeled=None):
+def claim_project_images(project_id, count=1, client=api):
+    """
+    Lock and fetch the next unlocked, unlabeled images of a project.
+    """
+    path = "projects/" + \
+        str(project_id) + "/claim"
+    headers = {"Accept": "application/json",
+               "Content-Type": "application/json",
+               ClientConfig.LOCK_OWNER_HEADER: LOCK_OWNER}
+    payload = json.dumps({"count": count})
+    return client.post("projects/<pid>/claim", path, headers=headers, data=payload)
+
+
+def update_image_meta_by_id(image_id, name=None, lock=None, labeled=None, client=api):
     image_meta = {}
     if name is not None:
         image_meta["name"] = str(name)
@@ -111,50 +197,134 @@ def update_image_meta_by_id(image_id, name=None, lock=None, labeled=None):
 
     payload = json.dumps(image_meta)
 
-    url = ClientConfig.SERVER_URL + "images/" + str(image_id)
+    path = "images/" + str(image_id)
     headers = {"Accept": "application/json",
-               "Content-Type": "application/json"}
+               "Content-Type": "application/json",
+               ClientConfig.LOCK_OWNER_HEADER: LOCK_OWNER}
+
+    return client.put("images/<iid>", path, headers=headers, data=payload)
+
 
-    return requests.put(url, headers=headers, data=payload)
+def update_image_metas_by_ids(image_ids, name=None, lock=None, labeled=None, client=api):
+    """
+    Apply the same meta update to many images in a single request.
+    """
+    patch = {}
+    if name is not None:
+        patch["name"] = str(name)
+    if lock is not None:
+        patch["is_locked"] = bool(lock)
+    if labeled is not None:
+        patch["is_labeled"] = bool(labeled)
 
+    payload = json.dumps({"ids": list(image_ids), "patch": patch})
 
-def get_image_by_id(image_id):
-    url = ClientConfig.SERVER_URL + "images/" + str(image_id)
+    path = "images"
+    headers = {"Accept": "application/json",
+               "Content-Type": "application/json",
+               ClientConfig.LOCK_OWNER_HEADER: LOCK_OWNER}
+
+    return client.put("images", path, headers=headers, data=payload)
+
+
+def renew_image_leases(image_ids, client=api):
+    """
+    Extend the locks this client holds on the given images.
+    """
+    path = "images/leases"
+    headers = {"Accept": "application/json",
+               "Content-Type": "application/json",
+               ClientConfig.LOCK_OWNER_HEADER: LOCK_OWNER}
+    payload = json.dumps({"ids": image_ids})
+
+    return client.put("images/leases", path, headers=headers, data=payload)
+
+
+def get_image_by_id(image_id, etag=None, client=api):
+    path = "images/" + str(image_id) + "/raw"
+    headers = {}
+    if etag is not None:
+        headers["If-None-Match"] = '"%s"' % etag
+
+    return client.get("images/<iid>/raw", path, headers=headers)
+
+
+def open_image_by_id(image_id, client=api):
+    """
+    Lock an image and fetch its meta, bytes and annotations in a single request.
+    The response body is an image container, see common/image_container.py.
+    """
+    path = "images/" + str(image_id) + "/open"
+    headers = {ClientConfig.LOCK_OWNER_HEADER: LOCK_OWNER,
+               mask_codec.MASK_ENCODING_HEADER: mask_codec.header_value(
+                   ClientConfig.MASK_ENCODINGS)}
+    return client.post("images/<iid>/open", path, headers=headers)
+
+
+def get_image_meta_by_id(image_id, client=api):
+    path = "images/" + str(image_id) + "?image-data=False"
     headers = {"Accept": "application/json"}
 
-    return requests.get(url, headers=headers)
+    return client.get("images/<iid>", path, headers=headers)
 
 
-def get_images_by_ids(image_ids):
-    url = ClientConfig.SERVER_URL + "images"
+def get_images_by_ids(image_ids, client=api):
+    path = "images"
     headers = {"Accept": "application/json",
                "Content-Type": "application/json"}
     body = {"ids": image_ids}
 
     payload = json.dumps(body)
 
-    return requests.get(url, headers=headers, data=payload)
+    return client.get("images", path, headers=headers, data=payload)
 
 
-def get_image_metas_by_ids(image_ids):
-    url = ClientConfig.SERVER_URL + "images?image-data=False"
+def get_image_metas_by_ids(image_ids, client=api):
+    path = "images?image-data=False"
     headers = {"Accept": "application/json",
                "Content-Type": "application/json"}
     body = {"ids": image_ids}
     payload = json.dumps(body)
 
-    return requests.get(url, headers=headers, data=payload)
+    return client.get("images", path, headers=headers, data=payload)
+
 
+def get_image_tile_manifest(image_id, client=api):
+    path = "images/" + str(image_id) + "/tiles"
+    headers = {"Accept": "application/json"}
 
-def add_image_annotation(image_id, annotations):
-    url = ClientConfig.SERVER_URL + "images/" + str(image_id) + "/annotation"
+    return client.get("images/<iid>/tiles", path, headers=headers)
+
+
+def get_image_tile(image_id, level, x, y, client=api):
+    path = "images/%d/tiles/%d/%d/%d" % (
+        image_id, level, x, y)
+
+    return client.get("images/<iid>/tiles/<level>/<x>/<y>", path)
+
+
+def get_image_thumbnails(image_ids, client=api):
+    path = "images/thumbnails"
+    headers = {"Accept": "application/json",
+               "Content-Type": "application/json"}
+    body = {"ids": image_ids}
+    payload = json.dumps(body)
+
+    return client.get("images/thumbnails", path, headers=headers, data=payload)
+
+
+def add_image_annotation(image_id, annotations, client=api):
+    path = "images/" + str(image_id) + "/annotation"
     headers = {"Accept": "application/json",
                "Content-Type": "application/json"}
     payload = {"image_id": image_id, "annotations": []}
     for annotation in annotations.values():
+        mask_encoding, mask_data = mask_codec.encode_smallest(
+            mat2mask(annotation.mat), ClientConfig.MASK_ENCODINGS)
         body = {
             'name': annotation.annotation_name,
-            'mask_data': encode_mask(mat2mask(annotation.mat)),
+            'mask_data': mask_data,
+            'mask_encoding': mask_encoding,
             'bbox': np.array(annotation.bbox).tolist(),
             'class_name': annotation.class_name,
             'shape': annotation.mat.shape}
@@ -162,18 +332,20 @@ def add_image_annotation(image_id, annotations):
 
     payload = json.dumps(payload)
 
-    return requests.post(url, headers=headers, data=payload)
+    return client.post("images/<iid>/annotation", path, headers=headers, data=payload)
 
 
-def delete_image_annotation(image_id, on_success=None, on_fail=None):
-    url = ClientConfig.SERVER_URL + "images/" + str(image_id) + "/annotation"
-    return requests.delete(url)
+def delete_image_annotation(image_id, on_success=None, on_fail=None, client=api):
+    path = "images/" + str(image_id) + "/annotation"
+    return client.delete("images/<iid>/annotation", path)
 
 
-def get_image_annotation(image_id, on_success=None, on_fail=None):
-    url = ClientConfig.SERVER_URL + "images/" + str(image_id) + "/annotation"
-    headers = {"Accept": "application/json"}
-    return requests.get(url, headers=headers)
+def get_image_annotation(image_id, on_success=None, on_fail=None, client=api):
+    path = "images/" + str(image_id) + "/annotation"
+    headers = {"Accept": "application/json",
+               mask_codec.MASK_ENCODING_HEADER: mask_codec.header_value(
+                   ClientConfig.MASK_ENCODINGS)}
+    return client.get("images/<iid>/annotation", path, headers=headers)
 
 
 # ======================
@@ -191,17 +363,14 @@ def decode_image(b64_str):
     return base64.b64decode(img_bytes_b64)
 
 
-# Takes Boolean mask -> bytes
-def encode_mask(mask):
-    encoded_mask = base64.b64encode(mask.tobytes(order='C'))
-    return encoded_mask.decode('utf-8')
+# Takes Boolean mask -> str
+def encode_mask(mask, encoding=mask_codec.DEFAULT_ENCODING):
+    return mask_codec.encode_mask(mask, encoding)
 
 
-# Takes bytes -> Boolean Mask
-def decode_mask(b64_str, shape):
-    mask_bytes = base64.b64decode(b64_str.encode("utf-8"))
-    flat = np.fromstring(mask_bytes, bool)
-    return np.reshape(flat, newshape=shape[:2], order='C')
+# Takes str -> Boolean Mask
+def decode_mask(encoded, shape, encoding=mask_codec.DEFAULT_ENCODING):
+    return mask_codec.decode_mask(encoded, shape, encoding)
 
 
 def mask2mat(mask):
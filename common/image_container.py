@@ -0,0 +1,38 @@
+"""
+A compact container carrying an image together with its JSON metadata, shared by
+the client and server.
+
+The layout is a 4 byte big endian length, that many bytes of UTF-8 JSON, and then
+the stored image bytes unchanged, so the pixels need no base64 round trip.
+"""
+import json
+import struct
+
+IMAGE_CONTAINER_MIMETYPE = "application/x-fastannotation-image"
+
+_LENGTH = struct.Struct(">I")
+
+
+def pack(meta, image_bytes):
+    """
+    :param meta: A JSON serializable dict
+    :param image_bytes: The encoded image file
+    :return: The container bytes
+    """
+    header = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+    return _LENGTH.pack(len(header)) + header + image_bytes
+
+
+def unpack(data):
+    """
+    :param data: Bytes produced by pack
+    :return: A tuple of (meta, image_bytes)
+    :raises ValueError: If the container is truncated
+    """
+    if len(data) < _LENGTH.size:
+        raise ValueError("Truncated image container.")
+    length, = _LENGTH.unpack_from(data)
+    end = _LENGTH.size + length
+    if len(data) < end:
+        raise ValueError("Truncated image container.")
+    return json.loads(data[_LENGTH.size:end].decode("utf-8")), data[end:]
@@ -0,0 +1,210 @@
+"""
+Wire encodings for boolean annotation masks, shared by the client and server.
+
+Every codec turns a 2D boolean mask into a JSON safe string and back again. The
+encoding used for a payload travels with it, either as the ``mask_encoding``
+field of an annotation or, for reads, as a list of acceptable encodings in the
+``X-Mask-Encoding`` request header.
+"""
+import base64
+import zlib
+
+import numpy as np
+
+MASK_ENCODING_HEADER = "X-Mask-Encoding"
+
+RAW = "raw"
+RLE = "rle"
+PACKBITS = "packbits"
+PACKBITS_ZLIB = "packbits_zlib"
+
+DEFAULT_ENCODING = RAW
+
+
+class MaskCodec:
+    """
+    Base class for a mask encoding. Subclasses convert between a boolean mask and a string.
+    """
+    name = None
+
+    def encode(self, mask):
+        raise NotImplementedError
+
+    def decode(self, data, shape):
+        raise NotImplementedError
+
+
+class RawCodec(MaskCodec):
+    """
+    One byte per pixel, base64 encoded. Kept for compatibility with older clients.
+    """
+    name = RAW
+
+    def encode(self, mask):
+        encoded_mask = base64.b64encode(mask.astype(bool).tobytes(order='C'))
+        return encoded_mask.decode('utf-8')
+
+    def decode(self, data, shape):
+        mask_bytes = base64.b64decode(data.encode('utf-8'))
+        flat = np.frombuffer(mask_bytes, dtype=bool)
+        return np.reshape(flat, tuple(shape[:2]), order='C')
+
+
+class PackbitsCodec(MaskCodec):
+    """
+    One bit per pixel (np.packbits), base64 encoded.
+    """
+    name = PACKBITS
+
+    def _pack(self, mask):
+        return np.packbits(mask.astype(bool).ravel(order='C')).tobytes()
+
+    def _unpack(self, packed, shape):
+        count = int(shape[0]) * int(shape[1])
+        flat = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=count)
+        return np.reshape(flat.astype(bool), tuple(shape[:2]), order='C')
+
+    def encode(self, mask):
+        return base64.b64encode(self._pack(mask)).decode('utf-8')
+
+    def decode(self, data, shape):
+        return self._unpack(base64.b64decode(data.encode('utf-8')), shape)
+
+
+class PackbitsZlibCodec(PackbitsCodec):
+    """
+    Bit packed mask compressed with zlib, base64 encoded.
+    """
+    name = PACKBITS_ZLIB
+
+    def encode(self, mask):
+        compressed = zlib.compress(self._pack(mask))
+        return base64.b64encode(compressed).decode('utf-8')
+
+    def decode(self, data, shape):
+        packed = zlib.decompress(base64.b64decode(data.encode('utf-8')))
+        return self._unpack(packed, shape)
+
+
+class RleCodec(MaskCodec):
+    """
+    COCO style run length encoding. Runs are counted in column-major order starting
+    with a run of zeros, and serialised with the compressed string format used by
+    pycocotools so the output is plain ASCII.
+    """
+    name = RLE
+
+    def encode(self, mask):
+        flat = mask.astype(bool).ravel(order='F')
+        if flat.size == 0:
+            return ""
+
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        bounds = np.concatenate(([0], changes, [flat.size]))
+        counts = np.diff(bounds).tolist()
+        if flat[0]:
+            counts.insert(0, 0)
+        return self._counts_to_string(counts)
+
+    def decode(self, data, shape):
+        counts = self._string_to_counts(data)
+        values = np.arange(len(counts)) % 2
+        flat = np.repeat(values, counts).astype(bool)
+        return np.reshape(flat, tuple(shape[:2]), order='F')
+
+    @staticmethod
+    def _counts_to_string(counts):
+        chars = []
+        for i, x in enumerate(counts):
+            if i > 2:
+                x -= counts[i - 2]
+            more = True
+            while more:
+                c = x & 0x1f
+                x >>= 5
+                more = x != -1 if c & 0x10 else x != 0
+                if more:
+                    c |= 0x20
+                chars.append(chr(c + 48))
+        return "".join(chars)
+
+    @staticmethod
+    def _string_to_counts(data):
+        counts = []
+        p = 0
+        while p < len(data):
+            x = 0
+            k = 0
+            more = True
+            while more:
+                c = ord(data[p]) - 48
+                x |= (c & 0x1f) << (5 * k)
+                more = c & 0x20
+                p += 1
+                k += 1
+                if not more and c & 0x10:
+                    x |= -1 << (5 * k)
+            if len(counts) > 2:
+                x += counts[-2]
+            counts.append(x)
+        return counts
+
+
+CODECS = {codec.name: codec for codec in (
+    RawCodec(), RleCodec(), PackbitsCodec(), PackbitsZlibCodec())}
+
+
+def get_codec(encoding):
+    if encoding is None:
+        encoding = DEFAULT_ENCODING
+    try:
+        return CODECS[encoding]
+    except KeyError:
+        raise ValueError("Unsupported mask encoding '%s'." % encoding)
+
+
+def encode_mask(mask, encoding=DEFAULT_ENCODING):
+    return get_codec(encoding).encode(mask)
+
+
+def decode_mask(data, shape, encoding=DEFAULT_ENCODING):
+    return get_codec(encoding).decode(data, shape)
+
+
+def encode_smallest(mask, encodings):
+    """
+    Encode a mask with every candidate encoding and keep the shortest result.
+    :param mask: A 2D boolean mask
+    :param encodings: An iterable of encoding names to consider
+    :return: A tuple of (encoding, encoded data)
+    """
+    best = None
+    for encoding in encodings:
+        data = encode_mask(mask, encoding)
+        if best is None or len(data) < len(best[1]):
+            best = (encoding, data)
+    if best is None:
+        best = (DEFAULT_ENCODING, encode_mask(mask, DEFAULT_ENCODING))
+    return best
+
+
+def parse_encodings(header_value, supported=None):
+    """
+    Parse a comma separated list of encodings, as sent in the X-Mask-Encoding header.
+    :param header_value: The raw header value, may be None
+    :param supported: An optional iterable restricting (and ordering) the result
+    :return: A list of known encodings, falling back to the default encoding
+    """
+    if supported is None:
+        supported = CODECS.keys()
+    requested = []
+    if header_value:
+        requested = [x.strip().lower() for x in header_value.split(",")]
+    encodings = [x for x in supported if x in requested and x in CODECS]
+    if not encodings:
+        encodings = [DEFAULT_ENCODING]
+    return encodings
+
+
+def header_value(encodings):
+    return ", ".join(encodings)
@@ -0,0 +1,144 @@
+import time
+from collections import deque
+from threading import Condition
+
+import mysql.connector
+from mysql.connector.errors import Error
+from mysql.connector.errors import PoolError
+
+
+class ConnectionPool:
+    """
+    A fixed size pool of MySQL connections.
+
+    Connections are opened when the pool is created. A checkout blocks on a condition
+    until a connection is released or its deadline passes, and connections which sat
+    idle for longer than the health check interval are pinged, and reconnected if
+    needed, before being handed out. Wait and checkout durations are recorded so the
+    pool can be sized from its stats.
+    """
+
+    def __init__(self, size, health_check_interval, **db_config):
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.db_config = db_config
+
+        self._cond = Condition()
+        self._idle = deque()  # (connection, idle since)
+        self._checked_out = {}  # id(connection) -> checkout time
+        self._opened = 0
+
+        self.checkouts = 0
+        self.releases = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.checkout_time_total = 0.0
+        self.checkout_time_max = 0.0
+        self.peak_in_use = 0
+
+        for _ in range(size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._opened += 1
+
+    def get_connection(self, timeout):
+        """
+        Check out a connection, waiting up to timeout seconds for one to be released.
+        :raises PoolError: If no connection became available before the deadline
+        """
+        t0 = time.monotonic()
+        deadline = t0 + timeout
+        with self._cond:
+            waited = False
+            while not self._idle and self._opened >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolError(
+                        "No database connection became available within %.1f seconds." % timeout)
+                waited = True
+                self._cond.wait(remaining)
+
+            if self._idle:
+                connection, idle_since = self._idle.pop()
+            else:
+                # A connection which failed its health check is replaced here
+                connection, idle_since = None, None
+                self._opened += 1
+
+            wait_time = time.monotonic() - t0
+            self.checkouts += 1
+            self.waits += waited
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            self.peak_in_use = max(self.peak_in_use, self._opened - len(self._idle))
+
+        try:
+            if connection is None:
+                connection = self._connect()
+            elif time.monotonic() - idle_since > self.health_check_interval:
+                connection = self._check(connection)
+        except BaseException:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._checked_out[id(connection)] = time.monotonic()
+        return connection
+
+    def release(self, connection):
+        with self._cond:
+            checkout_time = time.monotonic() - self._checked_out.pop(id(connection))
+            self.releases += 1
+            self.checkout_time_total += checkout_time
+            self.checkout_time_max = max(self.checkout_time_max, checkout_time)
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, connection):
+        """
+        Return the slot of a checked out connection which is no longer usable.
+        """
+        try:
+            connection.close()
+        except Error:
+            pass
+        with self._cond:
+            self._checked_out.pop(id(connection), None)
+            self._opened -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            in_use = self._opened - len(self._idle)
+            return {
+                "size": self.size,
+                "in_use": in_use,
+                "idle": len(self._idle),
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "reconnects": self.reconnects,
+                "mean_wait_time": self.wait_time_total / self.checkouts if self.checkouts else 0.0,
+                "max_wait_time": self.wait_time_max,
+                "mean_checkout_time": self.checkout_time_total / self.releases if self.releases else 0.0,
+                "max_checkout_time": self.checkout_time_max,
+                "saturation": self.waits / self.checkouts if self.checkouts else 0.0
+            }
+
+    def _connect(self):
+        return mysql.connector.connect(**self.db_config)
+
+    def _check(self, connection):
+        try:
+            connection.ping(reconnect=False)
+        except Error:
+            with self._cond:
+                self.reconnects += 1
+            connection.reconnect(attempts=2, delay=0)
+        return connection
@@ -12,12 +12,20 @@ CREATE TABLE `image` (
   `image_path` varchar(260) NOT NULL,
   `image_name` varchar(260) NOT NULL,
   `image_ext` varchar(10) NOT NULL,
+  `image_width` int DEFAULT NULL,
+  `image_height` int DEFAULT NULL,
+  `image_format` varchar(10) DEFAULT NULL,
   `is_locked` bit(1) NOT NULL DEFAULT b'0',
   `is_labeled` bit(1) NOT NULL DEFAULT b'0',
+  `lock_owner` varchar(64) DEFAULT NULL,
+  `lock_expires` datetime DEFAULT NULL,
   PRIMARY KEY (`image_id`),
-  UNIQUE KEY `image_id_UNIQUE` (`image_id`),
   UNIQUE KEY `image_path_UNIQUE` (`image_path`),
   KEY `project_id_idx` (`project_fid`),
+  KEY `project_name_idx` (`project_fid`, `image_name`, `image_id`, `is_locked`, `is_labeled`),
+  KEY `project_status_name_idx` (`project_fid`, `is_labeled`, `is_locked`, `image_name`, `image_id`),
+  KEY `project_status_idx` (`project_fid`, `is_labeled`, `is_locked`),
+  KEY `lock_expires_idx` (`lock_expires`),
   CONSTRAINT `project_id` FOREIGN KEY (`project_fid`) REFERENCES `project` (`project_id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=428 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
@@ -33,11 +41,17 @@ CREATE TABLE `instance_seg_meta` (
   `mask_path` varchar(260) NOT NULL,
   `info_path` varchar(260) NOT NULL,
   `class_name` varchar(45) NOT NULL,
+  `bbox_xmin` int DEFAULT NULL,
+  `bbox_ymin` int DEFAULT NULL,
+  `bbox_xmax` int DEFAULT NULL,
+  `bbox_ymax` int DEFAULT NULL,
+  `source_width` int DEFAULT NULL,
+  `source_height` int DEFAULT NULL,
+  `source_depth` int DEFAULT NULL,
+  `pixel_area` int DEFAULT NULL,
   PRIMARY KEY (`annotation_id`),
-  UNIQUE KEY `mask_path_UNIQUE` (`mask_path`),
-  UNIQUE KEY `info_path_UNIQUE` (`info_path`),
-  UNIQUE KEY `annotation_id_UNIQUE` (`annotation_id`),
-  KEY `image_fid_idx` (`image_id`),
+  UNIQUE KEY `image_annotation_UNIQUE` (`image_id`, `annotation_name`),
+  KEY `class_area_idx` (`class_name`, `pixel_area`),
   CONSTRAINT `image_fid` FOREIGN KEY (`image_id`) REFERENCES `image` (`image_id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=137 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
@@ -53,6 +67,26 @@ CREATE TABLE `project` (
   `unlabeled_count` int NOT NULL DEFAULT '0',
   `labeled_count` int NOT NULL DEFAULT '0',
   PRIMARY KEY (`project_id`),
-  UNIQUE KEY `project_id_UNIQUE` (`project_id`),
   UNIQUE KEY `project_name_UNIQUE` (`project_name`)
-) ENGINE=InnoDB AUTO_INCREMENT=119 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
\ No newline at end of file
+) ENGINE=InnoDB AUTO_INCREMENT=119 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+--
+-- Table structure for table `schema_migrations`
+-- This schema already includes every migration in database/migrations,
+-- newer migrations are applied with `python -m server.tools.migrate`
+--
+
+DROP TABLE IF EXISTS `schema_migrations`;
+CREATE TABLE `schema_migrations` (
+  `version` int NOT NULL,
+  `name` varchar(260) NOT NULL,
+  `applied_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+INSERT INTO `schema_migrations` (`version`, `name`) VALUES
+  (1, '0001_annotation_bundle.sql'),
+  (2, '0002_annotation_metadata.sql'),
+  (3, '0003_image_dimensions.sql'),
+  (4, '0004_image_listing_indexes.sql'),
+  (5, '0005_image_lock_leases.sql');
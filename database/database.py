@@ -1,9 +1,133 @@
-import mysql.connector
-from mysql.connector import pooling
+from contextlib import contextmanager
+from mysql.connector.constants import ClientFlag
+from mysql.connector.errors import DataError
+from mysql.connector.errors import DatabaseError
+from mysql.connector.errors import IntegrityError
 from mysql.connector.errors import InterfaceError
-from mysql.connector.errors import PoolError
+from mysql.connector.errors import OperationalError
 
-import time
+from database.connection_pool import ConnectionPool
+
+
+class Transaction:
+    """
+    A unit of work holding a single pooled connection. Statements run inside one
+    transaction which is committed when the owning `with` block exits normally
+    and rolled back if it raises.
+    """
+
+    # Upper bound on the rows sent in one multi-row INSERT, to stay under max_allowed_packet
+    MAX_INSERT_ROWS = 1000
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def query(self, query_string, params=None):
+        """
+        Run a single statement.
+        :return: A tuple of (rows as dicts, last inserted row id)
+        """
+        cursor = self.connection.cursor(dictionary=True)
+        try:
+            cursor.execute(query_string, params)
+            try:
+                result = cursor.fetchall()
+            except InterfaceError as ex:
+                result = []
+            id = cursor.lastrowid
+        finally:
+            cursor.close()
+        return result, id
+
+    def execute(self, query_string, params=None):
+        """
+        Run a single statement which returns no rows, such as an UPDATE.
+        :return: The number of affected rows
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query_string, params)
+            count = cursor.rowcount
+        finally:
+            cursor.close()
+        return count
+
+    def executemany(self, query_string, seq_params):
+        """
+        Run a statement once for every set of parameters. Simple INSERT statements
+        are rewritten by the driver into a single multi-row INSERT.
+        :return: The number of affected rows
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany(query_string, seq_params)
+            count = cursor.rowcount
+        finally:
+            cursor.close()
+        return count
+
+    def insert_many(self, query_string, row_values, seq_params, id_query, key_index):
+        """
+        Insert many rows with multi-row statements of up to MAX_INSERT_ROWS rows. If a
+        statement is rejected for a bad row its rows are inserted one at a time, so that
+        the bad row only fails itself. Any other error, e.g. a deadlock, is raised.
+
+        The ids of a multi-row insert are read back by a unique key of the rows, as the
+        auto increment values of one statement are only consecutive for some settings
+        of auto_increment_increment and innodb_autoinc_lock_mode.
+
+        :param query_string: The statement up to VALUES, e.g. "INSERT INTO t (a, b) VALUES "
+        :param row_values: The placeholders for one row, e.g. "(%s, %s)"
+        :param seq_params: A sequence of parameter tuples, one per row
+        :param id_query: A query selecting the id and then the unique key of rows, up to
+                         the list of keys, e.g. "SELECT id, b FROM t WHERE (b) IN "
+        :param key_index: The positions of the unique key in a row's parameters, e.g. (1,)
+        :return: A list of (row id, exception) tuples in the order of seq_params,
+                 where exactly one of the pair is None
+        """
+        key_values = "(" + ", ".join(["%s"] * len(key_index)) + ")"
+        inserted = []
+        for i in range(0, len(seq_params), self.MAX_INSERT_ROWS):
+            batch = seq_params[i:i + self.MAX_INSERT_ROWS]
+            params = tuple(x for row in batch for x in row)
+            try:
+                self.query(query_string + ", ".join([row_values] * len(batch)), params)
+            except (IntegrityError, DataError):
+                pass
+            else:
+                keys = [tuple(row[k] for k in key_index) for row in batch]
+                rows, _ = self.query(
+                    id_query + "(" + ", ".join([key_values] * len(batch)) + ")",
+                    tuple(x for key in keys for x in key))
+                ids = {}
+                for row in rows:
+                    values = list(row.values())
+                    ids[tuple(values[1:])] = values[0]
+                inserted.extend((ids[key], None) for key in keys)
+                continue
+
+            for row in batch:
+                try:
+                    _, id = self.query(query_string + row_values, row)
+                except (IntegrityError, DataError) as e:
+                    inserted.append((None, e))
+                else:
+                    inserted.append((id, None))
+        return inserted
+
+    def commit(self):
+        """
+        Commit the work so far and start a new transaction on the same connection.
+        """
+        self.connection.commit()
+        self.connection.start_transaction()
+
+    def rollback(self):
+        """
+        Discard the work so far and start a new transaction on the same connection.
+        """
+        self.connection.rollback()
+        self.connection.start_transaction()
 
 
 class Database:
@@ -15,38 +139,77 @@ class Database:
             'database': self.config.DATABASE_NAME,
             'password': self.config.DATABASE_PASSWORD,
             'autocommit': True,
+            # Report the rows an UPDATE matched rather than changed, so conditional
+            # updates which leave a row as it was still count it
+            'client_flags': [ClientFlag.FOUND_ROWS],
             'time_zone': self.config.DATABASE_TIMEZONE
         }
 
-        self.db_pool = mysql.connector.pooling.MySQLConnectionPool(
-            pool_name="db_pool", pool_size=self.config.DATABASE_POOL_SIZE, **self.db_config)
+        self.db_pool = ConnectionPool(
+            self.config.DATABASE_POOL_SIZE,
+            self.config.DATABASE_HEALTH_CHECK_INTERVAL,
+            **self.db_config)
 
-    def query(self, query_string, params=None, timeout=3):
-        t0 = time.time()
-        t1 = t0
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Check out a pooled connection for the duration of a `with` block. A connection
+        which fails with a connection error is replaced rather than returned to the pool.
+        :param timeout: The number of seconds to wait for a free connection,
+                        defaults to DATABASE_POOL_TIMEOUT
+        """
+        if timeout is None:
+            timeout = self.config.DATABASE_POOL_TIMEOUT
 
-        connection = None
-        while (t1 - t0) < timeout:
-            t1 = time.time()
-            try:
-                connection = self.db_pool.get_connection()
-            except PoolError:
-                print("Retrying Connection..")
-                time.sleep(1)
-                continue
+        connection = self.db_pool.get_connection(timeout)
+        lost = False
+        try:
+            yield connection
+        except (InterfaceError, OperationalError):
+            lost = True
+            raise
+        finally:
+            if lost:
+                self.db_pool.discard(connection)
             else:
-                break
-        print("Connection Made")
+                self.db_pool.release(connection)
 
-        cursor = connection.cursor(dictionary=True)
-        try:
-            cursor.execute(query_string, params)
+    @contextmanager
+    def transaction(self, timeout=None):
+        """
+        Check out one connection for a sequence of statements which succeed or fail together.
+        Single statements should use query, which runs without the extra round trips of
+        starting and committing a transaction.
+
+            with db.transaction() as tx:
+                tx.query(...)
+                tx.executemany(...)
+
+        :param timeout: The number of seconds to wait for a free connection,
+                        defaults to DATABASE_POOL_TIMEOUT
+        :return: A Transaction, committed on exit or rolled back if an exception is raised
+        """
+        with self.connection(timeout) as connection:
+            connection.start_transaction()
             try:
-                result = cursor.fetchall()
-            except InterfaceError as ex:
-                result = []
-            id = cursor.lastrowid
-        finally:
-            cursor.close()
-            connection.close()
-        return result, id
+                yield Transaction(connection)
+            except BaseException:
+                connection.rollback()
+                raise
+            connection.commit()
+
+    def query(self, query_string, params=None, timeout=None):
+        """
+        Run a single statement on its own, committed by autocommit.
+        :return: A tuple of (rows as dicts, last inserted row id)
+        """
+        with self.connection(timeout) as connection:
+            return Transaction(connection).query(query_string, params)
+
+    def execute(self, query_string, params=None, timeout=None):
+        """
+        Run a single statement which returns no rows on its own, committed by autocommit.
+        :return: The number of affected rows
+        """
+        with self.connection(timeout) as connection:
+            return Transaction(connection).execute(query_string, params)
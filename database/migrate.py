@@ -0,0 +1,89 @@
+"""
+A forward only, versioned schema migration runner.
+
+Migrations are the files named `<version>_<description>.sql` in database/migrations.
+The versions applied to a database are recorded in its `schema_migrations` table,
+and each run applies the pending migrations in version order. MySQL commits DDL
+implicitly, so every migration is recorded as soon as its statements complete.
+"""
+import os
+import re
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_PATTERN = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+CREATE_MIGRATIONS_TABLE = (
+    "CREATE TABLE IF NOT EXISTS `schema_migrations` ("
+    "`version` int NOT NULL, "
+    "`name` varchar(260) NOT NULL, "
+    "`applied_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+    "PRIMARY KEY (`version`))")
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    def statements(self):
+        """
+        Split the migration into statements, dropping `--` comment lines.
+        """
+        with open(self.path) as f:
+            lines = [line for line in f if not line.lstrip().startswith("--")]
+        return [x.strip() for x in "".join(lines).split(";") if x.strip()]
+
+
+def find_migrations(migrations_dir=MIGRATIONS_DIR):
+    """
+    :return: The migrations in migrations_dir ordered by version
+    :raises ValueError: If two migrations share a version
+    """
+    migrations = {}
+    for filename in os.listdir(migrations_dir):
+        match = MIGRATION_PATTERN.match(filename)
+        if match is None:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise ValueError("Duplicate migration version %d: %s and %s" % (
+                version, migrations[version].name, filename))
+        migrations[version] = Migration(version, filename, os.path.join(migrations_dir, filename))
+    return [migrations[v] for v in sorted(migrations)]
+
+
+def applied_versions(db):
+    with db.transaction() as tx:
+        tx.query(CREATE_MIGRATIONS_TABLE)
+        rows, _ = tx.query("SELECT version FROM schema_migrations")
+    return {row["version"] for row in rows}
+
+
+def pending_migrations(db, migrations_dir=MIGRATIONS_DIR):
+    applied = applied_versions(db)
+    return [m for m in find_migrations(migrations_dir) if m.version not in applied]
+
+
+def migrate(db, target=None, migrations_dir=MIGRATIONS_DIR, fake=False):
+    """
+    Apply every pending migration up to and including target.
+    :param db: A database.Database
+    :param target: The last version to apply, or None for all
+    :param fake: Record the migrations as applied without running them, for
+                 databases created from a create_database.sql which already includes them
+    :return: The list of migrations applied
+    """
+    applied = []
+    for migration in pending_migrations(db, migrations_dir):
+        if target is not None and migration.version > target:
+            break
+        with db.transaction() as tx:
+            if not fake:
+                for statement in migration.statements():
+                    tx.query(statement)
+            tx.query(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (migration.version, migration.name))
+        applied.append(migration)
+    return applied
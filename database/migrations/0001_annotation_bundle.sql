@@ -0,0 +1,10 @@
+--
+-- Annotations of an image are stored in a single bundle file, so mask_path and
+-- info_path are shared by every annotation of an image. Uniqueness moves to
+-- the (image_id, annotation_name) pair, which REPLACE INTO relies on.
+--
+
+ALTER TABLE `instance_seg_meta`
+  DROP INDEX `mask_path_UNIQUE`,
+  DROP INDEX `info_path_UNIQUE`,
+  ADD UNIQUE KEY `image_annotation_UNIQUE` (`image_id`, `annotation_name`);
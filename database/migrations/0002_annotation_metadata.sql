@@ -0,0 +1,16 @@
+--
+-- Bounding box, source shape and pixel area of each annotation are stored in
+-- instance_seg_meta so metadata reads no longer parse the VOC XML files.
+-- Existing rows are filled in by `python -m server.tools.backfill_annotation_meta`.
+--
+
+ALTER TABLE `instance_seg_meta`
+  ADD COLUMN `bbox_xmin` int DEFAULT NULL,
+  ADD COLUMN `bbox_ymin` int DEFAULT NULL,
+  ADD COLUMN `bbox_xmax` int DEFAULT NULL,
+  ADD COLUMN `bbox_ymax` int DEFAULT NULL,
+  ADD COLUMN `source_width` int DEFAULT NULL,
+  ADD COLUMN `source_height` int DEFAULT NULL,
+  ADD COLUMN `source_depth` int DEFAULT NULL,
+  ADD COLUMN `pixel_area` int DEFAULT NULL,
+  ADD KEY `class_area_idx` (`class_name`, `pixel_area`);
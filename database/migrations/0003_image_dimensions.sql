@@ -0,0 +1,9 @@
+--
+-- Uploads are stored as received, so the real format and dimensions of each
+-- image are recorded at ingest rather than assumed from DEFAULT_IMAGE_EXT.
+--
+
+ALTER TABLE `image`
+  ADD COLUMN `image_width` int DEFAULT NULL AFTER `image_ext`,
+  ADD COLUMN `image_height` int DEFAULT NULL AFTER `image_width`,
+  ADD COLUMN `image_format` varchar(10) DEFAULT NULL AFTER `image_height`;
@@ -0,0 +1,24 @@
+--
+-- Indexes for the keyset paginated project image listing. Each listing shape is
+-- answered from one index in sort order, without a filesort, and the name ordered
+-- indexes cover the inline fields so the listing never reads the table rows:
+--   no filter, by name        -> project_name_idx
+--   locked and labeled, by name -> project_status_name_idx
+--   locked and labeled, by id   -> project_status_idx (image_id is the implicit suffix)
+--   no filter, by id          -> project_id_idx
+-- The unique keys duplicating primary keys are dropped, as is image_fid_idx which
+-- is a prefix of image_annotation_UNIQUE.
+--
+
+ALTER TABLE `image`
+  DROP INDEX `image_id_UNIQUE`,
+  ADD KEY `project_name_idx` (`project_fid`, `image_name`, `image_id`, `is_locked`, `is_labeled`),
+  ADD KEY `project_status_name_idx` (`project_fid`, `is_labeled`, `is_locked`, `image_name`, `image_id`),
+  ADD KEY `project_status_idx` (`project_fid`, `is_labeled`, `is_locked`);
+
+ALTER TABLE `instance_seg_meta`
+  DROP INDEX `annotation_id_UNIQUE`,
+  DROP INDEX `image_fid_idx`;
+
+ALTER TABLE `project`
+  DROP INDEX `project_id_UNIQUE`;
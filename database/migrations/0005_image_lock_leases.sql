@@ -0,0 +1,13 @@
+--
+-- Image locks become leases held by an owner until an expiry time. The reaper
+-- releases expired leases with a range scan of lock_expires_idx. Locks taken
+-- before this migration have no owner, they are given an expiry of now so the
+-- first reaper pass releases them.
+--
+
+ALTER TABLE `image`
+  ADD COLUMN `lock_owner` varchar(64) DEFAULT NULL,
+  ADD COLUMN `lock_expires` datetime DEFAULT NULL,
+  ADD KEY `lock_expires_idx` (`lock_expires`);
+
+UPDATE `image` SET `lock_expires` = UTC_TIMESTAMP() WHERE `is_locked` = 1;
@@ -2,6 +2,7 @@ from flask_restplus import Api
 
 from .project import api as project_api
 from .image import api as image_api
+from .stats import api as stats_api
 
 api = Api(
     title='FastAnnotation API',
@@ -11,4 +12,5 @@ api = Api(
 
 
 api.add_namespace(project_api)
-api.add_namespace(image_api)
\ No newline at end of file
+api.add_namespace(image_api)
+api.add_namespace(stats_api)
\ No newline at end of file
@@ -1,18 +1,30 @@
 import base64
 import os
 
-from flask import request
+from flask import Response, request, send_file
 from flask_restplus import Namespace, Resource, fields, marshal
+from mysql.connector import errorcode
 from mysql.connector.errors import DatabaseError
 
 import server.utils as utils
+from common import image_container
+from common.mask_codec import CODECS, DEFAULT_ENCODING, MASK_ENCODING_HEADER
+from server.core import annotation_bundle
+from server.core import image_update
+from server.core import lock_leases
+from server.core import tile_pyramid
+from server.core import voc_export
 from server.core.common_dtos import common_store
+from server.server_config import AnnotationCacheInstance
 from server.server_config import DatabaseInstance
 from server.server_config import ServerConfig
+from server.server_config import ThumbnailPoolInstance
 
 api = Namespace('images', description='Image related operations')
 
 db = DatabaseInstance()
+annotation_cache = AnnotationCacheInstance()
+thumbnail_pool = ThumbnailPoolInstance()
 
 api.models.update(common_store.get_dtos())
 
@@ -33,6 +45,19 @@ image = api.model(
             required=False,
             description="The file extension of the image",
             example=".jpg"),
+        'width': fields.Integer(
+            attribute='image_width',
+            required=False,
+            description="The width of the image in pixels"),
+        'height': fields.Integer(
+            attribute='image_height',
+            required=False,
+            description="The height of the image in pixels"),
+        'format': fields.String(
+            attribute='image_format',
+            required=False,
+            description="The format of the stored image",
+            example="jpeg"),
         'is_locked': fields.Boolean(
             required=False,
             description="A flag indicating whether the image is locked"),
@@ -61,6 +86,12 @@ annotation = api.model('annotation', {
     'mask_data': fields.String(
         required=True,
         description="The encoded mask data"),
+    'mask_encoding': fields.String(
+        required=False,
+        default=DEFAULT_ENCODING,
+        enum=list(CODECS.keys()),
+        description="The encoding used for mask_data",
+        example="rle"),
     'bbox': fields.List(
         fields.Integer,
         required=True,
@@ -78,7 +109,12 @@ annotation = api.model('annotation', {
     'class_name': fields.String(
         required=True,
         description="The name of the class associated with this annotation",
-        example="class_1")})
+        example="class_1"),
+    'area': fields.Integer(
+        attribute="pixel_area",
+        required=False,
+        description="The number of pixels covered by the mask",
+        example=4096)})
 
 bulk_annotations = api.model('bulk_annotations', {
     'image_id': fields.Integer(
@@ -87,9 +123,147 @@ bulk_annotations = api.model('bulk_annotations', {
     'annotations': fields.List(fields.Nested(annotation))
 })
 
+thumbnail = api.model('thumbnail', {
+    'id': fields.Integer(
+        attribute='image_id',
+        required=True,
+        description='The image identifier'),
+    'name': fields.String(
+        attribute='image_name',
+        required=False,
+        description='The image name',
+        example="image_123"),
+    'thumbnail_data': fields.String(
+        required=False,
+        description="The encoded JPEG thumbnail")})
+
+bulk_thumbnails = api.model('bulk_thumbnails', {
+    'thumbnails': fields.List(fields.Nested(thumbnail))
+})
+
+tile_level = api.model('tile_level', {
+    'level': fields.Integer(
+        required=True,
+        description="The level index, 0 being full resolution"),
+    'width': fields.Integer(
+        required=True,
+        description="The width of the image at this level in pixels"),
+    'height': fields.Integer(
+        required=True,
+        description="The height of the image at this level in pixels"),
+    'columns': fields.Integer(
+        required=True,
+        description="The number of tiles across"),
+    'rows': fields.Integer(
+        required=True,
+        description="The number of tiles down")})
+
+tile_manifest = api.model('tile_manifest', {
+    'width': fields.Integer(
+        required=True,
+        description="The width of the full resolution image in pixels"),
+    'height': fields.Integer(
+        required=True,
+        description="The height of the full resolution image in pixels"),
+    'tile_size': fields.Integer(
+        required=True,
+        description="The width and height of a full tile in pixels",
+        example=512),
+    'format': fields.String(
+        required=True,
+        description="The file extension of the tiles",
+        example=".jpg"),
+    'levels': fields.List(fields.Nested(tile_level))
+})
+
 bulk_image_request = api.model('bulk_image_request', {'ids': fields.List(
     fields.Integer, required=True, description="The list of image ids to retrieve")})
 
+bulk_image_update = api.model('bulk_image_update', {
+    'ids': fields.List(
+        fields.Integer,
+        required=False,
+        description="The images to apply patch to"),
+    'patch': fields.Nested(
+        image,
+        required=False,
+        description="The fields to set on every image in ids"),
+    'images': fields.List(
+        fields.Nested(image),
+        required=False,
+        description="Patches for individual images, each including the image id")
+})
+
+
+ANNOTATION_QUERY = "SELECT annotation_id, annotation_name, mask_path, info_path, class_name, " + \
+    ", ".join(utils.ANNOTATION_META_COLUMNS) + " FROM instance_seg_meta WHERE image_id = %s"
+
+
+def _load_annotation(row, encodings, mask_data_flag, bundles):
+    """
+    Complete a single annotation row, see _load_annotations.
+    :param bundles: Bundles already read for this image, by path
+    :raises KeyError: If the row's annotation is missing from its bundle
+    """
+    info = utils.annotation_meta_from_row(row)
+    is_bundle = annotation_bundle.is_bundle_path(row["mask_path"])
+
+    if mask_data_flag:
+        # Encoded masks are cached against the version of the file they came from
+        key = (row["mask_path"],
+               utils.file_version(row["mask_path"]),
+               row["annotation_name"],
+               tuple(encodings))
+        payload = annotation_cache.get(key)
+        if payload is None:
+            if is_bundle:
+                if row["mask_path"] not in bundles:
+                    bundles[row["mask_path"]] = annotation_bundle.read_bundle(
+                        row["mask_path"])
+                mask = bundles[row["mask_path"]][row["annotation_name"]]["mask"]
+            else:
+                mask = utils.load_mask(row["mask_path"])
+            payload = utils.encode_mask_smallest(mask, encodings)
+            annotation_cache.put(
+                key, payload, len(payload[1]), group=row["mask_path"])
+        row["mask_encoding"], row["mask_data"] = payload
+
+    # Rows which have not been backfilled still need their files
+    if info is None and is_bundle:
+        stored = annotation_bundle.read_bundle_entry_meta(
+            row["mask_path"], row["annotation_name"])
+        if stored is None:
+            raise KeyError(row["annotation_name"])
+        info = {"bbox": stored["bbox"], "source_shape": stored["shape"]}
+    elif info is None:
+        info = utils.load_info(row["info_path"])
+
+    row["shape"] = info["source_shape"]
+    row["bbox"] = info["bbox"]
+
+    print("SERVER: outgoing bbox")
+    print("\t%s" % str(row["bbox"]))
+    return row
+
+
+def _load_annotations(result, encodings, mask_data_flag=True):
+    """
+    Complete annotation rows read from instance_seg_meta with their shape, bounding
+    box and, when mask_data_flag is set, their mask in the best of encodings.
+    """
+    annotations = []
+    bundles = {}
+    for row in result:
+        # A row whose mask is missing, e.g. after a partially failed write, is skipped
+        # rather than failing every other annotation of the image
+        try:
+            annotations.append(_load_annotation(row, encodings, mask_data_flag, bundles))
+        except (KeyError, FileNotFoundError) as e:
+            print("Skipping annotation %d '%s', its mask is missing: %r" % (
+                row["annotation_id"], row["annotation_name"], e))
+
+    return annotations
+
 
 @api.route("")
 class ImageList(Resource):
@@ -113,12 +287,25 @@ class ImageList(Resource):
         else:
             image_data_flag = image_data_flag.lower() == "true"
 
-        query = "SELECT image_id, image_path, image_name, image_ext, is_locked, is_labeled FROM image "
-        query += "WHERE image_id IN "
-        query += "(%s)" % ",".join(str(x) for x in content["ids"])
+        if len(content["ids"]) > ServerConfig.IMAGE_PAGE_SIZE_MAX:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": "At most %d images may be requested at once." % ServerConfig.IMAGE_PAGE_SIZE_MAX
+                }
+            }
+            return marshal(response, api.models["generic_response"]), 400
+
+        query = "SELECT image_id, image_path, image_name, image_ext, image_width, image_height, image_format, "
+        query += "is_locked, is_labeled FROM image "
+        query += "WHERE image_id IN (%s)" % ",".join(["%s"] * len(content["ids"]))
 
         try:
-            result = db.query(query)[0]
+            if not content["ids"]:
+                result = []
+            else:
+                result = db.query(query, tuple(int(x) for x in content["ids"]))[0]
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -156,17 +343,248 @@ class ImageList(Resource):
             return marshal(response, api.models["generic_response"]), code
 
 
+    @api.response(200, "OK", api.models["bulk_response"])
+    @api.response(400, "Invalid Payload", api.models["generic_response"])
+    @api.param(ServerConfig.LOCK_OWNER_HEADER, "The client taking the locks, when is_locked is set", _in="header")
+    @api.expect(bulk_image_update)
+    def put(self):
+        """
+        A bulk operation for updating image meta parameters, such as locking, unlocking or labeling many images.
+        The patch is applied to every image in ids, and each of images is applied to its own id.
+        """
+        content = request.json or {}
+
+        patches = [dict(content.get("patch") or {}, id=iid) for iid in content.get("ids") or []]
+        patches += content.get("images") or []
+
+        if any("id" not in patch for patch in patches):
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": "Every image patch must include an id."
+                }
+            }
+            return marshal(response, api.models["generic_response"], skip_none=True), 400
+        if len(patches) > ServerConfig.IMAGE_PAGE_SIZE_MAX:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": "At most %d images may be updated at once." % ServerConfig.IMAGE_PAGE_SIZE_MAX
+                }
+            }
+            return marshal(response, api.models["generic_response"], skip_none=True), 400
+
+        merged = image_update.merge_patches(patches)
+        errors = {}
+        for iid, patch in merged.items():
+            if "is_locked" not in patch and not set(patch) & set(image_update.IMAGE_UPDATE_COLUMNS):
+                errors[iid] = (400, "No valid parameters provided for update.")
+
+        ids = [iid for iid in merged if iid not in errors]
+        try:
+            if ids:
+                owner = lock_leases.request_owner()
+                with db.transaction() as tx:
+                    q_leases, lease_params = image_update.lease_query(ids, owner)
+                    rows = {row["image_id"]: row for row in tx.query(q_leases, lease_params)[0]}
+                    for iid in ids:
+                        if iid not in rows:
+                            errors[iid] = (404, "Image does not exist with id %d." % iid)
+                        elif image_update.lease_conflict(merged[iid], rows[iid]):
+                            errors[iid] = (409, "Image with id %d is locked by another client." % iid)
+
+                    updates = image_update.build_updates(
+                        {iid: merged[iid] for iid in ids if iid not in errors},
+                        owner)
+                    for group_ids, query, params in updates:
+                        # Most errors roll back only the failed statement, so the other groups
+                        # still apply. A deadlock or lock wait timeout can roll back the whole
+                        # transaction, which then fails every image in the request.
+                        try:
+                            tx.query(query, params)
+                        except DatabaseError as e:
+                            if e.errno in (errorcode.ER_LOCK_DEADLOCK, errorcode.ER_LOCK_WAIT_TIMEOUT):
+                                raise
+                            for iid in group_ids:
+                                errors[iid] = (500, e.msg)
+        except DatabaseError as e:
+            for iid in ids:
+                errors.setdefault(iid, (500, e.msg))
+        except BaseException as e:
+            for iid in ids:
+                errors.setdefault(iid, (500, str(e)))
+
+        bulk_response = []
+        for iid in merged:
+            if iid in errors:
+                code, message = errors[iid]
+                result = {
+                    "action": "failed",
+                    "id": iid,
+                    "error": {
+                        "code": code,
+                        "message": message
+                    }
+                }
+            else:
+                result = {
+                    "action": "updated",
+                    "id": iid
+                }
+            bulk_response.append(result)
+
+        return marshal({"results": bulk_response}, api.models["bulk_response"], skip_none=True), 200
+
+
+@api.route("/thumbnails")
+class ImageThumbnailList(Resource):
+    @api.response(200, "OK", bulk_thumbnails)
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.expect(bulk_image_request)
+    def get(self):
+        """
+        A bulk operation for retrieving image thumbnails by id.
+        """
+        content = request.json
+        ids = [int(x) for x in content["ids"]]
+        if not ids:
+            return marshal({"thumbnails": []}, bulk_thumbnails), 200
+
+        query = "SELECT image_id, image_path, image_name FROM image "
+        query += "WHERE image_id IN (%s)" % ",".join(["%s"] * len(ids))
+
+        try:
+            result = db.query(query, tuple(ids))[0]
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            # IN returns rows in index order, the response follows the order of the request
+            position = {}
+            for i, iid in enumerate(ids):
+                position.setdefault(iid, i)
+            result.sort(key=lambda row: position[row["image_id"]])
+            # Missing thumbnails are generated in parallel on the thumbnail pool
+            thumbnails = list(thumbnail_pool.map(self._load_thumbnail, result))
+            response = {"thumbnails": thumbnails}
+            code = 200
+
+        if code == 200:
+            return marshal(response, bulk_thumbnails, skip_none=True), code
+        else:
+            return marshal(response, api.models["generic_response"], skip_none=True), code
+
+    @staticmethod
+    def _load_thumbnail(row):
+        try:
+            data = utils.load_thumbnail(row["image_path"], row["image_id"])
+        except BaseException as e:
+            print("Failed to load thumbnail for image %d: %s" % (row["image_id"], str(e)))
+        else:
+            row["thumbnail_data"] = base64.b64encode(data).decode('utf-8')
+        return row
+
+
+@api.route("/leases")
+class ImageLeaseList(Resource):
+    @api.response(200, "OK", api.models["generic_response"])
+    @api.response(400, "Invalid Payload", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.param(ServerConfig.LOCK_OWNER_HEADER, "The client holding the locks", _in="header")
+    @api.marshal_with(api.models["generic_response"], skip_none=True)
+    @api.expect(bulk_image_request)
+    def put(self):
+        """
+        Renew the lock leases held by the requesting client on a list of images.
+        The ids returned are those still locked by the client, any others have been
+        released or taken by someone else.
+        """
+        content = request.json
+        ids = [int(x) for x in content["ids"]]
+        if len(ids) > ServerConfig.IMAGE_PAGE_SIZE_MAX:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": "At most %d leases may be renewed at once." % ServerConfig.IMAGE_PAGE_SIZE_MAX
+                }
+            }
+            return response, 400
+        if not ids:
+            return {"action": "updated", "ids": []}, 200
+
+        owner = lock_leases.request_owner()
+        in_ids = ",".join(["%s"] * len(ids))
+        q_renew = "UPDATE image SET " + lock_leases.LOCK_ASSIGNMENTS
+        q_renew += " WHERE image_id IN (%s) AND is_locked = 1 AND lock_owner = %%s" % in_ids
+        q_held = "SELECT image_id FROM image WHERE image_id IN (%s) AND is_locked = 1 AND lock_owner = %%s" % in_ids
+
+        try:
+            with db.transaction() as tx:
+                tx.query(q_renew, lock_leases.lock_params(owner) + tuple(ids) + (owner,))
+                results, _ = tx.query(q_held, tuple(ids) + (owner,))
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            response = {
+                "action": "updated",
+                "ids": [row["image_id"] for row in results]
+            }
+            code = 200
+        return response, code
+
+
 @api.doc(params={"iid": "An id associated with an existing image."})
 @api.route("/<int:iid>")
 class Image(Resource):
     @api.response(200, "OK", image)
     @api.response(404, "Resource Not Found", api.models["generic_response"])
     @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.param(
+        'image-data',
+        description='A flag indicating whether image data is required',
+        type='boolean')
     def get(self, iid):
         """
         Gets an image as referenced by its identifier.
         """
-        query = "SELECT image_id, image_path, image_name, image_ext, is_locked, is_labeled FROM image "
+        image_data_flag = request.args.get('image-data', 'true').lower() != "false"
+
+        query = "SELECT image_id, image_path, image_name, image_ext, image_width, image_height, image_format, "
+        query += "is_locked, is_labeled FROM image "
         query += "WHERE image_id = %s"
 
         try:
@@ -201,7 +619,7 @@ class Image(Resource):
             }
             code = 500
         else:
-            if response["image_ext"] == ".jpg":
+            if image_data_flag and response["image_ext"].lower() in (".jpg", ".jpeg", ".png"):
                 with open(response["image_path"], "rb") as img_file:
                     encoded_image = base64.b64encode(img_file.read())
                     response["image_data"] = encoded_image.decode('utf-8')
@@ -215,7 +633,10 @@ class Image(Resource):
 
     @api.response(200, "OK", api.models["generic_response"])
     @api.response(400, "Invalid Payload", api.models["generic_response"])
+    @api.response(404, "Resource Not Found", api.models["generic_response"])
+    @api.response(409, "Locked By Another Client", api.models["generic_response"])
     @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.param(ServerConfig.LOCK_OWNER_HEADER, "The client taking or releasing the lock, when is_locked is set", _in="header")
     @api.marshal_with(api.models["generic_response"], skip_none=True)
     @api.expect(image)
     def put(self, iid):
@@ -223,26 +644,35 @@ class Image(Resource):
         Update an images meta parameters.
         """
 
-        #TODO: Update to raise 409 when lock is requested on already locked object
-
         content = request.json
+        owner = lock_leases.request_owner()
 
-        query = "UPDATE image SET"
+        assignments = []
         params = []
+        conditions = ["image_id = %s"]
+        condition_params = [iid]
         if "name" in content:
-            query += " image_name = %s"
+            assignments.append("image_name = %s")
             params.append(content["name"])
         if "ext" in content:
-            query += " image_ext = %s"
+            assignments.append("image_ext = %s")
             params.append(content["ext"])
         if "is_locked" in content:
-            query += " is_locked = %s"
-            params.append(content["is_locked"])
+            # Locking takes out a lease for the requesting client, unlocking ends it,
+            # neither may touch a live lease held by another client
+            if content["is_locked"]:
+                assignments.append(lock_leases.LOCK_ASSIGNMENTS)
+                params.extend(lock_leases.lock_params(owner))
+                conditions.append(lock_leases.LOCKABLE_CONDITION)
+            else:
+                assignments.append(lock_leases.UNLOCK_ASSIGNMENTS)
+                conditions.append(lock_leases.UNLOCKABLE_CONDITION)
+            condition_params.append(owner)
         if "is_labeled" in content:
-            query += " is_labeled = %s"
+            assignments.append("is_labeled = %s")
             params.append(content["is_labeled"])
 
-        if not params:
+        if not assignments:
             response = {
                 "action": "failed",
                 "error": {
@@ -252,10 +682,12 @@ class Image(Resource):
             }
             return response, 400
 
-        query += " WHERE image_id = %s"
-        params.append(iid)
+        query = "UPDATE image SET " + ", ".join(assignments) + " WHERE " + " AND ".join(conditions)
+        params.extend(condition_params)
         try:
-            db.query(query, tuple(params))
+            count = db.execute(query, tuple(params))
+            if count == 0 and not db.query("SELECT image_id FROM image WHERE image_id = %s", (iid,))[0]:
+                raise IndexError(iid)
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -265,6 +697,15 @@ class Image(Resource):
                 }
             }
             code = 500
+        except IndexError:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 404,
+                    "message": "Image does not exist with id %d." % iid
+                }
+            }
+            code = 404
         except BaseException as e:
             response = {
                 "action": "failed",
@@ -275,11 +716,21 @@ class Image(Resource):
             }
             code = 500
         else:
-            response = {
-                "action": "updated",
-                "id": iid
-            }
-            code = 200
+            if count == 0:
+                response = {
+                    "action": "failed",
+                    "error": {
+                        "code": 409,
+                        "message": "Image with id %d is locked by another client." % iid
+                    }
+                }
+                code = 409
+            else:
+                response = {
+                    "action": "updated",
+                    "id": iid
+                }
+                code = 200
         return response, code
 
     @api.response(200, "OK", api.models["generic_response"])
@@ -294,8 +745,10 @@ class Image(Resource):
         query = "DELETE from image WHERE image_id = %s"
 
         try:
-            db.query(q_delete_annotations, (iid,))
-            db.query(query, (iid,))
+            with db.transaction() as tx:
+                tx.query(q_delete_annotations, (iid,))
+                tx.query(query, (iid,))
+            annotation_cache.invalidate(utils.annotation_bundle_path(iid))
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -323,20 +776,298 @@ class Image(Resource):
         return response, code
 
 
+@api.doc(params={"iid": "An id associated with an existing image."})
+@api.route("/<int:iid>/raw")
+class ImageRaw(Resource):
+    @api.response(200, "OK")
+    @api.response(304, "Not Modified")
+    @api.response(404, "Resource Not Found", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.param(
+        'If-None-Match',
+        description="An ETag from a previous response, answered with 304 if unchanged",
+        _in='header')
+    def get(self, iid):
+        """
+        Gets the stored bytes of an image as referenced by its identifier.
+        """
+        query = "SELECT image_path, image_ext FROM image "
+        query += "WHERE image_id = %s"
+
+        try:
+            row = db.query(query, (iid,))[0][0]
+            etag = utils.file_etag(row["image_path"])
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except (IndexError, FileNotFoundError):
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 404,
+                    "message": "Resource not found."
+                }
+            }
+            code = 404
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            # send_file hands the open file to the WSGI server's file wrapper,
+            # which uses sendfile where the server supports it
+            rv = send_file(
+                row["image_path"],
+                mimetype=utils.image_mimetype(row["image_ext"]))
+            rv.set_etag(etag)
+            rv.cache_control.no_cache = True
+            return rv.make_conditional(request)
+
+        return marshal(
+            response, api.models["generic_response"], skip_none=True), code
+
+
+@api.doc(params={"iid": "An id associated with an existing image."})
+@api.route("/<int:iid>/open")
+class ImageOpen(Resource):
+    @api.response(200, "OK")
+    @api.response(404, "Resource Not Found", api.models["generic_response"])
+    @api.response(409, "Locked By Another Client", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.param(ServerConfig.LOCK_OWNER_HEADER, "The client opening the image", _in="header")
+    @api.param(
+        MASK_ENCODING_HEADER,
+        description="A comma separated list of acceptable mask encodings",
+        _in='header')
+    def post(self, iid):
+        """
+        Lock an image for the requesting client and return it with its annotations.
+
+        The response is an image container (see common/image_container.py) holding the
+        image meta and annotations as JSON followed by the stored image bytes. Images
+        already locked by the client, or whose lease has expired, are locked again.
+        """
+        encodings = utils.negotiate_mask_encodings(
+            request.headers.get(MASK_ENCODING_HEADER))
+        owner = lock_leases.request_owner()
+
+        query = "SELECT image_id, image_path, image_name, image_ext, image_width, image_height, image_format, "
+        query += "is_locked, is_labeled, lock_owner, lock_expires < UTC_TIMESTAMP() AS lock_expired "
+        query += "FROM image WHERE image_id = %s FOR UPDATE"
+
+        try:
+            with db.transaction() as tx:
+                row = tx.query(query, (iid,))[0][0]
+                if row["is_locked"] and row["lock_owner"] != owner and not row["lock_expired"]:
+                    raise lock_leases.LockConflict()
+                tx.query("UPDATE image SET " + lock_leases.LOCK_ASSIGNMENTS + " WHERE image_id = %s",
+                         lock_leases.lock_params(owner) + (iid,))
+                result = tx.query(ANNOTATION_QUERY, (iid,))[0]
+                # Loaded before the lease commits, so a failure leaves the image unlocked
+                with open(row["image_path"], "rb") as f:
+                    image_bytes = f.read()
+                annotations = _load_annotations(result, encodings)
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except (IndexError, FileNotFoundError):
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 404,
+                    "message": "Image does not exist with id %d." % iid
+                }
+            }
+            code = 404
+        except lock_leases.LockConflict:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 409,
+                    "message": "Image with id %d is locked by another client." % iid
+                }
+            }
+            code = 409
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            row["is_locked"] = True
+            meta = {
+                "image": marshal(row, image, skip_none=True),
+                "annotations": marshal(annotations, annotation, skip_none=True)
+            }
+            return Response(image_container.pack(meta, image_bytes),
+                            mimetype=image_container.IMAGE_CONTAINER_MIMETYPE)
+
+        return marshal(
+            response, api.models["generic_response"], skip_none=True), code
+
+
+@api.doc(params={"iid": "An id associated with an existing image."})
+@api.route("/<int:iid>/tiles")
+class ImageTileManifest(Resource):
+    @api.response(200, "OK", tile_manifest)
+    @api.response(404, "Resource Not Found", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    def get(self, iid):
+        """
+        Describes the levels and tile grid of an image's tile pyramid.
+        """
+        query = "SELECT image_path FROM image "
+        query += "WHERE image_id = %s"
+
+        try:
+            row = db.query(query, (iid,))[0][0]
+            # A built pyramid is described by its own manifest
+            data = tile_pyramid.read_manifest(iid)
+            if data is None:
+                data = tile_pyramid.manifest(*utils.read_image_dimensions(row["image_path"]))
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except (IndexError, FileNotFoundError):
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 404,
+                    "message": "Resource not found."
+                }
+            }
+            code = 404
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            return marshal(data, tile_manifest), 200
+
+        return marshal(
+            response, api.models["generic_response"], skip_none=True), code
+
+
+@api.doc(params={
+    "iid": "An id associated with an existing image.",
+    "level": "The pyramid level, 0 being full resolution",
+    "x": "The column of the tile",
+    "y": "The row of the tile"})
+@api.route("/<int:iid>/tiles/<int:level>/<int:x>/<int:y>")
+class ImageTile(Resource):
+    @api.response(200, "OK")
+    @api.response(304, "Not Modified")
+    @api.response(404, "Resource Not Found", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    def get(self, iid, level, x, y):
+        """
+        Gets a single tile of an image's tile pyramid, building the pyramid if required.
+        """
+        query = "SELECT image_path FROM image "
+        query += "WHERE image_id = %s"
+
+        try:
+            row = db.query(query, (iid,))[0][0]
+            tile_path = tile_pyramid.tile_path(iid, level, x, y)
+            if not os.path.exists(tile_path):
+                tile_pyramid.ensure_pyramid(iid, row["image_path"])
+            if not os.path.exists(tile_path):
+                raise IndexError(tile_path)
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except (IndexError, FileNotFoundError):
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 404,
+                    "message": "Resource not found."
+                }
+            }
+            code = 404
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            rv = send_file(
+                tile_path,
+                mimetype=utils.image_mimetype(ServerConfig.TILE_EXT),
+                conditional=True)
+            rv.cache_control.public = True
+            rv.cache_control.max_age = ServerConfig.TILE_MAX_AGE
+            return rv
+
+        return marshal(
+            response, api.models["generic_response"], skip_none=True), code
+
+
 @api.doc(params={"iid": "An id associated with an existing image"})
 @api.route("/<int:iid>/annotation")
 class ImageAnnotationList(Resource):
     @api.response(200, "OK", bulk_annotations)
     @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.param(
+        MASK_ENCODING_HEADER,
+        description="A comma separated list of acceptable mask encodings",
+        _in='header')
+    @api.param(
+        'mask-data',
+        description='A flag indicating whether mask data is required',
+        type='boolean')
     def get(self, iid):
         """
         Gets all the annotations associated with an image.
         """
+        encodings = utils.negotiate_mask_encodings(
+            request.headers.get(MASK_ENCODING_HEADER))
+        mask_data_flag = request.args.get('mask-data', 'true').lower() != "false"
 
-        query = "SELECT annotation_id, annotation_name, mask_path, info_path, class_name FROM instance_seg_meta "
-        query += "WHERE image_id = %s"
         try:
-            result = db.query(query, (iid,))[0]
+            result = db.query(ANNOTATION_QUERY, (iid,))[0]
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -356,20 +1087,7 @@ class ImageAnnotationList(Resource):
             }
             code = 500
         else:
-            response = []
-            for row in result:
-                mask = utils.load_mask(row["mask_path"])
-                info = utils.load_info(row["info_path"])
-                row["mask_data"] = utils.encode_mask(mask)
-
-                row["shape"] = info["source_shape"]
-                row["bbox"] = info["bbox"]
-
-                print("SERVER: outgoing bbox")
-                print("\t%s" % str(row["bbox"]))
-                response.append(row)
-
-            response = {"image_id": iid, "annotations": response}
+            response = {"image_id": iid, "annotations": _load_annotations(result, encodings, mask_data_flag)}
             code = 200
         if code == 200:
             return marshal(response, bulk_annotations, skip_none=True), code
@@ -388,73 +1106,108 @@ class ImageAnnotationList(Resource):
 
         content = request.json
 
-        query = "DELETE FROM instance_seg_meta WHERE image_id = %s"
-        try:
-            db.query(query, (iid,))
-        except BaseException:
-            pass
+        bundle_path = utils.annotation_bundle_path(iid)
 
-        i = 0
         code = 201
-        results = []
-        for row in content["annotations"]:
+        results = [None] * len(content["annotations"])
+        decoded = []
+        for i, row in enumerate(content["annotations"]):
             try:
-                mask = utils.decode_mask(row['mask_data'], row['shape'])
+                mask = utils.decode_mask(
+                    row['mask_data'],
+                    row['shape'],
+                    row.get('mask_encoding', DEFAULT_ENCODING))
 
                 print("SERVER: incoming bbox")
                 print("\t%s" % str(row["bbox"]))
-
-                mask_path = os.path.join(
-                    ServerConfig.DATA_ROOT_DIR,
-                    "annotation",
-                    str(iid),
-                    "trimaps",
-                    "%s.png" % row["name"])
-                info_path = os.path.join(
-                    ServerConfig.DATA_ROOT_DIR,
-                    "annotation",
-                    str(iid),
-                    "xmls",
-                    "%s.xml" % row["name"])
-
-                query = "REPLACE INTO instance_seg_meta (annotation_name, image_id, mask_path, info_path, class_name)"
-                query += " VALUES (%s,%s,%s,%s,%s)"
-                _, aid = db.query(
-                    query, (row['name'], iid, mask_path, info_path, row["class_name"]))
-
-                utils.save_mask(mask, mask_path)
-                utils.save_info(
-                    shape=row["shape"],
-                    bbox=row["bbox"],
-                    class_name=row["class_name"],
-                    filepath=info_path)
-                i += 1
-            except DatabaseError as e:
-                response = {
+            except BaseException as e:
+                results[i] = {
                     "action": "failed",
                     "error": {
-                        "code": 400,
-                        "message": e.msg
+                        "code": 500,
+                        "message": str(e)
                     }
                 }
-                results.append(response)
                 code = 200
-            except BaseException as e:
-                response = {
+            else:
+                decoded.append((i, row, mask))
+
+        # All masks and metadata for the image are written to one bundle file
+        annotation_cache.invalidate(bundle_path)
+        try:
+            annotation_bundle.write_bundle(bundle_path, [{
+                "name": row["name"],
+                "class_name": row["class_name"],
+                "bbox": row["bbox"],
+                "shape": row["shape"],
+                "mask": mask} for _, row, mask in decoded])
+        except BaseException as e:
+            for i, _, _ in decoded:
+                results[i] = {
                     "action": "failed",
                     "error": {
                         "code": 500,
                         "message": str(e)
                     }
                 }
-                results.append(response)
-                code = 200
-            else:
-                response = {
-                    "action": "created",
-                    "id": aid
+            decoded = []
+            code = 200
+
+        # The previous annotations are replaced in the same transaction as the new rows.
+        # A repeated name keeps its last annotation, as a per-row REPLACE would.
+        last = {row["name"]: n for n, (_, row, _) in enumerate(decoded)}
+        unique = [decoded[n] for n in sorted(last.values())]
+
+        query = "INSERT INTO instance_seg_meta (annotation_name, image_id, mask_path, info_path, class_name, "
+        query += ", ".join(utils.ANNOTATION_META_COLUMNS) + ") VALUES "
+        try:
+            with db.transaction() as tx:
+                tx.query("DELETE FROM instance_seg_meta WHERE image_id = %s", (iid,))
+                inserted = tx.insert_many(
+                    query, "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", [
+                        (row['name'], iid, bundle_path, bundle_path, row["class_name"]) +
+                        utils.annotation_meta_params(row["shape"], row["bbox"], mask)
+                        for _, row, mask in unique],
+                    "SELECT annotation_id, image_id, annotation_name FROM instance_seg_meta "
+                    "WHERE (image_id, annotation_name) IN ", (1, 0))
+
+            inserted = dict(zip((row["name"] for _, row, _ in unique), inserted))
+            for i, row, _ in decoded:
+                aid, e = inserted[row["name"]]
+                if e is None:
+                    results[i] = {
+                        "action": "created",
+                        "id": aid
+                    }
+                else:
+                    results[i] = {
+                        "action": "failed",
+                        "error": {
+                            "code": 400,
+                            "message": e.msg
+                        }
+                    }
+                    code = 200
+        except DatabaseError as e:
+            for i, _, _ in decoded:
+                results[i] = {
+                    "action": "failed",
+                    "error": {
+                        "code": 500,
+                        "message": e.msg
+                    }
+                }
+            code = 200
+        except BaseException as e:
+            for i, _, _ in decoded:
+                results[i] = {
+                    "action": "failed",
+                    "error": {
+                        "code": 500,
+                        "message": str(e)
+                    }
                 }
-                results.append(response)
+            code = 200
 
         return {"results": results}, code
 
@@ -468,6 +1221,7 @@ class ImageAnnotationList(Resource):
         query = "DELETE FROM instance_seg_meta WHERE image_id = %s"
         try:
             db.query(query, (iid,))
+            annotation_cache.invalidate(utils.annotation_bundle_path(iid))
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -493,3 +1247,58 @@ class ImageAnnotationList(Resource):
             }
             code = 200
         return response, code
+
+
+@api.doc(params={
+    "iid": "An id associated with an existing image",
+    "name": "The name of an annotation on the image"})
+@api.route("/<int:iid>/annotation/<string:name>/voc")
+class ImageAnnotationVoc(Resource):
+    @api.response(200, "OK")
+    @api.response(404, "Resource Not Found", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.produces(["application/xml"])
+    def get(self, iid, name):
+        """
+        Exports an annotation as a Pascal VOC XML document.
+        """
+        query = "SELECT annotation_name, mask_path, info_path, class_name, "
+        query += ", ".join(utils.ANNOTATION_META_COLUMNS)
+        query += " FROM instance_seg_meta "
+        query += "WHERE image_id = %s AND annotation_name = %s"
+
+        try:
+            result = db.query(query, (iid, name))[0]
+            xml = voc_export.export_voc_xml(iid, result[0])
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except IndexError:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 404,
+                    "message": "Resource not found."
+                }
+            }
+            code = 404
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            return Response(xml, status=200, mimetype="application/xml")
+
+        return marshal(
+            response, api.models["generic_response"], skip_none=True), code
@@ -1,20 +1,28 @@
-import base64
 import os
 from pathlib import Path
 
-import cv2
-import numpy as np
 from flask import request
-from flask_restplus import Namespace, Resource, fields
+from flask_restplus import Namespace, Resource, fields, marshal
 from mysql.connector.errors import DatabaseError
 
+import server.utils as utils
+from server.core import image_ingest
+from server.core import lock_leases
+from server.core import upload_session
+from server.core.image_listing import IMAGE_FIELD_COLUMNS
+from server.core.image_listing import ImageListing
 from server.core.common_dtos import common_store
+from server.core.upload_session import UploadError
 from server.server_config import DatabaseInstance
+from server.server_config import IngestPoolInstance
 from server.server_config import ServerConfig
+from server.server_config import ThumbnailPoolInstance
 
 api = Namespace('projects', description='Project related operations')
 
 db = DatabaseInstance()
+thumbnail_pool = ThumbnailPoolInstance()
+ingest_pool = IngestPoolInstance()
 
 api.models.update(common_store.get_dtos())
 
@@ -53,7 +61,72 @@ image_filter = api.model(
             order_by,
             required=True,
             default={},
-            description="An optional flag for ordering images")})
+            description="An optional flag for ordering images"),
+        'limit': fields.Integer(
+            required=False,
+            min=1,
+            max=ServerConfig.IMAGE_PAGE_SIZE_MAX,
+            default=ServerConfig.IMAGE_PAGE_SIZE,
+            description="The maximum number of images to return"),
+        'cursor': fields.String(
+            required=False,
+            description="The next_cursor of the previous page, omit for the first page"),
+        'fields': fields.List(
+            fields.String(enum=list(IMAGE_FIELD_COLUMNS)),
+            required=False,
+            description="Image fields to return inline with each id, omit for ids only")})
+
+image_summary = api.model('image_summary', {
+    'id': fields.Integer(
+        attribute='image_id',
+        required=True,
+        description='The image identifier'),
+    'name': fields.String(
+        attribute='image_name',
+        required=False,
+        description='The image name',
+        example="image_123"),
+    'ext': fields.String(
+        attribute='image_ext',
+        required=False,
+        description="The file extension of the image",
+        example=".jpg"),
+    'width': fields.Integer(
+        attribute='image_width',
+        required=False,
+        description="The width of the image in pixels"),
+    'height': fields.Integer(
+        attribute='image_height',
+        required=False,
+        description="The height of the image in pixels"),
+    'format': fields.String(
+        attribute='image_format',
+        required=False,
+        description="The format of the stored image",
+        example="jpeg"),
+    'is_locked': fields.Boolean(
+        required=False,
+        description="A flag indicating whether the image is locked"),
+    'is_labeled': fields.Boolean(
+        required=False,
+        description="A flag indicating whether the image is labeled")})
+
+image_page = api.model('image_page', {
+    'action': fields.String(
+        required=True,
+        enum=["read"],
+        description="The action performed"),
+    'ids': fields.List(
+        fields.Integer,
+        required=True,
+        description="The image identifiers on this page"),
+    'images': fields.List(
+        fields.Nested(image_summary, skip_none=True),
+        required=False,
+        description="The requested fields of each image on this page"),
+    'next_cursor': fields.String(
+        required=False,
+        description="The cursor of the next page, absent on the last page")})
 
 image_upload = api.model('image_upload', {
     'name': fields.String(required=True, description='The image name'),
@@ -65,6 +138,54 @@ bulk_image_upload = api.model('bulk_image_upload', {
     'images': fields.List(fields.Nested(image_upload), required=True)
 })
 
+claim_request = api.model('claim_request', {
+    'count': fields.Integer(
+        required=False,
+        default=1,
+        min=1,
+        max=ServerConfig.CLAIM_MAX_COUNT,
+        description="The number of images to claim")})
+
+claimed_images = api.model('claimed_images', {
+    'images': fields.List(
+        fields.Nested(image_summary, skip_none=True),
+        required=True,
+        description="The claimed images, empty when no unlocked, unlabeled images remain")})
+
+upload_file = api.model('upload_file', {
+    'name': fields.String(
+        required=True,
+        description="The file name of the upload",
+        example="image_123.jpg"),
+    'size': fields.Integer(
+        required=False,
+        description="The total size of the file in bytes"),
+    'received': fields.Integer(
+        required=True,
+        description="The number of bytes received so far"),
+    'state': fields.String(
+        required=True,
+        enum=[upload_session.UPLOADING, upload_session.CREATED, upload_session.FAILED],
+        description="The state of the upload"),
+    'id': fields.Integer(
+        required=False,
+        description="The identifier of the created image"),
+    'error': fields.Nested(
+        api.models["error_response"],
+        required=False,
+        skip_none=True,
+        description="An optional error message")})
+
+upload_session_model = api.model('upload_session', {
+    'session_id': fields.String(
+        required=True,
+        description="The upload session identifier"),
+    'project_id': fields.Integer(
+        required=True,
+        description="The project the upload session adds images to"),
+    'files': fields.List(fields.Nested(upload_file, skip_none=True))
+})
+
 
 @api.route("")
 class ProjectList(Resource):
@@ -91,38 +212,32 @@ class ProjectList(Resource):
         code = 201
         bulk_response = []
 
-        for row in content:
-            query = "INSERT INTO project (project_name) "
-            query += "VALUES (%s);"
+        query = "INSERT INTO project (project_name) VALUES "
 
-            try:
-                _, id = db.query(query, (row["name"],))
-            except DatabaseError as e:
+        try:
+            with db.transaction() as tx:
+                inserted = tx.insert_many(
+                    query, "(%s)", [(row["name"],) for row in content],
+                    "SELECT project_id, project_name FROM project WHERE (project_name) IN ", (0,))
+        except DatabaseError as e:
+            inserted = [(None, e)] * len(content)
+
+        for id, e in inserted:
+            if e is None:
                 result = {
-                    "action": "failed",
-                    "error": {
-                        "code": 500,
-                        "message": e.msg
-                    }
+                    "action": "created",
+                    "id": id
                 }
-                bulk_response.append(result)
-                code = 200
-            except BaseException as e:
+            else:
                 result = {
                     "action": "failed",
                     "error": {
                         "code": 500,
-                        "message": str(e)
+                        "message": e.msg
                     }
                 }
-                bulk_response.append(result)
                 code = 200
-            else:
-                result = {
-                    "action": "created",
-                    "id": id
-                }
-                bulk_response.append(result)
+            bulk_response.append(result)
 
         return {"results": bulk_response}, code
 
@@ -156,9 +271,10 @@ class Project(Resource):
         query = "DELETE FROM project WHERE project_id = %s"
         code = 200
         try:
-            db.query(q_delete_annotation, (pid,))
-            db.query(q_delete_images, (pid,))
-            db.query(query, (pid,))
+            with db.transaction() as tx:
+                tx.query(q_delete_annotation, (pid,))
+                tx.query(q_delete_images, (pid,))
+                tx.query(query, (pid,))
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -188,39 +304,29 @@ class Project(Resource):
 @api.doc(params={"pid": "An id associated with a project."})
 @api.route("/<int:pid>/images")
 class ProjectImageList(Resource):
-    @api.response(200, "OK", api.models['generic_response'])
+    @api.response(200, "OK", image_page)
+    @api.response(400, "Invalid Payload", api.models['generic_response'])
     @api.response(500, "Unexpected Failure", api.models['generic_response'])
-    @api.marshal_with(api.models['generic_response'], skip_none=True)
     @api.expect(image_filter)
     def get(self, pid):
         """
-        Get the images associated with the a project as referenced by its identifier.
+        Get a page of the images associated with a project as referenced by its identifier.
+        Further pages are requested by passing back the returned next_cursor.
         """
-        content = request.json
-
-        query = "SELECT image_id FROM fadb.image "
-        query += "WHERE project_fid = %s"
-
-        if "locked" in content:
-            query += " and is_locked = " + str(content["locked"])
-
-        if "labeled" in content:
-            query += " and is_labeled = " + str(content["labeled"])
-
-        valid_order_by = True
-        if content["order_by"]["key"] == "id":
-            query += " ORDER BY image_id"
-        elif content["order_by"]["key"] == "name":
-            query += " ORDER BY image_name"
-        else:
-            valid_order_by = False
-
-        if valid_order_by:
-            query += " asc" if content["order_by"]["ascending"] else " desc"
+        try:
+            listing = ImageListing(pid, request.json or {})
+        except ValueError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": str(e)
+                }
+            }
+            return marshal(response, api.models['generic_response'], skip_none=True), 400
 
-        code = 200
         try:
-            results, _ = db.query(query, (pid,))
+            results, _ = db.query(listing.query, listing.params)
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -229,7 +335,7 @@ class ProjectImageList(Resource):
                     "message": e.msg
                 }
             }
-            code = 500
+            return marshal(response, api.models['generic_response'], skip_none=True), 500
         except BaseException as e:
             response = {
                 "action": "failed",
@@ -238,13 +344,10 @@ class ProjectImageList(Resource):
                     "message": str(e)
                 }
             }
-            code = 500
-        else:
-            response = {
-                "action": "read",
-                "ids": [row['image_id'] for row in results]
-            }
-        return response, code
+            return marshal(response, api.models['generic_response'], skip_none=True), 500
+
+        response = listing.page(results)
+        return marshal(response, image_page, skip_none=True), 200
 
     @api.response(200, "Partial Success", api.models['bulk_response'])
     @api.response(201, "Success", api.models['bulk_response'])
@@ -259,70 +362,83 @@ class ProjectImageList(Resource):
         code = 201
 
         success_count = 0
-        bulk_response = []
-        for row in content:
-            array = np.fromstring(
-                base64.b64decode(
-                    row["image_data"]),
-                np.uint8)
-            img = cv2.imdecode(array, cv2.IMREAD_COLOR)
-            img_dir = os.path.join(
-                ServerConfig.DATA_ROOT_DIR,
-                "images",
-                str(pid))
-            Path(img_dir).mkdir(parents=True, exist_ok=True)
-            img_path = os.path.join(
-                img_dir,
-                row["name"] +
-                ServerConfig.DEFAULT_IMAGE_EXT)
-
-            query = "INSERT INTO image (project_fid, image_path, image_name, image_ext) "
-            query += "VALUES (%s, %s, %s, %s);"
+        bulk_response = [None] * len(content)
+        img_dir = utils.project_image_dir(pid)
+        Path(img_dir).mkdir(parents=True, exist_ok=True)
+
+        # Decoding, hashing and thumbnailing is spread over the ingest processes
+        jobs = [ingest_pool.submit(
+            image_ingest.ingest_image,
+            row["image_data"], img_dir, row["name"], ServerConfig.TRANSCODE_UPLOADS)
+            for row in content]
+
+        staged = []
+        for i, job in enumerate(jobs):
             try:
-                _, id = db.query(
-                    query, (pid, img_path, row["name"], ServerConfig.DEFAULT_IMAGE_EXT))
-                cv2.imwrite(img_path, img)
-            except DatabaseError as e:
-                response = {
+                staged.append((i, job.result()))
+            except ValueError as e:
+                bulk_response[i] = {
                     "action": "failed",
                     "error": {
-                        "code": 500,
-                        "message": e.msg
+                        "code": 400,
+                        "message": str(e)
                     }
                 }
-                code = 200
             except BaseException as e:
-                response = {
+                bulk_response[i] = {
                     "action": "failed",
                     "error": {
                         "code": 500,
                         "message": str(e)
                     }
                 }
-                code = 200
-            else:
-                response = {
-                    "action": "created",
-                    "id": id
-                }
-                success_count += 1
-            bulk_response.append(response)
 
-        # Increment unlabeled image count
-        if success_count > 0:
-            query = "UPDATE project SET unlabeled_count = unlabeled_count + %s WHERE project_id = %s"
-            try:
-                db.query(query, (success_count, pid))
-            except DatabaseError as e:
-                response = {
+        # Rows, files and the unlabeled image count are committed together
+        try:
+            with db.transaction() as tx:
+                inserted = insert_images(tx, pid, [meta for _, meta in staged])
+                for (i, meta), (id, error) in zip(staged, inserted):
+                    if error is None:
+                        try:
+                            image_ingest.publish_image(meta, id)
+                        except BaseException as e:
+                            tx.query("DELETE FROM image WHERE image_id = %s", (id,))
+                            error = {"code": 500, "message": str(e)}
+                    if error is None:
+                        bulk_response[i] = {
+                            "action": "created",
+                            "id": id
+                        }
+                        success_count += 1
+                    else:
+                        image_ingest.discard_image(meta)
+                        bulk_response[i] = {
+                            "action": "failed",
+                            "error": error
+                        }
+
+                if success_count > 0:
+                    query = "UPDATE project SET unlabeled_count = unlabeled_count + %s WHERE project_id = %s"
+                    tx.query(query, (success_count, pid))
+        except BaseException as e:
+            message = e.msg if isinstance(e, DatabaseError) else str(e)
+            for i, meta in staged:
+                if bulk_response[i] is not None and bulk_response[i]["action"] == "created":
+                    image_ingest.unpublish_image(meta, bulk_response[i]["id"])
+                else:
+                    image_ingest.discard_image(meta)
+                bulk_response[i] = {
                     "action": "failed",
                     "error": {
                         "code": 500,
-                        "message": e.msg
+                        "message": message
                     }
                 }
-                bulk_response.append(response)
-                code = 200
+            success_count = 0
+
+        if success_count < len(content):
+            code = 200
+
         return {"results": bulk_response}, code
 
     @api.response(200, "OK", api.models['generic_response'])
@@ -340,9 +456,10 @@ class ProjectImageList(Resource):
         query = "DELETE FROM image WHERE project_fid = %s"
 
         try:
-            results, _ = db.query(q_get_image_ids, (pid,))
-            db.query(q_delete_annotations, (pid,))
-            db.query(query, (pid,))
+            with db.transaction() as tx:
+                results, _ = tx.query(q_get_image_ids, (pid,))
+                tx.query(q_delete_annotations, (pid,))
+                tx.query(query, (pid,))
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -369,3 +486,331 @@ class ProjectImageList(Resource):
             code = 200
 
         return response, code
+
+
+@api.doc(params={"pid": "An id associated with a project."})
+@api.route("/<int:pid>/claim")
+class ProjectImageClaim(Resource):
+    @api.response(200, "OK", claimed_images)
+    @api.response(400, "Invalid Payload", api.models['generic_response'])
+    @api.response(500, "Unexpected Failure", api.models['generic_response'])
+    @api.param(ServerConfig.LOCK_OWNER_HEADER, "The client taking the locks", _in="header")
+    @api.expect(claim_request)
+    def post(self, pid):
+        """
+        Atomically lock and return the next unlocked, unlabeled images of a project, in name order.
+        """
+        content = request.json or {}
+        count = content.get("count", 1)
+        if not isinstance(count, int) or not 1 <= count <= ServerConfig.CLAIM_MAX_COUNT:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": "The count must be between 1 and %d." % ServerConfig.CLAIM_MAX_COUNT
+                }
+            }
+            return marshal(response, api.models['generic_response'], skip_none=True), 400
+
+        # Rows being claimed by a concurrent request are skipped rather than waited on
+        query = "SELECT image_id, image_name, image_ext, image_width, image_height, image_format, "
+        query += "is_locked, is_labeled FROM image "
+        query += "WHERE project_fid = %s AND is_labeled = 0 AND is_locked = 0 "
+        query += "ORDER BY image_name, image_id LIMIT %s FOR UPDATE SKIP LOCKED"
+
+        try:
+            with db.transaction() as tx:
+                results, _ = tx.query(query, (pid, count))
+                if results:
+                    ids = [row["image_id"] for row in results]
+                    q_lock = "UPDATE image SET " + lock_leases.LOCK_ASSIGNMENTS
+                    q_lock += " WHERE image_id IN (%s) AND is_locked = 0" % ",".join(["%s"] * len(ids))
+                    tx.query(q_lock, lock_leases.lock_params(lock_leases.request_owner()) + tuple(ids))
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            return marshal(response, api.models['generic_response'], skip_none=True), 500
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            return marshal(response, api.models['generic_response'], skip_none=True), 500
+
+        for row in results:
+            row["is_locked"] = True
+        return marshal({"images": results}, claimed_images), 200
+
+
+@api.doc(params={"pid": "An id associated with a project."})
+@api.route("/<int:pid>/uploads")
+class ProjectUploadList(Resource):
+    @api.response(201, "Success", upload_session_model)
+    @api.response(500, "Unexpected Failure", api.models['generic_response'])
+    def post(self, pid):
+        """
+        Start a resumable upload session for adding images to a project.
+        """
+        try:
+            session = upload_session.create_session(pid)
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            return marshal(response, api.models['generic_response'], skip_none=True), 500
+        session["files"] = []
+        return marshal(session, upload_session_model, skip_none=True), 201
+
+
+@api.doc(params={
+    "pid": "An id associated with a project.",
+    "sid": "An id associated with an upload session."})
+@api.route("/<int:pid>/uploads/<string:sid>")
+class ProjectUpload(Resource):
+    @api.response(200, "OK", upload_session_model)
+    @api.response(404, "Resource Not Found", api.models['generic_response'])
+    def get(self, pid, sid):
+        """
+        Get the progress and result of every file in an upload session.
+        """
+        try:
+            session = upload_session.load_session(sid, pid)
+        except UploadError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": e.code,
+                    "message": e.message
+                }
+            }
+            return marshal(response, api.models['generic_response'], skip_none=True), e.code
+        return marshal(session, upload_session_model, skip_none=True), 200
+
+    @api.response(200, "OK", api.models['generic_response'])
+    @api.response(404, "Resource Not Found", api.models['generic_response'])
+    @api.marshal_with(api.models['generic_response'], skip_none=True)
+    def delete(self, pid, sid):
+        """
+        Abandon an upload session, discarding any partially received files.
+        """
+        try:
+            upload_session.check_session(sid, pid)
+            upload_session.delete_session(sid)
+        except UploadError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": e.code,
+                    "message": e.message
+                }
+            }
+            return response, e.code
+        return {"action": "deleted"}, 200
+
+
+@api.doc(params={
+    "pid": "An id associated with a project.",
+    "sid": "An id associated with an upload session."})
+@api.route("/<int:pid>/uploads/<string:sid>/files")
+class ProjectUploadFileList(Resource):
+    @api.response(200, "Partial Success", api.models['bulk_response'])
+    @api.response(201, "Success", api.models['bulk_response'])
+    @api.response(404, "Resource Not Found", api.models['generic_response'])
+    @api.marshal_with(api.models['bulk_response'], skip_none=True)
+    def post(self, pid, sid):
+        """
+        Upload images to an upload session as multipart/form-data, one file per 'images' part.
+        """
+        try:
+            upload_session.check_session(sid, pid)
+        except UploadError as e:
+            return {"results": [{
+                "action": "failed",
+                "error": {
+                    "code": e.code,
+                    "message": e.message
+                }
+            }]}, e.code
+
+        code = 201
+        bulk_response = []
+        # Werkzeug reads the whole body, spooling large parts to temporary files, before
+        # this loop runs. Send large files to the chunked PUT route to stream them.
+        for storage in request.files.getlist("images"):
+            name = storage.filename
+            with upload_session.file_lock(sid, name):
+                try:
+                    state = upload_session.file_state(sid, name)
+                    if state["state"] == upload_session.FAILED:
+                        state = upload_session.restart_file(sid, name)
+                    if state["state"] != upload_session.UPLOADING:
+                        raise UploadError("File '%s' has already been uploaded." % name, 409)
+                    filepath = upload_session.part_path(sid, name)
+                    storage.save(filepath)
+                    size = os.path.getsize(filepath)
+                    upload_session.set_file_state(sid, name, size=size, received=size)
+                except UploadError as e:
+                    response = {
+                        "action": "failed",
+                        "error": {
+                            "code": e.code,
+                            "message": e.message
+                        }
+                    }
+                else:
+                    state, _ = complete_upload(pid, sid, name)
+                    if state["state"] == upload_session.CREATED:
+                        response = {
+                            "action": "created",
+                            "id": state["id"]
+                        }
+                    else:
+                        response = {
+                            "action": "failed",
+                            "error": state["error"]
+                        }
+
+            if response["action"] == "failed":
+                code = 200
+            bulk_response.append(response)
+
+        return {"results": bulk_response}, code
+
+
+@api.doc(params={
+    "pid": "An id associated with a project.",
+    "sid": "An id associated with an upload session.",
+    "name": "The file name of the image, including its extension."})
+@api.route("/<int:pid>/uploads/<string:sid>/files/<string:name>")
+class ProjectUploadFile(Resource):
+    @api.response(200, "Chunk Received", upload_file)
+    @api.response(201, "Upload Complete", upload_file)
+    @api.response(400, "Invalid Payload", api.models['generic_response'])
+    @api.response(404, "Resource Not Found", api.models['generic_response'])
+    @api.response(409, "Unexpected Offset", api.models['generic_response'])
+    @api.param(
+        'Content-Range',
+        description="The byte range of this chunk as 'bytes start-end/total'. "
+                    "Omit to send the whole file at once.",
+        _in='header')
+    def put(self, pid, sid, name):
+        """
+        Upload an image, or the next chunk of one, to an upload session.
+        """
+        try:
+            upload_session.check_session(sid, pid)
+            start, total = upload_session.parse_content_range(
+                request.headers.get("Content-Range"), request.content_length)
+            with upload_session.file_lock(sid, name):
+                state = upload_session.write_chunk(
+                    sid, name, request.stream, start, total)
+                code = 200
+                if state["received"] == state["size"]:
+                    state, code = complete_upload(pid, sid, name)
+        except UploadError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": e.code,
+                    "message": e.message
+                }
+            }
+            return marshal(response, api.models['generic_response'], skip_none=True), e.code
+        return marshal(state, upload_file, skip_none=True), code
+
+    @api.response(200, "OK", upload_file)
+    @api.response(404, "Resource Not Found", api.models['generic_response'])
+    def get(self, pid, sid, name):
+        """
+        Get the progress of a single file, including the offset to resume from.
+        """
+        try:
+            upload_session.check_session(sid, pid)
+            state = upload_session.file_state(sid, name)
+        except UploadError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": e.code,
+                    "message": e.message
+                }
+            }
+            return marshal(response, api.models['generic_response'], skip_none=True), e.code
+        return marshal(state, upload_file, skip_none=True), 200
+
+
+def insert_images(tx, pid, metas):
+    """
+    Register staged images with a project using multi-row inserts.
+    :param tx: The transaction to insert the rows in
+    :param metas: A list of image meta dicts as returned by image_ingest.ingest_image
+    :return: A list of (image id, error) tuples in the order of metas
+    """
+    query = "INSERT INTO image (project_fid, image_path, image_name, image_ext, "
+    query += "image_width, image_height, image_format) VALUES "
+    inserted = tx.insert_many(query, "(%s, %s, %s, %s, %s, %s, %s)", [
+        (pid, meta["path"], meta["name"], meta["ext"],
+         meta["width"], meta["height"], meta["format"]) for meta in metas],
+        "SELECT image_id, image_path FROM image WHERE (image_path) IN ", (1,))
+    return [(id, None if e is None else {"code": 500, "message": e.msg})
+            for id, e in inserted]
+
+
+def complete_upload(pid, sid, name):
+    """
+    Move a fully received upload into the project and register it as an image.
+    :return: A tuple of (file state, http status code)
+    """
+    filepath = upload_session.part_path(sid, name)
+    image_name = os.path.splitext(os.path.basename(name))[0]
+
+    query = "INSERT INTO image (project_fid, image_path, image_name, image_ext, "
+    query += "image_width, image_height, image_format) "
+    query += "VALUES (%s, %s, %s, %s, %s, %s, %s);"
+
+    try:
+        if ServerConfig.TRANSCODE_UPLOADS:
+            with open(filepath, "rb") as f:
+                data, meta = utils.transcode_image(
+                    f.read(), ServerConfig.DEFAULT_IMAGE_EXT)
+            utils.write_file_atomic(filepath, data)
+        else:
+            meta = utils.sniff_image(upload_session.read_header(sid, name))
+
+        img_dir = utils.project_image_dir(pid)
+        Path(img_dir).mkdir(parents=True, exist_ok=True)
+        img_path = os.path.join(img_dir, image_name + meta["ext"])
+
+        with db.transaction() as tx:
+            _, id = tx.query(query, (
+                pid, img_path, image_name, meta["ext"],
+                meta["width"], meta["height"], meta["format"]))
+            tx.query(
+                "UPDATE project SET unlabeled_count = unlabeled_count + 1 WHERE project_id = %s",
+                (pid,))
+            os.replace(filepath, img_path)
+    except ValueError as e:
+        error = {"code": 400, "message": str(e)}
+    except DatabaseError as e:
+        error = {"code": 500, "message": e.msg}
+    except BaseException as e:
+        error = {"code": 500, "message": str(e)}
+    else:
+        thumbnail_pool.submit(utils.save_thumbnail, img_path, id)
+        return upload_session.set_file_state(
+            sid, name, state=upload_session.CREATED, id=id), 201
+
+    return upload_session.set_file_state(
+        sid, name, state=upload_session.FAILED, error=error), error["code"]
@@ -0,0 +1,101 @@
+from flask_restplus import Namespace, Resource, fields
+
+from server.core.common_dtos import common_store
+from server.server_config import AnnotationCacheInstance
+from server.server_config import DatabaseInstance
+
+api = Namespace('stats', description='Server statistics')
+
+annotation_cache = AnnotationCacheInstance()
+db = DatabaseInstance()
+
+api.models.update(common_store.get_dtos())
+
+cache_stats = api.model('cache_stats', {
+    'hits': fields.Integer(
+        required=True,
+        description="The number of lookups served from the cache"),
+    'misses': fields.Integer(
+        required=True,
+        description="The number of lookups not found in the cache"),
+    'evictions': fields.Integer(
+        required=True,
+        description="The number of entries evicted to stay within the memory budget"),
+    'invalidations': fields.Integer(
+        required=True,
+        description="The number of entries dropped because their source changed"),
+    'entries': fields.Integer(
+        required=True,
+        description="The number of entries currently cached"),
+    'bytes': fields.Integer(
+        required=True,
+        description="The size of the cached payloads in bytes"),
+    'max_bytes': fields.Integer(
+        required=True,
+        description="The memory budget of the cache in bytes"),
+    'hit_rate': fields.Float(
+        required=True,
+        description="The fraction of lookups served from the cache")})
+
+pool_stats = api.model('pool_stats', {
+    'size': fields.Integer(
+        required=True,
+        description="The number of connections the pool holds"),
+    'in_use': fields.Integer(
+        required=True,
+        description="The number of connections currently checked out"),
+    'idle': fields.Integer(
+        required=True,
+        description="The number of open connections waiting to be checked out"),
+    'peak_in_use': fields.Integer(
+        required=True,
+        description="The largest number of connections checked out at once"),
+    'checkouts': fields.Integer(
+        required=True,
+        description="The number of connections handed out"),
+    'waits': fields.Integer(
+        required=True,
+        description="The number of checkouts which had to wait for a connection"),
+    'timeouts': fields.Integer(
+        required=True,
+        description="The number of checkouts which gave up waiting"),
+    'reconnects': fields.Integer(
+        required=True,
+        description="The number of stale connections reconnected by the health check"),
+    'mean_wait_time': fields.Float(
+        required=True,
+        description="The mean time in seconds spent waiting for a connection"),
+    'max_wait_time': fields.Float(
+        required=True,
+        description="The longest time in seconds spent waiting for a connection"),
+    'mean_checkout_time': fields.Float(
+        required=True,
+        description="The mean time in seconds a connection was held"),
+    'max_checkout_time': fields.Float(
+        required=True,
+        description="The longest time in seconds a connection was held"),
+    'saturation': fields.Float(
+        required=True,
+        description="The fraction of checkouts which found no free connection")})
+
+
+@api.route("/annotation-cache")
+class AnnotationCacheStats(Resource):
+    @api.response(200, "OK", cache_stats)
+    @api.marshal_with(cache_stats)
+    def get(self):
+        """
+        Get the hit, miss and eviction counters of the encoded annotation cache.
+        """
+        return annotation_cache.stats(), 200
+
+
+@api.route("/database-pool")
+class DatabasePoolStats(Resource):
+    @api.response(200, "OK", pool_stats)
+    @api.marshal_with(pool_stats)
+    def get(self):
+        """
+        Get the wait time, checkout duration and saturation of the database connection pool.
+        """
+        return db.db_pool.stats(), 200
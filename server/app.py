@@ -1,10 +1,19 @@
 from flask import Flask
+from werkzeug.serving import WSGIRequestHandler
 
 from server.apis import api
+from server.core.lock_leases import LockReaper
+from server.server_config import DatabaseInstance
 
 app = Flask(__name__)
 app.config['RESTPLUS_VALIDATE'] = True
 app.config['RESTPLUS_MASK_SWAGGER'] = False
 
 api.init_app(app)
+
+lock_reaper = LockReaper(DatabaseInstance())
+lock_reaper.start()
+
+# Keep connections alive between requests, the client pools and reuses them
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
 app.run(debug=True)
@@ -0,0 +1,140 @@
+"""
+A single file container holding every annotation of an image.
+
+Layout:
+    8 bytes     magic (b"FABNDL01")
+    4 bytes     big endian length of the JSON index
+    N bytes     JSON index, a list of annotation metadata including the offset
+                and length of each mask blob relative to the end of the index
+    ...         mask blobs, bbox cropped single channel PNGs (see utils.encode_mask_png)
+
+The whole bundle can be read in one sequential pass, while a single annotation
+can be fetched by name by reading only the index and its blob.
+"""
+import json
+import os
+import struct
+from pathlib import Path
+
+import server.utils as utils
+from server.server_config import ServerConfig
+
+BUNDLE_MAGIC = b"FABNDL01"
+_HEADER = struct.Struct(">8sI")
+
+# Metadata fields persisted in the index for every annotation
+META_FIELDS = ("name", "class_name", "bbox", "shape")
+
+
+class BundleError(Exception):
+    pass
+
+
+def write_bundle(filepath, annotations):
+    """
+    Atomically write a bundle.
+    :param filepath: The destination path
+    :param annotations: A list of dicts containing META_FIELDS and a boolean 'mask'
+    """
+    index = []
+    blobs = []
+    offset = 0
+    for row in annotations:
+        blob = utils.encode_mask_png(row["mask"])
+        entry = {key: _to_json(row[key]) for key in META_FIELDS}
+        entry["offset"] = offset
+        entry["length"] = len(blob)
+        index.append(entry)
+        blobs.append(blob)
+        offset += len(blob)
+
+    index_bytes = json.dumps(index).encode("utf-8")
+    data = b"".join(
+        [_HEADER.pack(BUNDLE_MAGIC, len(index_bytes)), index_bytes] + blobs)
+
+    Path(os.path.dirname(filepath)).mkdir(parents=True, exist_ok=True)
+    utils.write_file_atomic(filepath, data)
+
+
+def read_bundle(filepath):
+    """
+    Read every annotation in a bundle.
+    :return: A dict of annotation name -> annotation dict with a decoded 'mask'
+    """
+    with open(filepath, "rb") as f:
+        data = f.read()
+
+    index, start = _parse_index(data, filepath)
+    annotations = {}
+    for entry in index:
+        blob = data[start + entry["offset"]:start + entry["offset"] + entry["length"]]
+        annotations[entry["name"]] = _load_entry(entry, blob)
+    return annotations
+
+
+def read_bundle_entry(filepath, name):
+    """
+    Read a single annotation from a bundle by name.
+    :return: The annotation dict, or None if the bundle has no such annotation
+    """
+    with open(filepath, "rb") as f:
+        magic, index_length = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != BUNDLE_MAGIC:
+            raise BundleError("%s is not an annotation bundle." % filepath)
+        index = json.loads(f.read(index_length).decode("utf-8"))
+        start = _HEADER.size + index_length
+        for entry in index:
+            if entry["name"] == name:
+                f.seek(start + entry["offset"])
+                return _load_entry(entry, f.read(entry["length"]))
+    return None
+
+
+def read_bundle_entry_meta(filepath, name):
+    """
+    Read the metadata of a single annotation without decoding its mask.
+    :return: The index entry, or None if the bundle has no such annotation
+    """
+    for entry in read_bundle_index(filepath):
+        if entry["name"] == name:
+            return entry
+    return None
+
+
+def read_bundle_index(filepath):
+    """
+    Read only the metadata of the annotations in a bundle.
+    """
+    with open(filepath, "rb") as f:
+        magic, index_length = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != BUNDLE_MAGIC:
+            raise BundleError("%s is not an annotation bundle." % filepath)
+        index = json.loads(f.read(index_length).decode("utf-8"))
+    return index
+
+
+def is_bundle_path(filepath):
+    return filepath.endswith(ServerConfig.ANNOTATION_BUNDLE_EXT)
+
+
+def _parse_index(data, filepath):
+    if len(data) < _HEADER.size:
+        raise BundleError("%s is not an annotation bundle." % filepath)
+    magic, index_length = _HEADER.unpack_from(data)
+    if magic != BUNDLE_MAGIC:
+        raise BundleError("%s is not an annotation bundle." % filepath)
+    start = _HEADER.size + index_length
+    index = json.loads(data[_HEADER.size:start].decode("utf-8"))
+    return index, start
+
+
+def _load_entry(entry, blob):
+    annotation = {key: entry[key] for key in META_FIELDS}
+    annotation["mask"] = utils.expand_mask(*utils.decode_mask_png(blob))
+    return annotation
+
+
+def _to_json(value):
+    if isinstance(value, (list, tuple)):
+        return [int(x) for x in value]
+    return value
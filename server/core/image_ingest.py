@@ -0,0 +1,85 @@
+"""
+CPU bound work for adding uploaded images to a project, run in a process pool.
+
+Workers decode, sniff or transcode, hash and thumbnail each image and stage it
+next to its final path. The request handler then registers every staged image
+with the database in one batch and moves the successful ones into place, so
+an image is never visible on disk without a row, nor overwritten by an upload
+whose insert failed.
+"""
+import base64
+import io
+import os
+import uuid
+
+import server.utils as utils
+from server.server_config import ServerConfig
+
+STAGING_EXT = ".ingest"
+
+
+def ingest_image(image_data, img_dir, name, transcode):
+    """
+    Prepare a single base64 encoded upload. Runs in a worker process.
+    :param image_data: The base64 encoded image
+    :param img_dir: The project image directory
+    :param name: The image name, without an extension
+    :param transcode: Whether to re-encode the image as ServerConfig.DEFAULT_IMAGE_EXT
+    :return: A dict holding the image meta, final and staged paths, content hash and thumbnail
+    :raises ValueError: If the image is not a supported format
+    """
+    data = base64.b64decode(image_data)
+    if transcode:
+        data, meta = utils.transcode_image(data, ServerConfig.DEFAULT_IMAGE_EXT)
+    else:
+        meta = utils.sniff_image(data)
+
+    img_path = os.path.join(img_dir, name + meta["ext"])
+    staged_path = "%s.%s%s" % (img_path, uuid.uuid4().hex, STAGING_EXT)
+    with open(staged_path, "wb") as f:
+        f.write(data)
+
+    try:
+        thumbnail = utils.create_thumbnail(data)
+    except BaseException:
+        # Thumbnails are regenerated on demand, so this does not fail the upload
+        thumbnail = None
+
+    meta.update({
+        "name": name,
+        "path": img_path,
+        "staged_path": staged_path,
+        "hash": utils.content_hash(io.BytesIO(data)),
+        "thumbnail": thumbnail
+    })
+    return meta
+
+
+def publish_image(meta, iid):
+    """
+    Move a staged image to its final path and store its thumbnail.
+    """
+    os.replace(meta["staged_path"], meta["path"])
+    utils.remember_file_etag(meta["path"], meta["hash"])
+    if meta["thumbnail"] is not None:
+        filepath = utils.thumbnail_path(iid)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        utils.write_file_atomic(filepath, meta["thumbnail"])
+
+
+def unpublish_image(meta, iid):
+    """
+    Remove a published image after the transaction registering it was rolled back.
+    """
+    for filepath in (meta["path"], utils.thumbnail_path(iid)):
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+
+def discard_image(meta):
+    try:
+        os.remove(meta["staged_path"])
+    except OSError:
+        pass
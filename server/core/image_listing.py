@@ -0,0 +1,83 @@
+"""
+Builds the keyset paginated query behind the project image listing.
+
+Every query shape produced here is meant to be answered from one of the image
+listing indexes without a filesort, see database/migrations/0004_image_listing_indexes.sql
+and `python -m server.tools.explain_listing`.
+"""
+from server.core import pagination
+from server.server_config import ServerConfig
+
+# Image fields which may be selected in a project image listing
+IMAGE_FIELD_COLUMNS = {
+    "name": "image_name",
+    "ext": "image_ext",
+    "width": "image_width",
+    "height": "image_height",
+    "format": "image_format",
+    "is_locked": "is_locked",
+    "is_labeled": "is_labeled"
+}
+
+
+class ImageListing:
+    """
+    A page request against the images of a project.
+    :raises ValueError: If the ordering, limit, fields or cursor are invalid
+    """
+
+    def __init__(self, pid, content):
+        order = content.get("order_by") or {}
+        self.ascending = order.get("ascending", True)
+        self.limit = content.get("limit", ServerConfig.IMAGE_PAGE_SIZE)
+
+        key = order.get("key", "id")
+        if key not in ServerConfig.IMAGE_ORDER_BY_MAP:
+            raise ValueError("Unknown ordering '%s'." % key)
+        self.columns = ServerConfig.IMAGE_ORDER_BY_MAP[key]
+
+        if not isinstance(self.limit, int) or not 1 <= self.limit <= ServerConfig.IMAGE_PAGE_SIZE_MAX:
+            raise ValueError("The limit must be between 1 and %d." % ServerConfig.IMAGE_PAGE_SIZE_MAX)
+
+        self.selected = []
+        for field in content.get("fields") or []:
+            if field not in IMAGE_FIELD_COLUMNS:
+                raise ValueError("Unknown image field '%s'." % field)
+            self.selected.append(IMAGE_FIELD_COLUMNS[field])
+
+        query = "SELECT " + ", ".join(sorted(set(("image_id",) + self.columns + tuple(self.selected))))
+        query += " FROM image WHERE project_fid = %s"
+        params = [pid]
+        for key, filters in ServerConfig.IMAGE_FILTER_MAP.items():
+            if content.get(key) is not None:
+                query += " AND " + filters[bool(content[key])]
+
+        if content.get("cursor"):
+            values = pagination.decode_cursor(content["cursor"], len(self.columns))
+            condition, condition_params = pagination.keyset_condition(self.columns, self.ascending)
+            query += " AND " + condition
+            params.extend(condition_params(values))
+
+        direction = " ASC" if self.ascending else " DESC"
+        query += " ORDER BY " + ", ".join(c + direction for c in self.columns)
+        # One extra row tells whether there is another page
+        query += " LIMIT %s"
+        params.append(self.limit + 1)
+
+        self.query = query
+        self.params = tuple(params)
+
+    def page(self, results):
+        """
+        Build the response for the rows returned by the query.
+        """
+        response = {
+            "action": "read",
+            "ids": [row['image_id'] for row in results[:self.limit]]
+        }
+        if self.selected:
+            response["images"] = results[:self.limit]
+        if len(results) > self.limit:
+            last = results[self.limit - 1]
+            response["next_cursor"] = pagination.encode_cursor([last[c] for c in self.columns])
+        return response
@@ -0,0 +1,99 @@
+"""
+Builds the set based UPDATE statements behind the bulk image update.
+
+Patches are grouped by the fields they set, and every group is applied with one
+UPDATE over its ids. Fields whose value differs between the images of a group
+are set with a CASE on the image id. Locking and unlocking follow the lease rules
+of a single image update, they never take or end another client's live lease.
+"""
+from server.core import lock_leases
+
+# Image fields which may be patched in bulk, is_locked is handled as a lease
+IMAGE_UPDATE_COLUMNS = {
+    "name": "image_name",
+    "ext": "image_ext",
+    "is_labeled": "is_labeled"
+}
+
+
+def merge_patches(patches):
+    """
+    :param patches: A list of dicts holding an image id and the fields to set
+    :return: An ordered dict of image id -> fields to set, later patches to the
+             same image override earlier ones
+    """
+    merged = {}
+    for patch in patches:
+        fields = merged.setdefault(int(patch["id"]), {})
+        fields.update({k: v for k, v in patch.items() if k != "id"})
+    return merged
+
+
+def lease_query(ids, owner):
+    """
+    Select the given images, locking their rows, with whether the owner may lock and
+    unlock each of them. Read in the same transaction as the updates it guards.
+    :return: A tuple of (query, params)
+    """
+    query = "SELECT image_id, %s AS lockable, %s AS unlockable FROM image " % (
+        lock_leases.LOCKABLE_CONDITION, lock_leases.UNLOCKABLE_CONDITION)
+    query += "WHERE image_id IN (%s) FOR UPDATE" % ",".join(["%s"] * len(ids))
+    return query, (owner, owner) + tuple(ids)
+
+
+def lease_conflict(fields, row):
+    """
+    :param fields: The fields a patch sets
+    :param row: The image's row from lease_query
+    :return: True if the patch would take or end a lease held by another client
+    """
+    if "is_locked" not in fields:
+        return False
+    if fields["is_locked"]:
+        return not row["lockable"]
+    return not row["unlockable"]
+
+
+def build_updates(merged, owner):
+    """
+    :param merged: The result of merge_patches, every patch must set at least one field
+    :param owner: The client making the update, patches which lock or unlock an image
+                  only apply where the owner may take or end its lease
+    :return: A list of (ids, query, params), one per combination of fields
+    """
+    groups = {}
+    for iid, fields in merged.items():
+        columns = tuple(sorted(k for k in fields if k in IMAGE_UPDATE_COLUMNS))
+        locked = bool(fields["is_locked"]) if "is_locked" in fields else None
+        groups.setdefault((columns, locked), []).append(iid)
+
+    updates = []
+    for (columns, locked), ids in groups.items():
+        assignments = []
+        params = []
+        for field in columns:
+            values = [merged[iid][field] for iid in ids]
+            if all(v == values[0] for v in values):
+                assignments.append(IMAGE_UPDATE_COLUMNS[field] + " = %s")
+                params.append(values[0])
+            else:
+                assignments.append("%s = CASE image_id %s END" % (
+                    IMAGE_UPDATE_COLUMNS[field], " ".join(["WHEN %s THEN %s"] * len(ids))))
+                for iid, value in zip(ids, values):
+                    params.extend((iid, value))
+        condition = ""
+        if locked is True:
+            assignments.append(lock_leases.LOCK_ASSIGNMENTS)
+            params.extend(lock_leases.lock_params(owner))
+            condition = " AND " + lock_leases.LOCKABLE_CONDITION
+        elif locked is False:
+            assignments.append(lock_leases.UNLOCK_ASSIGNMENTS)
+            condition = " AND " + lock_leases.UNLOCKABLE_CONDITION
+
+        query = "UPDATE image SET " + ", ".join(assignments)
+        query += " WHERE image_id IN (%s)" % ",".join(["%s"] * len(ids)) + condition
+        params.extend(ids)
+        if condition:
+            params.append(owner)
+        updates.append((ids, query, tuple(params)))
+    return updates
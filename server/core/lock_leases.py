@@ -0,0 +1,74 @@
+"""
+Image locks held as leases.
+
+A lock records the client holding it and when it expires. Clients renew the
+leases of the images they have open with a periodic heartbeat, and a reaper
+thread releases every expired lease with a single UPDATE over lock_expires_idx,
+so the locks of a client which crashed or lost its connection are freed without
+anyone having to unlock them.
+"""
+from threading import Event, Thread
+
+from flask import request
+
+from server.server_config import ServerConfig
+
+LOCK_ASSIGNMENTS = "is_locked = 1, lock_owner = %s, lock_expires = UTC_TIMESTAMP() + INTERVAL %s SECOND"
+UNLOCK_ASSIGNMENTS = "is_locked = 0, lock_owner = NULL, lock_expires = NULL"
+
+# Conditions restricting lock and unlock updates to images the owner may lock or
+# unlock, both take the owner as their parameter
+LOCKABLE_CONDITION = "(is_locked = 0 OR lock_owner = %s OR lock_expires < UTC_TIMESTAMP())"
+UNLOCKABLE_CONDITION = "(is_locked = 0 OR lock_owner = %s)"
+
+REAP_QUERY = "UPDATE image SET " + UNLOCK_ASSIGNMENTS + " WHERE lock_expires < UTC_TIMESTAMP()"
+
+
+class LockConflict(Exception):
+    """
+    Raised when an image is locked by another client.
+    """
+
+
+def request_owner():
+    """
+    :return: The lock owner named by the current request, falling back to the
+             client address for clients which do not send one
+    """
+    return request.headers.get(ServerConfig.LOCK_OWNER_HEADER) or request.remote_addr
+
+
+def lock_params(owner):
+    """
+    :return: The parameters of LOCK_ASSIGNMENTS for a new or renewed lease
+    """
+    return owner, ServerConfig.LOCK_LEASE_SECONDS
+
+
+class LockReaper(Thread):
+    """
+    A daemon thread releasing expired lock leases every interval seconds.
+    """
+
+    def __init__(self, db, interval=ServerConfig.LOCK_REAPER_INTERVAL):
+        super().__init__(name="lock-reaper", daemon=True)
+        self.db = db
+        self.interval = interval
+        self.released = 0
+        self._stopped = Event()
+
+    def reap(self):
+        """
+        :return: The number of leases released
+        """
+        return self.db.execute(REAP_QUERY)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.released += self.reap()
+            except BaseException as e:
+                print("Failed to release expired image locks: %s" % e)
+
+    def stop(self):
+        self._stopped.set()
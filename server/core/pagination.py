@@ -0,0 +1,59 @@
+"""
+Keyset pagination helpers.
+
+A page is continued from the sort key of the last row of the previous page rather
+than an offset, so every page costs an index range scan of the page size no matter
+how deep into the listing it is. The key is handed to clients as an opaque cursor.
+"""
+import base64
+import json
+
+
+def encode_cursor(values):
+    """
+    :param values: The sort key of the last row of a page, e.g. [image_name, image_id]
+    :return: An opaque, url safe cursor string
+    """
+    data = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor, length):
+    """
+    :param cursor: A cursor returned by encode_cursor
+    :param length: The number of columns in the expected sort key
+    :return: The list of sort key values
+    :raises ValueError: If the cursor is malformed or does not match the sort key
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Cursor does not match the requested ordering.")
+    return values
+
+
+def keyset_condition(columns, ascending):
+    """
+    Build the WHERE condition selecting the rows after a cursor. The comparison is
+    expanded rather than written as a row constructor so MySQL can use it as an
+    index range.
+    :param columns: The sort key columns, the last of which must be unique
+    :param ascending: The direction of the ordering
+    :return: A tuple of (condition, function mapping cursor values to its parameters)
+    """
+    op = ">" if ascending else "<"
+    terms = []
+    for i, column in enumerate(columns):
+        equal = ["%s = %%s" % c for c in columns[:i]]
+        terms.append("(" + " AND ".join(equal + ["%s %s %%s" % (column, op)]) + ")")
+    condition = "(" + " OR ".join(terms) + ")"
+
+    def params(values):
+        result = []
+        for i in range(len(columns)):
+            result.extend(values[:i + 1])
+        return tuple(result)
+
+    return condition, params
@@ -0,0 +1,130 @@
+"""
+Multi-resolution tile pyramids for images which are too large to send whole.
+
+Level 0 is the full resolution image and every following level halves the
+dimensions of the previous one, rounding up, until the image fits in a single
+tile. Pyramids are built the first time a tile of an image is requested and
+are kept on disk under DATA/tiles/<iid>.
+"""
+import json
+import math
+import os
+from pathlib import Path
+from threading import Lock
+
+import cv2
+
+import server.utils as utils
+from server.server_config import ServerConfig
+
+MANIFEST_NAME = "manifest.json"
+
+_locks_lock = Lock()
+_build_locks = {}
+
+
+def pyramid_levels(width, height, tile_size):
+    """
+    Describe the levels of a pyramid without building it.
+    :return: A list of dicts holding the dimensions and tile grid of every level
+    """
+    levels = []
+    level = 0
+    while True:
+        scale = 2 ** level
+        level_width = max(1, math.ceil(width / scale))
+        level_height = max(1, math.ceil(height / scale))
+        levels.append({
+            "level": level,
+            "width": level_width,
+            "height": level_height,
+            "columns": math.ceil(level_width / tile_size),
+            "rows": math.ceil(level_height / tile_size)
+        })
+        if max(level_width, level_height) <= tile_size:
+            return levels
+        level += 1
+
+
+def manifest(width, height):
+    return {
+        "width": width,
+        "height": height,
+        "tile_size": ServerConfig.TILE_SIZE,
+        "format": ServerConfig.TILE_EXT,
+        "levels": pyramid_levels(width, height, ServerConfig.TILE_SIZE)
+    }
+
+
+def tiles_dir(iid):
+    return os.path.join(ServerConfig.DATA_ROOT_DIR, "tiles", str(iid))
+
+
+def tile_path(iid, level, x, y):
+    return os.path.join(
+        tiles_dir(iid), str(level), "%d_%d%s" % (x, y, ServerConfig.TILE_EXT))
+
+
+def is_built(iid):
+    return os.path.exists(os.path.join(tiles_dir(iid), MANIFEST_NAME))
+
+
+def read_manifest(iid):
+    """
+    :return: The manifest written by build_pyramid, or None if the pyramid is not built
+    """
+    try:
+        with open(os.path.join(tiles_dir(iid), MANIFEST_NAME), "rb") as f:
+            return json.loads(f.read().decode("utf-8"))
+    except FileNotFoundError:
+        return None
+
+
+def ensure_pyramid(iid, image_path):
+    """
+    Build the pyramid of an image unless it already exists. Concurrent requests
+    for the same image wait for a single build.
+    """
+    if is_built(iid):
+        return
+    with _locks_lock:
+        lock = _build_locks.setdefault(iid, Lock())
+    with lock:
+        if not is_built(iid):
+            build_pyramid(iid, image_path)
+    with _locks_lock:
+        _build_locks.pop(iid, None)
+
+
+def build_pyramid(iid, image_path):
+    # EXIF orientation is ignored so the pyramid has the stored dimensions, which are
+    # those read from the file header for manifests of pyramids not yet built
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        raise ValueError("Unable to decode image.")
+
+    tile_size = ServerConfig.TILE_SIZE
+    params = [cv2.IMWRITE_JPEG_QUALITY, ServerConfig.TILE_QUALITY]
+    height, width = img.shape[:2]
+    levels = pyramid_levels(width, height, tile_size)
+
+    for level in levels:
+        Path(os.path.join(tiles_dir(iid), str(level["level"]))).mkdir(
+            parents=True, exist_ok=True)
+        for y in range(level["rows"]):
+            for x in range(level["columns"]):
+                tile = img[y * tile_size:(y + 1) * tile_size,
+                           x * tile_size:(x + 1) * tile_size]
+                _, buf = cv2.imencode(ServerConfig.TILE_EXT, tile, params)
+                utils.write_file_atomic(
+                    tile_path(iid, level["level"], x, y), buf.tobytes())
+
+        if level is not levels[-1]:
+            img = cv2.resize(
+                img,
+                (math.ceil(img.shape[1] / 2), math.ceil(img.shape[0] / 2)),
+                interpolation=cv2.INTER_AREA)
+
+    # The manifest is written last and marks the pyramid as complete
+    data = json.dumps(manifest(width, height)).encode("utf-8")
+    utils.write_file_atomic(os.path.join(tiles_dir(iid), MANIFEST_NAME), data)
@@ -0,0 +1,260 @@
+"""
+Disk backed sessions for chunked, resumable image uploads.
+
+Every session is a directory under DATA/uploads/<session id>. Each file in the
+session is received into a ".part" file, appended to chunk by chunk as the
+request body is read, alongside a small JSON file recording its state. A client
+that loses its connection can read the state back and continue from the number
+of bytes already received. Sessions left idle for UPLOAD_SESSION_MAX_AGE seconds
+are deleted when a new session is created.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
+from werkzeug.utils import secure_filename
+
+import server.utils as utils
+from server.server_config import ServerConfig
+
+SESSION_FILE = "session.json"
+PART_EXT = ".part"
+STATE_EXT = ".state"
+
+UPLOADING = "uploading"
+CREATED = "created"
+FAILED = "failed"
+
+_SESSION_ID = re.compile(r"[0-9a-f]{32}")
+_CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+_locks_lock = Lock()
+_file_locks = {}  # (session id, name) -> [lock, number of holders and waiters]
+
+
+class UploadError(Exception):
+    def __init__(self, message, code):
+        self.message = message
+        self.code = code
+
+    def __str__(self):
+        return "UploadError, %s" % self.message
+
+
+def session_dir(sid):
+    if not _SESSION_ID.fullmatch(sid):
+        raise UploadError("Invalid upload session id.", 404)
+    return os.path.join(ServerConfig.DATA_ROOT_DIR, "uploads", sid)
+
+
+def create_session(pid):
+    expire_sessions(ServerConfig.UPLOAD_SESSION_MAX_AGE)
+    sid = uuid.uuid4().hex
+    folder = session_dir(sid)
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    session = {"session_id": sid, "project_id": pid, "created": time.time()}
+    _write_json(os.path.join(folder, SESSION_FILE), session)
+    return session
+
+
+def check_session(sid, pid):
+    """
+    Raise an UploadError unless the session exists and belongs to the project.
+    """
+    filepath = os.path.join(session_dir(sid), SESSION_FILE)
+    try:
+        with open(filepath) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        raise UploadError("Upload session not found.", 404)
+    if session["project_id"] != pid:
+        raise UploadError("Upload session not found.", 404)
+
+
+def load_session(sid, pid=None):
+    try:
+        with open(os.path.join(session_dir(sid), SESSION_FILE)) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        raise UploadError("Upload session not found.", 404)
+    if pid is not None and session["project_id"] != pid:
+        raise UploadError("Upload session not found.", 404)
+    session["files"] = list_files(sid)
+    return session
+
+
+def delete_session(sid):
+    shutil.rmtree(session_dir(sid), ignore_errors=True)
+
+
+def expire_sessions(max_age):
+    """
+    Delete sessions, and the partial files in them, that have been idle for max_age seconds.
+    Writing a file state replaces a file in the session directory, so the modification
+    time of the directory is that of its last activity.
+    :return: The number of sessions deleted
+    """
+    root = os.path.join(ServerConfig.DATA_ROOT_DIR, "uploads")
+    try:
+        entries = os.listdir(root)
+    except FileNotFoundError:
+        return 0
+
+    deleted = 0
+    cutoff = time.time() - max_age
+    for sid in entries:
+        folder = os.path.join(root, sid)
+        try:
+            if not _SESSION_ID.fullmatch(sid) or os.path.getmtime(folder) > cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        shutil.rmtree(folder, ignore_errors=True)
+        deleted += 1
+    return deleted
+
+
+@contextmanager
+def file_lock(sid, name):
+    """
+    Serialise the requests writing to one file of a session, e.g. concurrent chunks.
+    """
+    key = (sid, name)
+    with _locks_lock:
+        entry = _file_locks.setdefault(key, [Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _file_locks[key]
+
+
+def part_path(sid, name):
+    return os.path.join(session_dir(sid), _safe_name(name) + PART_EXT)
+
+
+def file_state(sid, name):
+    try:
+        with open(_state_path(sid, name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"name": name, "size": None, "received": 0, "state": UPLOADING}
+
+
+def set_file_state(sid, name, **kwargs):
+    state = file_state(sid, name)
+    state.update(kwargs)
+    _write_json(_state_path(sid, name), state)
+    return state
+
+
+def restart_file(sid, name):
+    """
+    Discard a file whose upload failed so that it can be sent again.
+    :return: The reset file state
+    """
+    try:
+        os.remove(part_path(sid, name))
+    except FileNotFoundError:
+        pass
+    state = {"name": name, "size": None, "received": 0, "state": UPLOADING}
+    _write_json(_state_path(sid, name), state)
+    return state
+
+
+def list_files(sid):
+    folder = session_dir(sid)
+    files = []
+    for entry in sorted(os.listdir(folder)):
+        if entry.endswith(STATE_EXT):
+            with open(os.path.join(folder, entry)) as f:
+                files.append(json.load(f))
+    return files
+
+
+def parse_content_range(header, content_length):
+    """
+    Parse a "bytes start-end/total" Content-Range header.
+    :return: A tuple of (start, total). Without a header the body is the whole file.
+    """
+    if not header:
+        if content_length is None:
+            raise UploadError("A Content-Length or Content-Range header is required.", 411)
+        return 0, content_length
+    match = _CONTENT_RANGE.fullmatch(header.strip())
+    if match is None:
+        raise UploadError("Malformed Content-Range header.", 400)
+    start, end, total = (int(x) for x in match.groups())
+    if end < start or end >= total:
+        raise UploadError("Invalid Content-Range header.", 416)
+    return start, total
+
+
+def write_chunk(sid, name, stream, start, total):
+    """
+    Append a chunk read from a stream to the part file of an upload.
+    The caller holds the file_lock of the file.
+    :param stream: A file like object, read incrementally
+    :param start: The offset of the chunk within the file
+    :param total: The total size of the file
+    :return: The updated file state
+    """
+    state = file_state(sid, name)
+    if state["state"] == FAILED and start == 0:
+        state = restart_file(sid, name)
+    if state["state"] != UPLOADING:
+        raise UploadError("File '%s' has already been uploaded." % name, 409)
+    if state["size"] is not None and state["size"] != total:
+        raise UploadError("File size does not match the earlier chunks.", 409)
+
+    filepath = part_path(sid, name)
+    received = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+    if start != received:
+        raise UploadError(
+            "Expected a chunk starting at byte %d." % received, 409)
+
+    with open(filepath, "ab") as f:
+        while True:
+            chunk = stream.read(ServerConfig.UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            if received > total:
+                f.truncate(start)
+                raise UploadError("Chunk exceeds the declared file size.", 400)
+            f.write(chunk)
+
+    return set_file_state(sid, name, size=total, received=received)
+
+
+def read_header(sid, name):
+    with open(part_path(sid, name), "rb") as f:
+        return f.read(256 * 1024)
+
+
+def _state_path(sid, name):
+    return os.path.join(session_dir(sid), _safe_name(name) + STATE_EXT)
+
+
+def _safe_name(name):
+    # Sanitising maps some distinct names to one, e.g. "a b.jpg" and "a_b.jpg",
+    # so the files of a session are kept apart by a hash of the original name
+    safe = secure_filename(name) if name else ""
+    if not safe:
+        raise UploadError("Invalid file name '%s'." % name, 400)
+    return "%s_%s" % (safe, hashlib.sha1(name.encode("utf-8")).hexdigest()[:12])
+
+
+def _write_json(filepath, obj):
+    utils.write_file_atomic(filepath, json.dumps(obj).encode("utf-8"))
@@ -0,0 +1,51 @@
+"""
+On demand Pascal VOC XML export for annotations.
+
+XML is no longer written when annotations are saved. It is built from the stored
+metadata the first time it is requested and cached next to the annotation bundle
+until the bundle is rewritten.
+"""
+import os
+
+import server.utils as utils
+from server.core import annotation_bundle
+
+
+def export_voc_xml(iid, row):
+    """
+    Get the VOC XML document for an annotation.
+    :param iid: The id of the image the annotation belongs to
+    :param row: An instance_seg_meta row including the ANNOTATION_META_COLUMNS
+    :return: The encoded XML document
+    """
+    if not annotation_bundle.is_bundle_path(row["info_path"]):
+        # Legacy annotations were saved with their XML
+        with open(row["info_path"], "rb") as f:
+            return f.read()
+
+    xml_path = utils.voc_xml_path(iid, row["annotation_name"])
+    if _is_fresh(xml_path, row["mask_path"]):
+        with open(xml_path, "rb") as f:
+            return f.read()
+
+    info = utils.annotation_meta_from_row(row)
+    if info is None:
+        entry = annotation_bundle.read_bundle_entry_meta(
+            row["mask_path"], row["annotation_name"])
+        info = {"bbox": entry["bbox"], "source_shape": entry["shape"]}
+
+    xml = utils.build_voc_xml(info["source_shape"], info["bbox"], row["class_name"])
+    try:
+        os.makedirs(os.path.dirname(xml_path), exist_ok=True)
+        utils.write_file_atomic(xml_path, xml)
+    except OSError:
+        # The export is still valid if the cache cannot be written
+        pass
+    return xml
+
+
+def _is_fresh(cache_path, source_path):
+    try:
+        return os.path.getmtime(cache_path) >= os.path.getmtime(source_path)
+    except OSError:
+        return False
@@ -1,7 +1,10 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 
 from database.database import Database
 from definitions import ROOT_DIR
+from server.core.lru_cache import LruCache
 
 
 class ServerConfig:
@@ -10,29 +13,79 @@ class ServerConfig:
     DATABASE_PASSWORD = "root"
     DATABASE_NAME = "fadb"
     DATABASE_POOL_SIZE = 3
+    # Seconds a request waits for a free connection before failing
+    DATABASE_POOL_TIMEOUT = 3
+    # Connections idle for longer than this many seconds are pinged before reuse
+    DATABASE_HEALTH_CHECK_INTERVAL = 30
     DATABASE_TIMEZONE = '+00:00'
 
     DATA_ROOT_DIR = os.path.join(ROOT_DIR, "database", "DATA")
     XML_TEMPLATE_PATH = os.path.join(ROOT_DIR, "server", "template.xml")
     DEFAULT_IMAGE_EXT = ".jpg"
 
+    # When False uploads are stored byte for byte, when True they are re-encoded as DEFAULT_IMAGE_EXT
+    TRANSCODE_UPLOADS = False
+
+    # Size of the reads used to stream upload bodies to disk
+    UPLOAD_CHUNK_SIZE = 1024 * 1024
+    # Seconds an upload session may sit idle before it and its partial files are deleted
+    UPLOAD_SESSION_MAX_AGE = 24 * 60 * 60
+    ANNOTATION_BUNDLE_EXT = ".fab"
+
+    # Mask encodings the server is willing to send, in order of preference
+    MASK_ENCODINGS = ("rle", "packbits_zlib", "packbits", "raw")
+
+    # Memory budget for encoded annotation masks kept between requests
+    ANNOTATION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+    # Number of image content hashes remembered for ETags
+    ETAG_CACHE_SIZE = 65536
+
+    # Thumbnails are generated at upload, bounded to THUMBNAIL_SIZE on the longest side
+    THUMBNAIL_SIZE = 256
+    THUMBNAIL_EXT = ".jpg"
+    THUMBNAIL_QUALITY = 80
+    THUMBNAIL_WORKERS = os.cpu_count() or 1
+
+    # Processes used to decode, hash and thumbnail bulk image uploads
+    INGEST_WORKERS = os.cpu_count() or 1
+
+    # Tile pyramids for large images, built on first request
+    TILE_SIZE = 512
+    TILE_EXT = ".jpg"
+    TILE_QUALITY = 90
+    TILE_MAX_AGE = 24 * 60 * 60
+
     # Used to white list filter combinations for Project Images
     IMAGE_FILTER_MAP = {
         "locked": {
             True: "is_locked = 1",
             False: "is_locked = 0"
         },
-        "labelled": {
+        "labeled": {
             True: "is_labeled = 1",
             False: "is_labeled = 0"
         }
     }
 
+    # Sort keys for Project Images, the last column of each must be unique
     IMAGE_ORDER_BY_MAP = {
-        "name": "image_name",
-        "id": "image_id"
+        "name": ("image_name", "image_id"),
+        "id": ("image_id",)
     }
 
+    # Image listings are paged, clients may ask for up to IMAGE_PAGE_SIZE_MAX rows at once
+    IMAGE_PAGE_SIZE = 500
+    IMAGE_PAGE_SIZE_MAX = 5000
+
+    # Most images an annotator may claim from a project's work queue at once
+    CLAIM_MAX_COUNT = 50
+
+    # Locks are leases renewed by client heartbeats, expired leases are released by the reaper
+    LOCK_OWNER_HEADER = "X-Lock-Owner"
+    LOCK_LEASE_SECONDS = 120
+    LOCK_REAPER_INTERVAL = 30
+
 
 class DatabaseInstance:
     __instance = None
@@ -41,3 +94,33 @@ class DatabaseInstance:
         if DatabaseInstance.__instance is None:
             DatabaseInstance.__instance = Database(ServerConfig())
         return DatabaseInstance.__instance
+
+
+class AnnotationCacheInstance:
+    __instance = None
+
+    def __new__(cls):
+        if AnnotationCacheInstance.__instance is None:
+            AnnotationCacheInstance.__instance = LruCache(
+                ServerConfig.ANNOTATION_CACHE_MAX_BYTES)
+        return AnnotationCacheInstance.__instance
+
+
+class ThumbnailPoolInstance:
+    __instance = None
+
+    def __new__(cls):
+        if ThumbnailPoolInstance.__instance is None:
+            ThumbnailPoolInstance.__instance = ThreadPoolExecutor(
+                max_workers=ServerConfig.THUMBNAIL_WORKERS)
+        return ThumbnailPoolInstance.__instance
+
+
+class IngestPoolInstance:
+    __instance = None
+
+    def __new__(cls):
+        if IngestPoolInstance.__instance is None:
+            IngestPoolInstance.__instance = ProcessPoolExecutor(
+                max_workers=ServerConfig.INGEST_WORKERS)
+        return IngestPoolInstance.__instance
@@ -0,0 +1,71 @@
+"""
+Fills the metadata columns of instance_seg_meta from existing annotation files.
+
+Rows are read from their annotation bundle where available, otherwise from the
+legacy VOC XML and trimap PNG.
+
+Usage:
+    python -m server.tools.backfill_annotation_meta [--dry-run]
+"""
+import argparse
+
+import server.utils as utils
+from server.core import annotation_bundle
+from server.server_config import DatabaseInstance
+
+
+def load_annotation(row, bundles):
+    """
+    Load the shape, bbox and mask of an annotation row.
+    :param row: A row from instance_seg_meta
+    :param bundles: A dict caching the bundle of the current image between rows
+    :return: A tuple of (shape, bbox, mask)
+    """
+    if annotation_bundle.is_bundle_path(row["mask_path"]):
+        if row["mask_path"] not in bundles:
+            bundles.clear()
+            bundles[row["mask_path"]] = annotation_bundle.read_bundle(
+                row["mask_path"])
+        stored = bundles[row["mask_path"]][row["annotation_name"]]
+        return stored["shape"], stored["bbox"], stored["mask"]
+
+    info = utils.load_info(row["info_path"])
+    mask = utils.load_mask(row["mask_path"])
+    return info["source_shape"], info["bbox"], mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    db = DatabaseInstance()
+
+    query = "SELECT annotation_id, annotation_name, mask_path, info_path FROM instance_seg_meta "
+    query += "WHERE pixel_area IS NULL ORDER BY image_id"
+    rows, _ = db.query(query)
+
+    update = "UPDATE instance_seg_meta SET "
+    update += ", ".join("%s = %%s" % column for column in utils.ANNOTATION_META_COLUMNS)
+    update += " WHERE annotation_id = %s"
+
+    updated = 0
+    failed = 0
+    bundles = {}
+    for row in rows:
+        try:
+            shape, bbox, mask = load_annotation(row, bundles)
+            params = utils.annotation_meta_params(shape, bbox, mask)
+            if not args.dry_run:
+                db.query(update, params + (row["annotation_id"],))
+        except BaseException as e:
+            print("Failed to backfill annotation %d: %s" % (row["annotation_id"], str(e)))
+            failed += 1
+        else:
+            updated += 1
+
+    print("Backfilled %d of %d annotations (%d failed)" % (updated, len(rows), failed))
+
+
+if __name__ == "__main__":
+    main()
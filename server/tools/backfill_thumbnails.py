@@ -0,0 +1,57 @@
+"""
+Generates thumbnails for images uploaded before thumbnails were created at ingest.
+
+Usage:
+    python -m server.tools.backfill_thumbnails [--project PID] [--force]
+"""
+import argparse
+import os
+
+import server.utils as utils
+from server.server_config import DatabaseInstance
+from server.server_config import ThumbnailPoolInstance
+
+
+def backfill(row, force=False):
+    """
+    Create the thumbnail for an image row if required.
+    :return: True if a thumbnail was written
+    """
+    if not force and os.path.exists(utils.thumbnail_path(row["image_id"])):
+        return False
+    utils.save_thumbnail(row["image_path"], row["image_id"])
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--project", type=int, default=None)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    db = DatabaseInstance()
+    pool = ThumbnailPoolInstance()
+
+    query = "SELECT image_id, image_path FROM image"
+    params = None
+    if args.project is not None:
+        query += " WHERE project_fid = %s"
+        params = (args.project,)
+    rows, _ = db.query(query, params)
+
+    jobs = [(row, pool.submit(backfill, row, args.force)) for row in rows]
+    created = 0
+    failed = 0
+    for row, job in jobs:
+        try:
+            created += int(job.result())
+        except BaseException as e:
+            print("Failed to create thumbnail for image %d: %s" % (row["image_id"], str(e)))
+            failed += 1
+
+    pool.shutdown(wait=True)
+    print("Created %d thumbnails for %d images (%d failed)" % (created, len(rows), failed))
+
+
+if __name__ == "__main__":
+    main()
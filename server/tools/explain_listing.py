@@ -0,0 +1,142 @@
+"""
+Benchmarks the project image listing and checks its query plans with EXPLAIN.
+
+Seeds a temporary project with synthetic image rows, then times every listing
+shape (ordering, filters, inline fields, first and later pages) and fails if a
+plan scans the whole table, needs a filesort, or reads table rows for a listing
+which should be answered from the index alone.
+
+Usage:
+    python -m server.tools.explain_listing [--rows N] [--repeat N] [--keep]
+"""
+import argparse
+import itertools
+import json
+import random
+import sys
+import time
+import uuid
+
+from server.core.image_listing import ImageListing
+from server.server_config import DatabaseInstance
+
+FIELDS = ["name", "is_locked"]
+
+
+def listing_shapes():
+    """
+    :return: A list of (description, listing request, whether it must be index only)
+    """
+    shapes = []
+    for key, filtered, fields in itertools.product(("name", "id"), (False, True), (False, True)):
+        content = {"order_by": {"key": key, "ascending": True}, "limit": 200}
+        if filtered:
+            content["locked"] = False
+            content["labeled"] = False
+        if fields:
+            content["fields"] = FIELDS
+        description = "order=%s filter=%s fields=%s" % (key, filtered, fields)
+        # Listings by name select only indexed columns, listings by id are checked for order only
+        shapes.append((description, content, key == "name"))
+    return shapes
+
+
+def find_plans(node, plans):
+    """
+    Collect the table access plans and filesort flags of an EXPLAIN FORMAT=JSON document.
+    """
+    if isinstance(node, dict):
+        if node.get("using_filesort"):
+            plans.append({"using_filesort": True})
+        if "table_name" in node:
+            plans.append(node)
+        for value in node.values():
+            find_plans(value, plans)
+    elif isinstance(node, list):
+        for value in node:
+            find_plans(value, plans)
+    return plans
+
+
+def check_plan(tx, listing, index_only):
+    rows, _ = tx.query("EXPLAIN FORMAT=JSON " + listing.query, listing.params)
+    plan = json.loads(list(rows[0].values())[0])
+
+    problems = []
+    key = None
+    for node in find_plans(plan, []):
+        if node.get("using_filesort"):
+            problems.append("filesort")
+        if node.get("table_name") != "image":
+            continue
+        key = node.get("key")
+        if node.get("access_type") == "ALL" or key is None:
+            problems.append("full table scan")
+        if index_only and not node.get("using_index"):
+            problems.append("reads table rows")
+    return key, problems
+
+
+def seed(tx, pid, count):
+    batch = []
+    prefix = uuid.uuid4().hex
+    query = "INSERT INTO image (project_fid, image_path, image_name, image_ext, is_locked, is_labeled) VALUES "
+    for i in range(count):
+        batch.append((pid, "benchmark/%s/%d.jpg" % (prefix, i), "image_%08d" % random.randrange(count),
+                      ".jpg", random.random() < 0.1, random.random() < 0.5))
+    tx.insert_many(query, "(%s, %s, %s, %s, %s, %s)", batch,
+                   "SELECT image_id, image_path FROM image WHERE (image_path) IN ", (1,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark project instead of deleting it")
+    args = parser.parse_args()
+
+    db = DatabaseInstance()
+
+    with db.transaction() as tx:
+        _, pid = tx.query("INSERT INTO project (project_name) VALUES (%s)",
+                          ("explain-benchmark-" + uuid.uuid4().hex[:8],))
+        seed(tx, pid, args.rows)
+    db.query("ANALYZE TABLE image")
+
+    failures = 0
+    try:
+        for description, content, index_only in listing_shapes():
+            first = ImageListing(pid, content)
+            results, _ = db.query(first.query, first.params)
+            cursor = first.page(results).get("next_cursor")
+            pages = [("first page", first)]
+            if cursor is not None:
+                pages.append(("next page", ImageListing(pid, dict(content, cursor=cursor))))
+
+            for page_name, listing in pages:
+                with db.transaction() as tx:
+                    key, problems = check_plan(tx, listing, index_only)
+                    t0 = time.perf_counter()
+                    for _ in range(args.repeat):
+                        tx.query(listing.query, listing.params)
+                    elapsed = (time.perf_counter() - t0) / args.repeat
+
+                status = "FAIL (%s)" % ", ".join(problems) if problems else "ok"
+                print("%-42s %-10s %7.2f ms  key=%-24s %s" % (
+                    description, page_name, elapsed * 1000, key, status))
+                failures += bool(problems)
+    finally:
+        if not args.keep:
+            with db.transaction() as tx:
+                tx.query("DELETE FROM image WHERE project_fid = %s", (pid,))
+                tx.query("DELETE FROM project WHERE project_id = %s", (pid,))
+
+    if failures:
+        print("%d listing plans are not index backed" % failures)
+        sys.exit(1)
+    print("All listing plans are index backed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Applies pending schema migrations from database/migrations to the configured database.
+
+Usage:
+    python -m server.tools.migrate [--list] [--target VERSION] [--fake]
+"""
+import argparse
+
+from database import migrate
+from server.server_config import DatabaseInstance
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--list", action="store_true",
+                        help="only list the pending migrations")
+    parser.add_argument("--target", type=int, default=None,
+                        help="the last migration version to apply")
+    parser.add_argument("--fake", action="store_true",
+                        help="record the migrations as applied without running them")
+    args = parser.parse_args()
+
+    db = DatabaseInstance()
+
+    if args.list:
+        pending = migrate.pending_migrations(db)
+        for migration in pending:
+            print("%04d %s" % (migration.version, migration.name))
+        print("%d pending migrations" % len(pending))
+        return
+
+    applied = migrate.migrate(db, target=args.target, fake=args.fake)
+    for migration in applied:
+        print("Applied %s" % migration.name)
+    print("Applied %d migrations" % len(applied))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Rewrites legacy full image trimap masks as bbox cropped single channel PNGs.
+
+Usage:
+    python -m server.tools.migrate_masks [--data-root DIR] [--dry-run]
+"""
+import argparse
+import glob
+import os
+
+import server.utils as utils
+from server.server_config import ServerConfig
+
+
+def find_masks(data_root):
+    pattern = os.path.join(data_root, "annotation", "*", "trimaps", "*.png")
+    return sorted(glob.glob(pattern))
+
+
+def migrate_mask(filepath, dry_run=False):
+    """
+    Convert a single mask file in place.
+    :param filepath: The path to a trimap PNG
+    :param dry_run: If True the file is left untouched
+    :return: A tuple of (migrated, size before, size after)
+    """
+    size_before = os.path.getsize(filepath)
+    if utils.is_cropped_mask(filepath):
+        return False, size_before, size_before
+
+    mask = utils.load_mask(filepath)
+    if dry_run:
+        return True, size_before, size_before
+
+    utils.save_mask(mask, filepath)
+    return True, size_before, os.path.getsize(filepath)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--data-root", default=ServerConfig.DATA_ROOT_DIR)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    migrated = 0
+    failed = 0
+    total_before = 0
+    total_after = 0
+    for filepath in find_masks(args.data_root):
+        try:
+            changed, before, after = migrate_mask(filepath, args.dry_run)
+        except BaseException as e:
+            print("Failed to migrate %s: %s" % (filepath, str(e)))
+            failed += 1
+            continue
+        if changed:
+            migrated += 1
+            total_before += before
+            total_after += after
+
+    print("Migrated %d masks (%d failed)" % (migrated, failed))
+    if not args.dry_run:
+        print("\t%d bytes -> %d bytes" % (total_before, total_after))
+
+
+if __name__ == "__main__":
+    main()
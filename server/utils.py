@@ -1,23 +1,38 @@
-import base64
+import copy
+import functools
+import hashlib
+import json
+import mimetypes
 import os
+import struct
+import tempfile
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import zlib
 from pathlib import Path
 
 import cv2
 import numpy as np
+
+from common import mask_codec
+from server.core.lru_cache import LruCache
 from server.server_config import ServerConfig
 
 
-def encode_mask(mask):
-    encoded_mask = base64.b64encode(mask.tobytes(order='C'))
-    return encoded_mask.decode('utf-8')
+def encode_mask(mask, encoding=mask_codec.DEFAULT_ENCODING):
+    return mask_codec.encode_mask(mask, encoding)
+
+
+def decode_mask(encoded, shape, encoding=mask_codec.DEFAULT_ENCODING):
+    return mask_codec.decode_mask(encoded, shape, encoding)
 
 
-def decode_mask(b64_str, shape):
-    mask_bytes = base64.b64decode(b64_str.encode("utf-8"))
-    flat = np.fromstring(mask_bytes, bool)
-    return np.reshape(flat, newshape=shape[:2], order='C')
+def encode_mask_smallest(mask, encodings):
+    return mask_codec.encode_smallest(mask, encodings)
+
+
+def negotiate_mask_encodings(header_value):
+    return mask_codec.parse_encodings(
+        header_value, supported=ServerConfig.MASK_ENCODINGS)
 
 
 def mask2mat(mask):
@@ -29,23 +44,394 @@ def mat2mask(mat):
     return np.sum(mat.astype(bool), axis=2, dtype=bool)
 
 
+# Keyword of the PNG tEXt chunk holding the crop offset and source shape of a mask
+MASK_PNG_KEYWORD = b"fa_mask"
+
+
+def crop_mask(mask):
+    """
+    Crop a mask to the bounding box of its set pixels.
+    :param mask: A 2D boolean mask
+    :return: A tuple of (cropped mask, (row offset, column offset))
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return np.zeros((1, 1), dtype=bool), (0, 0)
+    y0, y1 = int(rows[0]), int(rows[-1]) + 1
+    x0, x1 = int(cols[0]), int(cols[-1]) + 1
+    return mask[y0:y1, x0:x1], (y0, x0)
+
+
+def uncrop_mask(cropped, offset, shape):
+    mask = np.zeros(tuple(shape[:2]), dtype=bool)
+    y, x = offset
+    h, w = cropped.shape[:2]
+    mask[y:y + h, x:x + w] = cropped[:mask.shape[0] - y, :mask.shape[1] - x]
+    return mask
+
+
 def save_mask(mask, filepath):
+    """
+    Save a mask as a single channel PNG cropped to its set pixels. The crop offset
+    and the full mask shape are kept in a tEXt chunk so load_mask can rebuild it.
+    """
     folder = os.path.dirname(filepath)
     Path(folder).mkdir(parents=True, exist_ok=True)
-    mask = mask.astype(np.uint8) * 255
-    cv2.imwrite(filepath, mask)
+    write_file_atomic(filepath, encode_mask_png(mask))
+
+
+def encode_mask_png(mask):
+    mask = mask.astype(bool)
+    cropped, offset = crop_mask(mask)
+    _, buf = cv2.imencode(".png", cropped.astype(np.uint8) * 255)
+    meta = json.dumps({"offset": offset, "shape": mask.shape[:2]})
+    return _png_add_text(buf.tobytes(), MASK_PNG_KEYWORD, meta.encode("utf-8"))
+
+
+def load_mask_crop(filepath):
+    """
+    Load the stored region of a mask without expanding it.
+    :return: A tuple of (cropped mask, (row offset, column offset), full shape)
+    """
+    with open(filepath, "rb") as f:
+        data = f.read()
+    return decode_mask_png(data)
+
+
+def decode_mask_png(data):
+    cropped = cv2.imdecode(
+        np.frombuffer(data, np.uint8),
+        cv2.IMREAD_GRAYSCALE).astype(bool)
+    meta = _png_find_text(data, MASK_PNG_KEYWORD)
+    if meta is None:
+        # Legacy full image mask
+        return cropped, (0, 0), cropped.shape
+    meta = json.loads(meta.decode("utf-8"))
+    return cropped, tuple(meta["offset"]), tuple(meta["shape"])
 
 
 def load_mask(filepath):
-    mask = cv2.imread(filepath)
-    mask = np.all(mask.astype(bool), axis=2)
-    return mask
+    return expand_mask(*load_mask_crop(filepath))
 
 
-def save_info(shape, bbox, class_name, filepath):
-    create_info_file(filepath)
+def expand_mask(cropped, offset, shape):
+    if tuple(offset) == (0, 0) and cropped.shape == tuple(shape[:2]):
+        return cropped
+    return uncrop_mask(cropped, offset, shape)
 
-    root = ET.parse(filepath).getroot()
+
+def is_cropped_mask(filepath):
+    with open(filepath, "rb") as f:
+        data = f.read()
+    return _png_find_text(data, MASK_PNG_KEYWORD) is not None
+
+
+def project_image_dir(pid):
+    return os.path.join(
+        ServerConfig.DATA_ROOT_DIR,
+        "images",
+        str(pid))
+
+
+def annotation_bundle_path(iid):
+    return os.path.join(
+        ServerConfig.DATA_ROOT_DIR,
+        "annotation",
+        str(iid),
+        "annotations" + ServerConfig.ANNOTATION_BUNDLE_EXT)
+
+
+def file_version(filepath):
+    """
+    A token which changes whenever the file is rewritten.
+    """
+    stat = os.stat(filepath)
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Content hashes of image files, keyed by path and file version
+_etag_cache = LruCache(ServerConfig.ETAG_CACHE_SIZE)
+
+
+def file_etag(filepath):
+    """
+    A strong ETag derived from the content hash of a file. Hashes are cached
+    against the file version so unchanged files are only read once.
+    """
+    key = (filepath, file_version(filepath))
+    digest = _etag_cache.get(key)
+    if digest is None:
+        with open(filepath, "rb") as f:
+            digest = content_hash(f)
+        _etag_cache.put(key, digest, 1)
+    return digest
+
+
+def remember_file_etag(filepath, digest):
+    """
+    Record the content hash of a file that was hashed while it was written.
+    """
+    _etag_cache.put((filepath, file_version(filepath)), digest, 1)
+
+
+def content_hash(f):
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_mimetype(ext):
+    mimetype, _ = mimetypes.guess_type("image" + ext.lower())
+    return mimetype or "application/octet-stream"
+
+
+def image_dimensions(data):
+    """
+    Read the format and dimensions of an encoded image from its header bytes.
+    :param data: The leading bytes of an image file
+    :return: A tuple of (ext, width, height), or None if the format is not recognised
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        width, height = struct.unpack(">II", data[16:24])
+        return ".png", width, height
+
+    if data[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 4 <= len(data):
+            if data[pos] != 0xFF:
+                return None
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                pos += 2
+                continue
+            length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+            # Start of frame markers, excluding DHT (C4), JPG (C8) and DAC (CC)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                if pos + 9 > len(data):
+                    return None
+                height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                return ".jpg", width, height
+            pos += 2 + length
+        return None
+
+    if data[:2] == b"BM" and len(data) >= 26:
+        width, height = struct.unpack("<ii", data[18:26])
+        return ".bmp", width, abs(height)
+
+    return None
+
+
+# Formats accepted for upload, by the extension reported by image_dimensions
+IMAGE_FORMATS = {
+    ".jpg": "jpeg",
+    ".png": "png",
+    ".bmp": "bmp"
+}
+
+
+def sniff_image(data):
+    """
+    Identify an uploaded image from its header bytes without decoding it.
+    :param data: The encoded image
+    :return: A dict holding the ext, format, width and height of the image
+    :raises ValueError: If the image format is not supported
+    """
+    header = image_dimensions(data)
+    if header is None or header[0] not in IMAGE_FORMATS:
+        raise ValueError("Unsupported or corrupt image.")
+    ext, width, height = header
+    if width <= 0 or height <= 0:
+        raise ValueError("Invalid image dimensions %dx%d." % (width, height))
+    return {
+        "ext": ext,
+        "format": IMAGE_FORMATS[ext],
+        "width": width,
+        "height": height
+    }
+
+
+def transcode_image(data, ext):
+    """
+    Decode an uploaded image and re-encode it in another format.
+    :return: A tuple of (encoded image, meta dict in the form returned by sniff_image)
+    """
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Unsupported or corrupt image.")
+    _, buf = cv2.imencode(ext, img)
+    return buf.tobytes(), sniff_image(buf.tobytes())
+
+
+def read_image_dimensions(image_path):
+    """
+    Read the dimensions of an image file, decoding it only if the header is not understood.
+    :return: A tuple of (width, height)
+    """
+    with open(image_path, "rb") as f:
+        header = image_dimensions(f.read(256 * 1024))
+    if header is not None:
+        return header[1], header[2]
+    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("Unable to decode image.")
+    return img.shape[1], img.shape[0]
+
+
+def create_thumbnail(data, max_size=None):
+    """
+    Create a JPEG thumbnail from encoded image bytes. Large JPEGs are decoded at a
+    reduced resolution so the full image is never materialised.
+    :param data: The encoded image
+    :param max_size: The maximum length of the longest side of the thumbnail
+    :return: The encoded thumbnail
+    """
+    if max_size is None:
+        max_size = ServerConfig.THUMBNAIL_SIZE
+
+    flag = cv2.IMREAD_COLOR
+    header = image_dimensions(data)
+    if header is not None and header[0] == ".jpg":
+        longest = max(header[1:])
+        for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                                (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if longest // factor >= max_size:
+                flag = reduced
+                break
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if img is None:
+        raise ValueError("Unable to decode image.")
+
+    scale = max_size / max(img.shape[:2])
+    if scale < 1:
+        size = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    _, buf = cv2.imencode(
+        ServerConfig.THUMBNAIL_EXT, img,
+        [cv2.IMWRITE_JPEG_QUALITY, ServerConfig.THUMBNAIL_QUALITY])
+    return buf.tobytes()
+
+
+def thumbnail_path(iid):
+    return os.path.join(
+        ServerConfig.DATA_ROOT_DIR,
+        "thumbnails",
+        str(iid) + ServerConfig.THUMBNAIL_EXT)
+
+
+def save_thumbnail(image_path, iid):
+    with open(image_path, "rb") as f:
+        data = f.read()
+    filepath = thumbnail_path(iid)
+    Path(os.path.dirname(filepath)).mkdir(parents=True, exist_ok=True)
+    write_file_atomic(filepath, create_thumbnail(data))
+    return filepath
+
+
+def load_thumbnail(image_path, iid):
+    """
+    Read the thumbnail of an image, generating it if it does not exist yet.
+    """
+    filepath = thumbnail_path(iid)
+    if not os.path.exists(filepath):
+        save_thumbnail(image_path, iid)
+    with open(filepath, "rb") as f:
+        return f.read()
+
+
+def write_file_atomic(filepath, data):
+    """
+    Write a file so readers only ever see its old or new contents. Every call writes
+    its own temporary file, so concurrent writers of one path never share one.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(filepath) or ".",
+        prefix=os.path.basename(filepath) + ".",
+        suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp creates files readable by their owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _png_chunk(chunk_type, body):
+    crc = zlib.crc32(chunk_type + body) & 0xffffffff
+    return struct.pack(">I", len(body)) + chunk_type + body + struct.pack(">I", crc)
+
+
+def _png_add_text(png, keyword, text):
+    # The IHDR chunk always directly follows the 8 byte signature and is 25 bytes long
+    ihdr_end = 8 + 25
+    chunk = _png_chunk(b"tEXt", keyword + b"\0" + text)
+    return png[:ihdr_end] + chunk + png[ihdr_end:]
+
+
+def _png_find_text(png, keyword):
+    pos = 8
+    while pos + 8 <= len(png):
+        length, chunk_type = struct.unpack(">I4s", png[pos:pos + 8])
+        if chunk_type == b"IDAT":
+            break
+        if chunk_type == b"tEXt":
+            body = png[pos + 8:pos + 8 + length]
+            key, _, text = body.partition(b"\0")
+            if key == keyword:
+                return text
+        pos += 12 + length
+    return None
+
+
+# instance_seg_meta columns holding the metadata previously read from the VOC XML
+ANNOTATION_META_COLUMNS = (
+    "bbox_xmin", "bbox_ymin", "bbox_xmax", "bbox_ymax",
+    "source_width", "source_height", "source_depth", "pixel_area")
+
+
+def annotation_meta_params(shape, bbox, mask):
+    """
+    Build the values for ANNOTATION_META_COLUMNS, in column order.
+    """
+    return (int(bbox[0]), int(bbox[1]), int(bbox[2]), int(bbox[3]),
+            int(shape[0]), int(shape[1]), int(shape[2]),
+            int(np.count_nonzero(mask)))
+
+
+def annotation_meta_from_row(row):
+    """
+    Read annotation metadata from a database row, in the same form as load_info.
+    :return: The info dict, or None if the row has not been backfilled yet
+    """
+    if row.get("bbox_xmin") is None:
+        return None
+    return {
+        "bbox": (row["bbox_xmin"], row["bbox_ymin"], row["bbox_xmax"], row["bbox_ymax"]),
+        "source_shape": (row["source_width"], row["source_height"], row["source_depth"]),
+        "class_name": row["class_name"],
+        "pixel_area": row["pixel_area"]
+    }
+
+
+def build_voc_xml(shape, bbox, class_name):
+    """
+    Build a Pascal VOC XML document for an annotation in memory.
+    :return: The encoded XML document
+    """
+    root = copy.deepcopy(_voc_template())
 
     obj = root.find('size')
     obj.find('width').text = str(shape[0])
@@ -60,11 +446,13 @@ def save_info(shape, bbox, class_name, filepath):
     obj.find("bndbox/xmax").text = str(bbox[2])
     obj.find("bndbox/ymax").text = str(bbox[3])
 
+    return b'<?xml version="1.0" ?>\n' + ET.tostring(root, encoding="utf-8")
 
-    xmlstr = minidom.parseString(ET.tostring(root)).toprettyxml(indent="   ")
-    xmlstr = os.linesep.join([s for s in xmlstr.splitlines() if s.strip()])
-    with open(filepath, 'w') as f:
-        f.write(xmlstr)
+
+def save_info(shape, bbox, class_name, filepath):
+    folder = os.path.dirname(filepath)
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    write_file_atomic(filepath, build_voc_xml(shape, bbox, class_name))
 
 
 def load_info(filepath):
@@ -90,10 +478,16 @@ def load_info(filepath):
     return info
 
 
-def create_info_file(filepath):
-    folder = os.path.dirname(filepath)
-    Path(folder).mkdir(parents=True, exist_ok=True)
-    with open(ServerConfig.XML_TEMPLATE_PATH) as f_in:
-        with open(filepath, "w") as f_out:
-            for line in f_in:
-                f_out.write(line)
\ No newline at end of file
+@functools.lru_cache(maxsize=1)
+def _voc_template():
+    # The template is already indented, so copies of it serialise pretty printed
+    return ET.parse(ServerConfig.XML_TEMPLATE_PATH).getroot()
+
+
+def voc_xml_path(iid, annotation_name):
+    return os.path.join(
+        ServerConfig.DATA_ROOT_DIR,
+        "annotation",
+        str(iid),
+        "xmls",
+        "%s.xml" % annotation_name)